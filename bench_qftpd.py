@@ -0,0 +1,255 @@
+"""Benchmarks for qftpd that need no cluster: an async qftpd server is run
+in-process against a fake_qumulo cluster and driven by ftplib clients, and
+each scenario reports operations per second and p50/p99 latencies. Only
+the network to the cluster is faked, every REST call still goes through
+qftpd's scheduler, node balancer, metrics and (with --trace) tracing.
+
+    python bench_qftpd.py                      # every scenario
+    python bench_qftpd.py list_10k stor_small  # just these
+    python bench_qftpd.py --latency 0.002 --bandwidth 200e6 --clients 8
+"""
+import io
+import sys
+import time
+import ftplib
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+
+import pyftpdlib.log
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.servers import FTPServer
+
+import qftpd
+import fake_qumulo
+
+USER = u'bench'
+PASSWORD = u'bench'
+SCENARIOS = OrderedDict()  # name -> (function, description)
+
+
+def scenario(description):
+    def register(function):
+        SCENARIOS[function.__name__] = (function, description)
+        return function
+    return register
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[int(round((len(ordered) - 1) * percent / 100.0))]
+
+
+class Bench(object):
+    """A qftpd server on a fake cluster, and ways to time clients using it"""
+    def __init__(self, latency, bandwidth, clients, scale, nodes):
+        self.clients = clients
+        self.scale = scale
+        self.cluster = fake_qumulo.FakeCluster(
+            latency=latency, bandwidth=bandwidth,
+            nodes=['10.0.0.%d' % (n + 1) for n in range(nodes)])
+        self.cluster.add_user(USER, PASSWORD)
+        self.cluster.install()
+        self.server = self.start_server()
+        self.address = self.server.socket.getsockname()[:2]
+
+    def start_server(self):
+        handler = qftpd.QFTPHandler
+        handler.authorizer = qftpd.QSFSAuthorizer()
+        handler.abstracted_fs = qftpd.AbstractedQSFS
+        # as main() does, which finds the cluster's nodes
+        handler.authorizer.admin_pool.call(qftpd.refresh_nodes)
+        handler.authorizer.admin_pool.call(qftpd.warm_identity_caches)
+        ioloop = IOLoop()
+        server = FTPServer(('127.0.0.1', 0), handler, ioloop=ioloop)
+        if qftpd.WORKER_THREADS:
+            handler.executor = qftpd.IOLoopExecutor(qftpd.WORKER_THREADS,
+                                                    ioloop)
+        self.thread = threading.Thread(target=server.serve_forever,
+                                       kwargs={'handle_exit': False},
+                                       name='bench-server')
+        self.thread.daemon = True
+        self.thread.start()
+        return server
+
+    def close(self):
+        """Shut the server down from its own thread, closing any transfer
+        still winding down
+        """
+        executor = qftpd.QFTPHandler.executor
+        if executor is not None:
+            executor.call_soon(self.server.close_all)
+            self.thread.join(10)
+
+    def connect(self):
+        ftp = ftplib.FTP()
+        ftp.connect(*self.address)
+        ftp.login(USER, PASSWORD)
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def run(self, operation, iterations, clients=None, login=True):
+        """Call operation(ftp, i) iterations times spread over clients
+        sessions in parallel, returning each call's latency and the
+        elapsed wall clock time
+        """
+        clients = min(clients or self.clients, iterations)
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def client(first):
+            ftp = self.connect() if login else None
+            try:
+                for i in range(first, iterations, clients):
+                    start = time.time()
+                    operation(ftp, i)
+                    elapsed = time.time() - start
+                    with lock:
+                        latencies.append(elapsed)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                if ftp is not None:
+                    ftp.close()
+        threads = [threading.Thread(target=client, args=(n,))
+                   for n in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return latencies, time.time() - start
+
+
+@scenario('log in and out')
+def login(bench):
+    def operation(_, i):
+        bench.connect().quit()
+    return bench.run(operation, 200 * bench.scale, login=False), 0
+
+
+def list_directory(bench, entries, iterations):
+    path = '/list_%d' % entries
+    bench.cluster.make_files(path, entries)
+    lines = []
+
+    def operation(ftp, i):
+        del lines[:]
+        ftp.retrlines('LIST %s' % path, lines.append)
+        assert len(lines) == entries, len(lines)
+    return bench.run(operation, iterations, clients=1), 0
+
+
+@scenario('LIST of a 10,000 entry directory')
+def list_10k(bench):
+    return list_directory(bench, 10000, 10 * bench.scale)
+
+
+@scenario('LIST of a 100,000 entry directory')
+def list_100k(bench):
+    return list_directory(bench, 100000, 2 * bench.scale)
+
+
+@scenario('STOR of many 4KB files')
+def stor_small(bench):
+    data = 'x' * 4096
+    bench.cluster.create('/small', 'DIRECTORY')
+
+    def operation(ftp, i):
+        ftp.storbinary('STOR /small/%06d' % i, io.BytesIO(data))
+    iterations = 500 * bench.scale
+    return bench.run(operation, iterations), iterations * len(data)
+
+
+@scenario('STOR of 256MB files')
+def stor_large(bench):
+    size = 256 * 1024 * 1024
+    data = '\0' * size
+    bench.cluster.create('/large_stor', 'DIRECTORY')
+
+    def operation(ftp, i):
+        ftp.storbinary('STOR /large_stor/%d' % i, io.BytesIO(data),
+                       blocksize=65536)
+    iterations = 2 * bench.scale
+    return bench.run(operation, iterations, clients=1), iterations * size
+
+
+@scenario('RETR of a 256MB file')
+def retr_large(bench):
+    size = 256 * 1024 * 1024
+    bench.cluster.make_file('/large_retr', size)
+    received = [0]
+
+    def operation(ftp, i):
+        received[0] = 0
+
+        def count(data):
+            received[0] += len(data)
+        ftp.retrbinary('RETR /large_retr', count, blocksize=65536)
+        assert received[0] == size, received[0]
+    iterations = 2 * bench.scale
+    return bench.run(operation, iterations, clients=1), iterations * size
+
+
+def report(name, latencies, elapsed, data_bytes):
+    line = '%-12s %6d ops %8.1f ops/s   p50 %8.1f ms   p99 %8.1f ms' % (
+        name, len(latencies), len(latencies) / elapsed,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000)
+    if data_bytes:
+        line += '   %7.1f MB/s' % (data_bytes / elapsed / 1e6)
+    print line
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        epilog='\n'.join('%-12s %s' % (name, description) for name,
+                         (_, description) in SCENARIOS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='any of: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.0005,
+                        help='seconds added to every REST call')
+    parser.add_argument('--bandwidth', type=float, default=1e9,
+                        help='cluster bytes/second for file data, 0 for '
+                             'unlimited')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='parallel sessions where a scenario uses them')
+    parser.add_argument('--nodes', type=int, default=4,
+                        help='cluster nodes to balance REST calls across')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='multiply every scenario\'s iterations')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='trace every command and REST call to FILE')
+    args = parser.parse_args(argv)
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %s' % name)
+    pyftpdlib.log.LEVEL = logging.WARNING
+    qftpd.TRACE_FILE = args.trace
+    bench = Bench(args.latency, args.bandwidth or None, args.clients,
+                  args.scale, args.nodes)
+    print 'REST latency %.1f ms, bandwidth %s, %d clients, %d nodes' % (
+        args.latency * 1000,
+        '%.0f MB/s' % (args.bandwidth / 1e6) if args.bandwidth else 'unlimited',
+        args.clients, args.nodes)
+    try:
+        for name in names:
+            function, description = SCENARIOS[name]
+            (latencies, elapsed), data_bytes = function(bench)
+            report(name, latencies, elapsed, data_bytes)
+    finally:
+        bench.close()
+    calls = ', '.join('%s %d' % item for item in
+                      sorted(bench.cluster.calls.items()))
+    print 'REST calls: %s' % calls
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,481 @@
+"""An in-process stand-in for a Qumulo cluster's REST API, so qftpd can be
+run and measured without a cluster. It answers the HTTP requests qftpd's
+real RestClients make, in place of the network below every call's trip
+through the REST scheduler, node balancer, failover, metrics and tracing,
+so those are run and measured too. Every call can be made to cost a fixed
+latency, and file data a transfer time at a given bandwidth, to model a
+cluster some network distance away.
+
+    cluster = FakeCluster(latency=0.001, bandwidth=500e6)
+    cluster.add_user('admin', 'a')
+    cluster.make_files('/big', 100000)
+    cluster.install()  # qftpd's REST requests now go to cluster
+"""
+import os
+import re
+import json
+import bisect
+import urllib
+import urlparse
+import posixpath
+import threading
+import time
+import itertools
+from collections import namedtuple
+
+import qftpd
+from qumulo.lib.auth import Credentials
+from qumulo.lib.request import RequestError, RestResponse
+
+
+def not_found(path):
+    return RequestError(404, 'Not Found',
+                        {'error_class': 'fs_no_such_entry_error',
+                         'description': '%s does not exist' % path})
+
+
+def timestamp(seconds=None):
+    """seconds since the epoch in the API's RFC 3339 format"""
+    seconds = time.time() if seconds is None else seconds
+    return '%s.%09dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S',
+                                       time.gmtime(seconds)),
+                         int(seconds % 1 * 1e9))
+
+
+def normalize(path):
+    return posixpath.normpath('/' + (path or '').lstrip('/'))
+
+
+def quote(component):
+    """a path component as qumulo.lib.uri puts it in a URI"""
+    return urllib.quote(unicode(component).encode('utf8'), '')
+
+
+# (method, URI path pattern, FakeCluster method answering it, needs login)
+ROUTES = []
+
+# what an API request carries besides its URI path, and the user making it
+Request = namedtuple('Request', 'query body body_file response_file uid')
+
+
+def route(method, pattern, login=True):
+    def register(function):
+        ROUTES.append((method, re.compile(pattern + '$'), function, login))
+        return function
+    return register
+
+
+class FakeNode(object):
+    """A file or directory. Directory children are kept in name order so
+    listings page like the real API's do
+    """
+    def __init__(self, cluster, path, file_type, owner, group):
+        self.path = path
+        self.file_type = file_type
+        self.file_number = next(cluster.file_numbers)
+        self.owner = owner
+        self.group = group
+        self.mode = '0755' if file_type == 'DIRECTORY' else '0644'
+        self.data = bytearray()
+        self.children = {}  # name -> FakeNode
+        self.sorted_names = None  # children's names, rebuilt on demand
+        self.created = self.modified = timestamp()
+        cluster.files_by_id[str(self.file_number)] = self
+
+    def attrs(self):
+        return {
+            'path': self.path + ('/' if self.file_type == 'DIRECTORY' and
+                                 self.path != '/' else ''),
+            'name': posixpath.basename(self.path),
+            'type': 'FS_FILE_TYPE_' + self.file_type,
+            'id': str(self.file_number),
+            'file_number': str(self.file_number),
+            'mode': self.mode,
+            'owner': self.owner,
+            'group': self.group,
+            'size': str(len(self.data)),
+            'blocks': str((len(self.data) + 4095) // 4096),
+            'num_links': 2 if self.file_type == 'DIRECTORY' else 1,
+            'child_count': len(self.children),
+            'change_time': self.modified,
+            'modification_time': self.modified,
+            'creation_time': self.created,
+        }
+
+    def names(self):
+        if self.sorted_names is None:
+            self.sorted_names = sorted(self.children)
+        return self.sorted_names
+
+
+class FakeCluster(object):
+    """The cluster's state: one namespace, its users, groups and login
+    sessions. latency is added to every call, bandwidth (bytes per second,
+    None for unlimited) limits file data going either way
+    """
+    def __init__(self, latency=0.0, bandwidth=None, name=u'fake',
+                 nodes=('127.0.0.1',)):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.name = name
+        self.nodes = list(nodes)
+        self.lock = threading.RLock()
+        self.file_numbers = itertools.count(2)
+        self.users = {}  # name -> (id, password)
+        self.groups = {u'Users': u'513'}
+        self.sessions = {}  # bearer token -> user id
+        self.calls = {}  # API function -> times called
+        self.log = []  # (API function, path or id, ...) of every call
+        self.ids_used = []  # file ids calls named files by
+        self.failures = {}  # API function -> RequestError it fails with
+        self.files_by_id = {}  # id -> FakeNode, for calls by id
+        self.replaced = None  # the rest_request() install() replaced
+        self.root = FakeNode(self, '/', 'DIRECTORY', u'500', u'513')
+        # the admin qftpd logs in as
+        self.add_user(qftpd.API_USER, qftpd.API_PASS, uid=u'500')
+
+    def add_user(self, name, password, uid=None):
+        uid = uid or unicode(1000 + len(self.users))
+        self.users[name] = (uid, password)
+        return uid
+
+    def install(self):
+        """Send every REST request qftpd makes to this cluster"""
+        self.replaced = qftpd.untracked_rest_request
+        qftpd.untracked_rest_request = self.rest_request
+
+    def uninstall(self):
+        qftpd.untracked_rest_request = self.replaced
+
+    def session(self, username):
+        """Credentials for username, as if it had logged in"""
+        token = os.urandom(16).encode('hex')
+        with self.lock:
+            self.sessions[token] = self.users[username][0]
+        return Credentials(token)
+
+    def expire_sessions(self):
+        """Log everyone out, as the cluster does when sessions time out"""
+        with self.lock:
+            self.sessions.clear()
+
+    def fail(self, name, error=None):
+        """Make every call to the API function name raise error, or stop
+        failing it with None
+        """
+        with self.lock:
+            if error is None:
+                self.failures.pop(name, None)
+            else:
+                self.failures[name] = error
+
+    def rest_request(self, conninfo, credentials, method, uri, body=None,
+                     body_file=None, response_file=None, if_match=None,
+                     request_content_type=None):
+        """qumulo.lib.request.rest_request(), answered here. Bodies go
+        through JSON both ways, as they would over the wire
+        """
+        path, _, query = str(uri).partition('?')
+        for route_method, pattern, function, login in ROUTES:
+            match = pattern.match(path)
+            if match is not None and route_method == method:
+                break
+        else:
+            raise RequestError(404, 'Not Found',
+                               {'error_class': 'http_not_found_error',
+                                'description': '%s %s' % (method, uri)})
+        uid = self.authenticate(credentials) if login else None
+        query = dict((key, value.decode('utf8'))
+                     for key, value in urlparse.parse_qsl(query))
+        if body is not None:
+            body = json.loads(json.dumps(body))
+        request = Request(query, body, body_file, response_file, uid)
+        args = [urllib.unquote(group).decode('utf8')
+                for group in match.groups()]
+        data = function(self, request, *args)
+        if data is not None:
+            data = json.loads(json.dumps(data))
+        return RestResponse(data, None)
+
+    def authenticate(self, credentials):
+        """The id of the user whose session credentials are"""
+        uid = self.sessions.get(getattr(credentials, 'bearer_token', None))
+        if uid is None:
+            raise RequestError(401, 'Unauthorized',
+                               {'error_class': 'http_unauthorized_error'})
+        return uid
+
+    def call(self, name, *details, **kwargs):
+        """Account for and wait out one API call, logged as (name,) +
+        details. Its data_bytes of file data take time at bandwidth
+        """
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.log.append((name,) + details)
+            error = self.failures.get(name)
+        delay = self.latency
+        data_bytes = kwargs.get('data_bytes', 0)
+        if self.bandwidth and data_bytes:
+            delay += float(data_bytes) / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+        if error is not None:
+            raise error
+
+    def lookup(self, path):
+        node = self.root
+        for name in normalize(path).split('/'):
+            if not name:
+                continue
+            node = node.children.get(name)
+            if node is None:
+                raise not_found(path)
+        return node
+
+    def find(self, ref):
+        """The node a request names by path or by id"""
+        if ref.startswith('/'):
+            return self.lookup(ref)
+        self.ids_used.append(ref)
+        node = self.files_by_id.get(ref)
+        if node is None:
+            raise not_found(ref)
+        return node
+
+    def path_of(self, ref):
+        """What the log calls the file ref names"""
+        if ref.startswith('/'):
+            return normalize(ref)
+        node = self.files_by_id.get(ref)
+        return ref if node is None else node.path
+
+    def create(self, path, file_type, owner=u'500'):
+        path = normalize(path)
+        dirname, name = posixpath.split(path)
+        with self.lock:
+            parent = self.lookup(dirname)
+            if parent.file_type != 'DIRECTORY':
+                raise RequestError(
+                    400, 'Bad Request',
+                    {'error_class': 'fs_not_a_directory_error'})
+            if name in parent.children:
+                raise RequestError(
+                    409, 'Conflict', {'error_class': 'fs_entry_exists_error',
+                                      'description': '%s exists' % path})
+            node = FakeNode(self, path, file_type, owner, u'513')
+            parent.children[name] = node
+            parent.sorted_names = None
+            parent.modified = timestamp()
+        return node
+
+    def remove(self, path):
+        with self.lock:
+            dirname, name = posixpath.split(normalize(path))
+            parent = self.lookup(dirname)
+            if name not in parent.children:
+                raise not_found(path)
+            if parent.children[name].children:
+                raise RequestError(
+                    409, 'Conflict',
+                    {'error_class': 'fs_directory_not_empty_error'})
+            node = parent.children.pop(name)
+            parent.sorted_names = None
+            del self.files_by_id[str(node.file_number)]
+
+    def move(self, source, path, clobber=False):
+        """Move the file or directory at source to path"""
+        dirname, name = posixpath.split(normalize(path))
+        with self.lock:
+            node = self.lookup(source)
+            target = self.lookup(dirname)
+            if name in target.children:
+                if not clobber:
+                    raise RequestError(
+                        409, 'Conflict',
+                        {'error_class': 'fs_entry_exists_error'})
+                self.remove(path)
+            parent = self.lookup(posixpath.dirname(node.path))
+            del parent.children[posixpath.basename(node.path)]
+            parent.sorted_names = None
+            target.children[name] = node
+            target.sorted_names = None
+            self.repath(node, posixpath.join(target.path, name))
+        return node
+
+    def repath(self, node, path):
+        node.path = path
+        for name, child in node.children.items():
+            self.repath(child, posixpath.join(path, name))
+
+    def make_files(self, directory, count, size=0):
+        """Populate directory (created if need be) with count files named
+        f000000... of size zero bytes each, without any API latency
+        """
+        try:
+            self.lookup(directory)
+        except RequestError:
+            self.create(directory, 'DIRECTORY')
+        data = bytearray(size)
+        for i in xrange(count):
+            node = self.create(posixpath.join(directory, 'f%06d' % i),
+                               'FILE')
+            node.data = bytearray(data)
+
+    def make_file(self, path, size=0, data=None):
+        node = self.create(path, 'FILE')
+        node.data = bytearray(size) if data is None else bytearray(data)
+        return node
+
+    def contents(self, path):
+        return bytes(self.lookup(path).data)
+
+    @route('GET', r'/v1/files/([^/]+)/info/attributes')
+    def get_file_attr(self, request, ref):
+        self.call('get_file_attr', self.path_of(ref))
+        return self.find(ref).attrs()
+
+    @route('GET', r'/v1/files/([^/]+)/entries/')
+    def read_directory(self, request, ref):
+        """One page of the directory's entries, and where the next one
+        starts
+        """
+        self.call('read_directory', self.path_of(ref))
+        page_size = int(request.query.get('limit', 1000))
+        after = request.query.get('after')
+        with self.lock:
+            node = self.find(ref)
+            names = node.names()
+            start = 0 if after is None else bisect.bisect_right(names, after)
+            page = names[start:start + page_size]
+            files = [node.children[name].attrs() for name in page]
+            attrs = node.attrs()
+        next_uri = ''
+        if page and start + len(page) < len(names):
+            next_uri = '/v1/files/%s/entries/?limit=%d&after=%s' % (
+                quote(ref), page_size, quote(page[-1]))
+        return {'path': attrs['path'], 'id': attrs['id'], 'files': files,
+                'paging': {'next': next_uri, 'prev': ''}}
+
+    @route('GET', r'/v1/files/([^/]+)/data')
+    def read_file(self, request, ref):
+        offset = request.query.get('offset')
+        length = request.query.get('length')
+        offset = None if offset is None else int(offset)
+        length = None if length is None else int(length)
+        node = self.find(ref)
+        start = offset or 0
+        end = len(node.data) if length is None else start + length
+        data = bytes(node.data[start:end])
+        self.call('read_file', node.path, offset, length,
+                  data_bytes=len(data))
+        request.response_file.write(data)
+
+    @route('PUT', r'/v1/files/([^/]+)/data')
+    @route('PATCH', r'/v1/files/([^/]+)/data')
+    def write_file(self, request, ref):
+        offset = request.query.get('offset')
+        offset = None if offset is None else int(offset)
+        data = request.body_file.read()
+        self.call('write_file', self.path_of(ref), offset, len(data),
+                  data_bytes=len(data))
+        with self.lock:
+            node = self.find(ref)
+            if offset is None:
+                node.data = bytearray(data)
+            else:
+                if len(node.data) < offset:
+                    node.data.extend(bytearray(offset - len(node.data)))
+                node.data[offset:offset + len(data)] = data
+            node.modified = timestamp()
+        return node.attrs()
+
+    @route('POST', r'/v1/files/([^/]+)/entries/')
+    def create_entry(self, request, ref):
+        """create_file(), create_directory() and rename()"""
+        action = request.body['action']
+        if action == 'RENAME':
+            return self.rename(request, ref)
+        file_type = action[len('CREATE_'):]
+        name = request.body['name']
+        self.call('create_' + file_type.lower(),
+                  posixpath.join(self.path_of(ref), name))
+        return self.create(posixpath.join(self.find(ref).path, name),
+                           file_type, request.uid).attrs()
+
+    def rename(self, request, ref):
+        name = request.body['name']
+        source = normalize(request.body['old_path'])
+        self.call('rename', source,
+                  posixpath.join(self.path_of(ref), name))
+        with self.lock:
+            path = posixpath.join(self.find(ref).path, name)
+            return self.move(source, path,
+                             request.body.get('clobber')).attrs()
+
+    @route('DELETE', r'/v1/files/([^/]+)')
+    def delete(self, request, ref):
+        self.call('delete', self.path_of(ref))
+        with self.lock:
+            self.remove(self.find(ref).path)
+
+    @route('POST', r'/v1/files/([^/]+)/copy-chunk')
+    def copy(self, request, ref):
+        """The whole copy in one chunk, the data staying on the cluster"""
+        source = request.body.get('source_path',
+                                  request.body.get('source_id'))
+        self.call('copy', self.path_of(source), self.path_of(ref))
+        with self.lock:
+            data = self.find(source).data
+            self.find(ref).data = bytearray(data)
+        return None  # nothing left to copy
+
+    def identities(self, kind):
+        if kind == 'users':
+            return dict((uid, name) for name, (uid, _)
+                        in self.users.items())
+        return dict((gid, name) for name, gid in self.groups.items())
+
+    @route('GET', r'/v1/(users|groups)/')
+    def list_identities(self, request, kind):
+        """list_users() and list_groups()"""
+        self.call('list_' + kind)
+        return [{'id': i, 'name': name}
+                for i, name in self.identities(kind).items()]
+
+    @route('GET', r'/v1/(users|groups)/(\d+)')
+    def list_identity(self, request, kind, auth_id):
+        """list_user() and list_group()"""
+        self.call('list_' + kind[:-1], auth_id)
+        name = self.identities(kind).get(unicode(auth_id))
+        if name is None:
+            raise not_found(auth_id)
+        return {'id': unicode(auth_id), 'name': name}
+
+    @route('GET', r'/v1/cluster/settings')
+    def get_cluster_conf(self, request):
+        self.call('get_cluster_conf')
+        return {u'cluster_name': self.name}
+
+    @route('GET', r'/v1/version')
+    def version(self, request):
+        self.call('version')
+        return {'revision_id': 'Qumulo Core (fake_qumulo)'}
+
+    @route('GET', r'/v1/network/status/')
+    def list_network_status(self, request):
+        self.call('list_network_status')
+        return [{'network_details': {'address': node}}
+                for node in self.nodes]
+
+    @route('POST', r'/v1/session/login', login=False)
+    def login(self, request):
+        username = request.body['username']
+        self.call('login', username)
+        user = self.users.get(username)
+        if user is None or user[1] != request.body['password']:
+            raise RequestError(401, 'Unauthorized',
+                               {'error_class': 'authentication_error'})
+        token = os.urandom(16).encode('hex')
+        with self.lock:
+            self.sessions[token] = user[0]
+        return {'bearer_token': token}
@@ -6,12 +6,39 @@ if ssl.OPENSSL_VERSION.split(" ")[1] == '0.9.8zh':
     ssl._create_default_https_context = ssl._create_unverified_context
 
 import os
+import io
+import json
+import bisect
+import fcntl
+import mmap
+import struct
+import zlib
+import heapq
+import sys
+import itertools
 import logging
+import multiprocessing
+import posixpath
+import shlex
+import signal
+import Queue
+import httplib
+import socket
+import threading
+import time
+import calendar
+import hashlib
+import hmac
 import datetime
+import functools
 import dateutil.parser
 import pytz
 import stat
-from tempfile import SpooledTemporaryFile
+import types
+import weakref
+import BaseHTTPServer
+from collections import OrderedDict, deque
+from tempfile import SpooledTemporaryFile, TemporaryFile
 
 # 3rd party imports
 import pyftpdlib
@@ -19,11 +46,19 @@ import pyftpdlib
 from pyftpdlib.authorizers import DummyAuthorizer
 from pyftpdlib.authorizers import AuthenticationFailed
 from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.handlers import DTPHandler
+from pyftpdlib.handlers import BufferedIteratorProducer
+from pyftpdlib.handlers import _strerror
 from pyftpdlib.servers import FTPServer
+from pyftpdlib.servers import ThreadedFTPServer
+from pyftpdlib.servers import MultiprocessFTPServer
+from pyftpdlib.ioloop import IOLoop
 from pyftpdlib.filesystems import AbstractedFS
 from pyftpdlib.filesystems import FilesystemError
+from pyftpdlib.filesystems import _filemode, _months_map
 from pyftpdlib.log import logger
 
+import qumulo.lib.request
 from qumulo.rest_client import RestClient
 from qumulo.lib.request import RequestError
 
@@ -35,6 +70,10 @@ API_HOST = '<cluster-name>'
 API_PORT = '8000'
 API_USER = '<qumulo-api-user>'
 API_PASS = '<qumulo-api-password>'
+# every node's address, to spread API load across the cluster. Empty means
+# just API_HOST, plus whatever NODE_DISCOVERY finds
+API_HOSTS = []
+NODE_DISCOVERY = True
 
 # For dealing with timestamps
 LOCAL_TZ = 'America/Los_Angeles'
@@ -43,57 +82,2225 @@ UTC = pytz.timezone('UTC')
 AbstractedQSFS() using this object
 """
 EPOCH = UTC.localize(datetime.datetime(1970, 1, 1))
+TIME_FIELDS = ('change_time', 'modification_time', 'creation_time')
 
 # Other nerd knobs
 WRITE_BUFFER_SIZE = 1000000
+PARALLEL_UPLOAD_THRESHOLD = 16000000  # bytes into an upload before going wide
+UPLOAD_CONCURRENCY = 4  # ranges in flight per session, 1 disables
+READ_CHUNK_SIZE = 4194304
+READ_AHEAD_MIN = 1  # ranges a RETR keeps in flight ahead of the client
+READ_AHEAD_MAX = 8  # grows up to this while the client waits, 0 disables
+# bytes of file data every transfer in the process may hold in memory at
+# once (prefork workers get an equal share), None for no limit. Transfers
+# that can't get more pause their data channel until some is released
+TRANSFER_BUFFER_BUDGET = 512 * 1024 * 1024
+BUFFER_WAIT_INTERVAL = 0.05  # seconds a paused data channel waits to retry
+ATTR_CACHE_TTL = 5  # seconds, 0 disables the get_file_attr() cache
+ATTR_CACHE_NEGATIVE_TTL = 2  # seconds to remember paths that don't exist
+ATTR_CACHE_SIZE = 10000
+# seconds to address a path seen in a listing or stat by its file id, which
+# spares the cluster walking the path again. 0 disables
+ID_CACHE_TTL = 60
+ID_CACHE_SIZE = 100000
+LISTDIR_PAGE_SIZE = 1000
+TREE_WALK_CONCURRENCY = 8  # read_directory calls in flight per LIST -R
+TREE_WALK_MAX_DEPTH = None  # levels below the top, None for no limit
+TREE_WALK_MAX_ENTRIES = 1000000  # entries listed before a walk stops
+# entries a walk reads ahead of the client at most, each counted as
+# TREE_ENTRY_SIZE bytes of TRANSFER_BUFFER_BUDGET while it's held
+TREE_WALK_MAX_BUFFERED = 10000
+TREE_ENTRY_SIZE = 512
+IDENTITY_CACHE_TTL = 300  # seconds to trust a uid/gid -> name lookup
+IDENTITY_CACHE_NEGATIVE_TTL = 60  # seconds to remember failed lookups
+IDENTITY_CACHE_SIZE = 10000
+# prefork and multiprocess workers keep the attribute and uid/gid -> name
+# caches in memory they all share, so what one worker looks up or
+# invalidates counts for every other. False gives each its own
+SHARED_CACHES = True
+SHARED_CACHE_WAYS = 8  # slots a key may be stored in
+SESSION_CACHE_TTL = 300
+SESSION_CACHE_SIZE = 1000
+ADMIN_POOL_SIZE = 4
+CLUSTER_CACHE_REFRESH = 60  # seconds between background banner/user reloads
+CLUSTER_CACHE_MISS_REFRESH = 5  # min seconds between reloads for unknown users
+WORKER_THREADS = 16  # threads making REST calls for the IOLoop, 0 disables
+LISTEN_ADDRESS = ('127.0.0.1', 21)
+NODE_LATENCY_WEIGHT = 0.2  # EWMA weight of each new request's latency
+NODE_EJECT_FAILURES = 3  # consecutive failures before a node is ejected
+NODE_EJECT_TIME = 30  # seconds an ejected node gets no new clients
+REST_TIMEOUT = 60  # seconds a REST call waits on a node that went quiet
+# REST calls made for FTP sessions in flight at once, None disables the
+# scheduler. Prefork workers get an equal share
+REST_CONCURRENCY = 64
+REST_USER_CONCURRENCY = 16  # in flight for any one user
+REST_BULK_SHARE = 0.75  # of REST_CONCURRENCY that file data calls may use
+REST_QUEUE_LIMIT = 1000  # calls waiting before new commands get a 421
+USER_WEIGHTS = {}  # username -> share of the API relative to others, 1
+BULK_CALLS = frozenset(['read_file', 'write_file'])
+# 'async': one process, one IOLoop, blocking calls made by WORKER_THREADS
+# 'threaded' / 'multiprocess': a thread / process per session
+# 'prefork': PREFORK_PROCESSES async servers sharing the port via SO_REUSEPORT
+SERVER_MODE = 'async'
+PREFORK_PROCESSES = 0  # 0 means one per CPU
+# a prefork worker that exits within PREFORK_STARTUP_TIME seconds failed to
+# start. It is replaced after PREFORK_RESTART_DELAY seconds, doubling with
+# each failure in a row, and given up on after PREFORK_MAX_FAILURES of them
+PREFORK_STARTUP_TIME = 5
+PREFORK_RESTART_DELAY = 1
+PREFORK_MAX_FAILURES = 5
+# ('127.0.0.1', 9121) serves Prometheus metrics at /metrics, None disables.
+# prefork workers each listen on the port plus their worker number
+METRICS_ADDRESS = None
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)  # seconds
+# appends every command and the REST calls behind it to this file as Chrome
+# trace events (chrome://tracing, Perfetto, speedscope), None disables
+TRACE_FILE = None
+SLOW_COMMAND_SECONDS = None  # log commands slower than this, None disables
+SLOW_COMMAND_CALLS = 10  # slowest REST calls shown for each slow command
+# kill -USR1 <pid> starts sampling every thread's stack, a second one writes
+# the samples to PROFILE_DIR as folded stacks for flamegraph.pl/speedscope
+PROFILE_SIGNAL = signal.SIGUSR1
+PROFILE_INTERVAL = 0.005  # seconds between samples
+PROFILE_MAX_SECONDS = 300  # a profile nobody stops is written after this
+PROFILE_DIR = '/tmp'
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Counters, gauges and histograms kept in memory and rendered in the
+    Prometheus text format. An update is a dict lookup and an add under
+    one lock, cheap enough for every command and REST call. Collectors are
+    called at scrape time for values that are already counted elsewhere
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.types = OrderedDict()  # name -> (type, help)
+        self.values = {}  # (name, labels) -> number or Histogram
+        self.collectors = []
+
+    def describe(self, name, metric_type, help_text):
+        self.types[name] = (metric_type, help_text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def add_collector(self, collector):
+        """collector() returns (name, labels, value) samples"""
+        self.collectors.append(collector)
+
+    def samples(self):
+        with self.lock:
+            samples = [(name, labels, value if not isinstance(value, Histogram)
+                        else (list(value.counts), value.sum))
+                       for (name, labels), value in self.values.items()]
+        for collector in self.collectors:
+            samples.extend(collector())
+        return samples
+
+    def render(self):
+        by_name = {}
+        for name, labels, value in self.samples():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (metric_type, help_text) in self.types.items():
+            if name not in by_name:
+                continue
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in sorted(by_name[name]):
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(labels),
+                                              format_value(value)))
+                    continue
+                counts, total = value
+                cumulative = 0
+                les = [format_value(b) for b in self.buckets] + ['+Inf']
+                for le, count in zip(les, counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(labels + (('le', le),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              format_value(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+metrics = Metrics(LATENCY_BUCKETS)
+metrics.describe('qftpd_command_seconds', 'histogram',
+                 'Time from an FTP command arriving to its reply')
+metrics.describe('qftpd_rest_request_seconds', 'histogram',
+                 'Latency of REST calls by API function')
+metrics.describe('qftpd_rest_request_errors_total', 'counter',
+                 'REST calls that failed, by API function and HTTP status')
+metrics.describe('qftpd_rest_failovers_total', 'counter',
+                 'Clients moved off a node they could not reach, by call')
+metrics.describe('qftpd_rest_queue_seconds', 'histogram',
+                 'Time session REST calls waited for the scheduler, by class')
+metrics.describe('qftpd_rest_in_flight', 'gauge',
+                 'Scheduled REST calls in flight, by class')
+metrics.describe('qftpd_rest_queued', 'gauge',
+                 'REST calls waiting for the scheduler, by class')
+metrics.describe('qftpd_commands_shed_total', 'counter',
+                 'Commands refused with 421 because the REST queue was full')
+metrics.describe('qftpd_transfer_bytes_total', 'counter',
+                 'File data moved over FTP data channels')
+metrics.describe('qftpd_upload_chunks_total', 'counter',
+                 'Upload chunks handed to QSFS, by how they were written')
+metrics.describe('qftpd_read_ahead_stalls_total', 'counter',
+                 'Downloads left waiting on a range that was still in flight')
+metrics.describe('qftpd_buffer_bytes_in_use', 'gauge',
+                 'File data held in memory by transfers')
+metrics.describe('qftpd_buffer_bytes_peak', 'gauge',
+                 'Most file data held in memory by transfers at once')
+metrics.describe('qftpd_buffer_bytes_limit', 'gauge',
+                 'File data transfers may hold in memory at once')
+metrics.describe('qftpd_buffer_waits_total', 'counter',
+                 'Times a data channel was paused for want of buffer space')
+metrics.describe('qftpd_sessions_active', 'gauge', 'Connected FTP sessions')
+metrics.describe('qftpd_logins_total', 'counter', 'FTP logins by result')
+metrics.describe('qftpd_cache_hits_total', 'counter', 'Cache hits by cache')
+metrics.describe('qftpd_cache_misses_total', 'counter',
+                 'Cache misses by cache')
+metrics.describe('qftpd_cache_hit_ratio', 'gauge',
+                 'Fraction of lookups answered by each cache')
+metrics.describe('qftpd_cache_entries', 'gauge', 'Entries in each cache')
+metrics.describe('qftpd_node_requests_in_flight', 'gauge',
+                 'REST calls in flight by cluster node')
+metrics.describe('qftpd_node_latency_seconds', 'gauge',
+                 'Recent REST latency by cluster node')
+metrics.describe('qftpd_node_ejected', 'gauge',
+                 '1 while a cluster node is ejected for failing')
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format % args)
+
+
+def start_metrics_server(port_offset=0):
+    """Serve metrics from a daemon thread if METRICS_ADDRESS is set"""
+    if METRICS_ADDRESS is None:
+        return None
+    host, port = METRICS_ADDRESS
+    server = BaseHTTPServer.HTTPServer((host, port + port_offset),
+                                       MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='qftpd-metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("serving metrics on http://%s:%s/metrics" %
+                server.server_address)
+    return server
+
+
+# rest_request()'s positional arguments after the uri
+REQUEST_ARGS = ('body', 'body_file', 'if_match', 'request_content_type',
+                'response_file')
+
+
+class RestCall(object):
+    """One traced REST call. Payload sizes are measured from the JSON body
+    or the file the data is read from or written to
+    """
+    def __init__(self, name, method, uri, args, kwargs):
+        self.name = name
+        self.method = method
+        self.uri = uri
+        self.thread = threading.current_thread()
+        self.command = None
+        self.lane = None
+        self.status = None
+        self.elapsed = None
+        request = dict(zip(REQUEST_ARGS, args))
+        request.update(kwargs)
+        self.body = request.get('body')
+        self.body_file = request.get('body_file')
+        self.response_file = request.get('response_file')
+        self.sent_from = self.tell(self.body_file)
+        self.received_from = self.tell(self.response_file)
+        self.sent = self.received = 0
+        self.start = time.time()
+
+    @staticmethod
+    def tell(f):
+        try:
+            return f.tell()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def finish(self, response, status):
+        self.elapsed = time.time() - self.start
+        self.status = status
+        if self.body is not None:
+            self.sent = len(json.dumps(self.body))
+        elif self.sent_from is not None:
+            self.sent = (self.tell(self.body_file) or 0) - self.sent_from
+        if self.received_from is not None:
+            self.received = ((self.tell(self.response_file) or 0) -
+                             self.received_from)
+        elif response is not None and response.data is not None:
+            self.received = len(json.dumps(response.data))
+        # the objects themselves aren't kept around with the trace
+        self.body = self.body_file = self.response_file = None
+
+    def describe(self, since):
+        return "+%.3fs %s %.3fs %s %s %s sent %d received %d (%s)" % (
+            self.start - since, self.name, self.elapsed, self.method,
+            self.uri, self.status, self.sent, self.received,
+            self.thread.name)
+
+
+class CommandTrace(object):
+    """An FTP command and the REST calls made for it"""
+    def __init__(self, command, arg):
+        self.command = command
+        self.arg = arg
+        self.start = time.time()
+        self.end = None
+        self.calls = []
+
+    def describe(self, session):
+        """A few lines for the log: the command, its calls totalled by API
+        function, and the slowest of them
+        """
+        lines = ["slow command: session %d %s %s took %.3fs in %d REST calls" %
+                 (session.id, self.command, self.arg, self.end - self.start,
+                  len(self.calls))]
+        totals = {}
+        for call in self.calls:
+            count, seconds, sent, received = totals.get(call.name,
+                                                        (0, 0.0, 0, 0))
+            totals[call.name] = (count + 1, seconds + call.elapsed,
+                                 sent + call.sent, received + call.received)
+        for name, (count, seconds, sent, received) in sorted(
+                totals.items(), key=lambda item: -item[1][1]):
+            lines.append("  %s: %d calls %.3fs sent %d received %d" %
+                         (name, count, seconds, sent, received))
+        slowest = sorted(self.calls, key=lambda call: -call.elapsed)
+        for call in slowest[:SLOW_COMMAND_CALLS]:
+            lines.append("    " + call.describe(self.start))
+        return '\n'.join(lines)
+
+
+class SessionTrace(object):
+    """Collects an FTP session's REST calls, whichever thread makes them,
+    into the command being run. A call nests under its command in the trace
+    unless another call of the session is already in flight, then it gets
+    its calling thread's lane, so concurrent calls don't overlap there.
+    A command that starts a transfer lasts until the transfer is done.
+    Calls made after their command ends are written out on their own
+    """
+    ids = itertools.count(1)
+
+    def __init__(self, label):
+        self.id = next(self.ids)
+        self.label = label
+        self.lock = threading.Lock()
+        self.command = None
+        self.transfer = None  # a command whose data transfer is running
+        self.last = None  # the command calls made between commands are for
+        self.in_flight = 0
+        self.named = False  # has the trace file been told our label yet
+
+    def begin(self, command, arg):
+        with self.lock:
+            self.command = CommandTrace(command, arg)
+
+    def end(self, transferring=False):
+        with self.lock:
+            command, self.command = self.command, None
+            if command is None:
+                return
+            if transferring:
+                self.transfer = command
+                return
+        self.finish(command)
+
+    def end_transfer(self):
+        with self.lock:
+            command, self.transfer = self.transfer, None
+        if command is not None:
+            self.finish(command)
+
+    def finish(self, command):
+        with self.lock:
+            command.end = time.time()
+            self.last = command
+        tracer.finish(self, command)
+
+    def begin_call(self, call):
+        with self.lock:
+            running = self.command or self.transfer
+            call.command = running or self.last
+            if running is not None and not self.in_flight:
+                call.lane = self.id
+            else:
+                call.lane = call.thread.ident
+            self.in_flight += 1
+
+    def end_call(self, call):
+        with self.lock:
+            self.in_flight -= 1
+            command = call.command
+            if command is not None and command.end is None:
+                command.calls.append(call)
+                return
+        call.lane = call.thread.ident
+        tracer.write_events(self, command, [call])
+
+
+class Tracer(object):
+    """Sends finished commands to the slow command log and the trace file.
+    The session being served by a thread is kept thread-local, which is
+    how calls made through clients that aren't the session's own, like the
+    login itself, find their way to it
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.fd = None
+        self.named = set()  # thread lanes already named in the trace file
+
+    def enabled(self):
+        return TRACE_FILE is not None or SLOW_COMMAND_SECONDS is not None
+
+    def active(self):
+        return getattr(self.local, 'trace', None)
+
+    def run(self, trace, function, *args, **kwargs):
+        """Call function(*args, **kwargs) on behalf of trace's session"""
+        previous = self.active()
+        self.local.trace = trace
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.local.trace = previous
+
+    def finish(self, session, command):
+        elapsed = command.end - command.start
+        if (SLOW_COMMAND_SECONDS is not None and
+                elapsed >= SLOW_COMMAND_SECONDS):
+            logger.warn(command.describe(session))
+        self.write_events(session, command, command.calls, True)
+
+    def write_events(self, session, command, calls, with_command=False):
+        if TRACE_FILE is None:
+            return
+        pid = os.getpid()
+        events = []
+        if not session.named:
+            session.named = True
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': session.id, 'args': {'name': session.label}})
+        if with_command:
+            events.append({
+                'name': command.command, 'cat': 'command', 'ph': 'X',
+                'pid': pid, 'tid': session.id, 'ts': command.start * 1e6,
+                'dur': (command.end - command.start) * 1e6,
+                'args': {'arg': command.arg, 'calls': len(command.calls)}})
+        for call in calls:
+            if call.lane != session.id and call.lane not in self.named:
+                self.named.add(call.lane)
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': call.lane,
+                               'args': {'name': call.thread.name}})
+            events.append({
+                'name': call.name, 'cat': 'rest', 'ph': 'X', 'pid': pid,
+                'tid': call.lane, 'ts': call.start * 1e6,
+                'dur': call.elapsed * 1e6,
+                'args': {'method': call.method, 'uri': call.uri,
+                         'status': call.status, 'sent': call.sent,
+                         'received': call.received, 'session': session.id,
+                         'command': command and command.command}})
+        self.write(''.join(json.dumps(event) + ',\n' for event in events))
+
+    def write(self, data):
+        """Append to the trace file in one write(), so processes sharing
+        it don't interleave their events. The closing ] of the JSON array
+        is optional for trace viewers and is never written
+        """
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(TRACE_FILE,
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                  0644)
+                if not os.fstat(self.fd).st_size:
+                    os.write(self.fd, '[\n')
+            os.write(self.fd, data)
+
+
+tracer = Tracer()
+
+
+class StackSampler(object):
+    """A sampling profiler for a live server. While running it records
+    every thread's stack each interval and when stopped writes them out as
+    folded stacks, a 'thread;frame;frame count' line per distinct stack.
+    Unlike cProfile it sees the worker threads as well as the IOLoop, and
+    costs nothing until started
+    """
+    def __init__(self, interval, max_seconds, directory):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.directory = directory
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def toggle(self, *_):
+        """Start or stop sampling, usable as a signal handler"""
+        if self.thread is not None and self.thread.is_alive():
+            self.stopping.set()
+            return
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='qftpd-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        logger.info("profiler: sampling every %ss" % self.interval)
+        counts = {}
+        deadline = time.time() + self.max_seconds
+        own = threading.current_thread().ident
+        while not self.stopping.is_set() and time.time() < deadline:
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self.fold(names.get(ident, str(ident)), frame)
+                counts[stack] = counts.get(stack, 0) + 1
+            self.stopping.wait(self.interval)
+        path = os.path.join(self.directory, 'qftpd-%d-%d.folded' %
+                            (os.getpid(), time.time()))
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write('%s %d\n' % (stack, count))
+        logger.info("profiler: wrote %d samples to %s" %
+                    (sum(counts.values()), path))
+
+    @staticmethod
+    def fold(thread_name, frame):
+        # workers share a lane: qftpd-worker-3 and qftpd-read /x are one
+        frames = [thread_name.split(' ')[0].rstrip('0123456789-')]
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        frames.extend(reversed(stack))
+        return ';'.join(name.replace(';', ':') for name in frames)
+
+
+profiler = StackSampler(PROFILE_INTERVAL, PROFILE_MAX_SECONDS, PROFILE_DIR)
+
+
+def install_profiler():
+    if PROFILE_SIGNAL is not None:
+        signal.signal(PROFILE_SIGNAL, profiler.toggle)
+
+
+class NodeStats(object):
+    def __init__(self, host):
+        self.host = host
+        self.in_flight = 0
+        self.latency = 0.0  # EWMA of request latency, seconds
+        self.failures = 0  # consecutive
+        self.ejected_until = 0
+
+    def score(self):
+        return (self.in_flight + 1) * max(self.latency, 0.001)
+
+
+class NodeBalancer(object):
+    """Chooses the cluster node each new RestClient talks to, or a client
+    that lost its node moves to: the healthy node with the fewest requests
+    in flight, weighted by its recent latency, taking nodes in turn when
+    that's a tie. Nodes whose requests keep failing are ejected for
+    NODE_EJECT_TIME seconds
+    """
+    def __init__(self, hosts=()):
+        self.lock = threading.Lock()
+        self.nodes = OrderedDict()
+        self.turn = 0
+        self.set_hosts(hosts)
+
+    def set_hosts(self, hosts):
+        """Replace the node list, keeping what we know about nodes that are
+        still in it
+        """
+        with self.lock:
+            self.nodes = OrderedDict(
+                (host, self.nodes.get(host) or NodeStats(host))
+                for host in hosts)
+
+    def pick(self, avoid=None):
+        """A node for a client, other than avoid unless it's the only one"""
+        with self.lock:
+            if not self.nodes:
+                return API_HOST
+            now = time.time()
+            nodes = self.nodes.values()
+            healthy = [node for node in nodes if node.ejected_until <= now]
+            # everything ejected: keep trying rather than refuse service
+            nodes = healthy or nodes
+            nodes = [node for node in nodes if node.host != avoid] or nodes
+            self.turn = (self.turn + 1) % len(nodes)
+            nodes = nodes[self.turn:] + nodes[:self.turn]
+            return min(nodes, key=NodeStats.score).host
+
+    def begin(self, host):
+        with self.lock:
+            node = self.nodes.get(host)
+            if node is not None:
+                node.in_flight += 1
+
+    def end(self, host, elapsed, failed):
+        with self.lock:
+            node = self.nodes.get(host)
+            if node is None:
+                return
+            node.in_flight -= 1
+            if not failed:
+                node.failures = 0
+                node.latency += NODE_LATENCY_WEIGHT * (elapsed - node.latency)
+                return
+            node.failures += 1
+            if node.failures >= NODE_EJECT_FAILURES:
+                logger.warn("ejecting node %s for %s seconds after %d failed "
+                            "requests" % (host, NODE_EJECT_TIME,
+                                          node.failures))
+                node.ejected_until = time.time() + NODE_EJECT_TIME
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return dict((node.host, {'in_flight': node.in_flight,
+                                     'latency': node.latency,
+                                     'ejected': node.ejected_until > now})
+                        for node in self.nodes.values())
+
+
+class FairShare(object):
+    """A session's place in the REST scheduler's queues"""
+    def __init__(self, user, weight=1):
+        self.user = user
+        self.weight = float(weight)
+        self.finish = {False: 0.0, True: 0.0}  # virtual time, by bulk
+
+
+class Waiter(object):
+    def __init__(self, share, bulk, tag, order):
+        self.share = share
+        self.bulk = bulk
+        self.tag = tag
+        self.order = order
+        self.start = time.time()
+        self.ready = threading.Event()
+
+    def __lt__(self, other):
+        return (self.tag, self.order) < (other.tag, other.order)
+
+
+class RestScheduler(object):
+    """Admission control for the REST calls sessions make. At most limit
+    calls are in flight, user_limit of them for any one user and bulk_limit
+    of them moving file data, which leaves room for metadata calls however
+    many transfers are running. Waiting metadata calls go before waiting
+    bulk ones, and within each, sessions take turns in proportion to their
+    weights (start-time fair queuing), so one session with a thousand
+    queued reads can't push another's single call to the back
+    """
+    def __init__(self, limit, user_limit, bulk_share):
+        self.user_limit = user_limit
+        self.bulk_share = bulk_share
+        self.resize(limit)
+        self.order = itertools.count()
+        self.reset()
+
+    def resize(self, limit):
+        self.limit = limit
+        self.bulk_limit = max(int(limit * self.bulk_share), 1)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.in_flight = {False: 0, True: 0}
+        self.user_in_flight = {}
+        self.queues = {False: [], True: []}  # heaps of Waiters
+        self.vtime = 0.0
+
+    def queued(self):
+        return len(self.queues[False]) + len(self.queues[True])
+
+    def overloaded(self):
+        return self.queued() >= REST_QUEUE_LIMIT
+
+    def allowed(self, user, bulk):
+        if sum(self.in_flight.values()) >= self.limit:
+            return False
+        if bulk and self.in_flight[True] >= self.bulk_limit:
+            return False
+        return self.user_in_flight.get(user, 0) < self.user_limit
+
+    def start(self, share, bulk):
+        self.in_flight[bulk] += 1
+        self.user_in_flight[share.user] = (
+            self.user_in_flight.get(share.user, 0) + 1)
+
+    def acquire(self, share, bulk, wait=True):
+        """Return once a call may go out. With wait False it goes out now
+        regardless, for the IOLoop thread, which mustn't block
+        """
+        with self.lock:
+            tag = max(self.vtime, share.finish[bulk])
+            share.finish[bulk] = tag + 1 / share.weight
+            if not wait or (not self.queues[bulk] and
+                            not (bulk and self.queues[False]) and
+                            self.allowed(share.user, bulk)):
+                self.start(share, bulk)
+                return 0.0
+            waiter = Waiter(share, bulk, tag, next(self.order))
+            heapq.heappush(self.queues[bulk], waiter)
+        waiter.ready.wait()
+        return time.time() - waiter.start
+
+    def release(self, share, bulk):
+        with self.lock:
+            self.in_flight[bulk] -= 1
+            count = self.user_in_flight[share.user] - 1
+            if count:
+                self.user_in_flight[share.user] = count
+            else:
+                del self.user_in_flight[share.user]
+            self.dispatch()
+
+    def dispatch(self):
+        """Start waiting calls while there's room, metadata first"""
+        for bulk in (False, True):
+            queue = self.queues[bulk]
+            skipped = []
+            while queue and self.allowed(None, bulk):
+                waiter = heapq.heappop(queue)
+                if not self.allowed(waiter.share.user, bulk):
+                    skipped.append(waiter)  # that user is at their limit
+                    continue
+                self.vtime = max(self.vtime, waiter.tag)
+                self.start(waiter.share, bulk)
+                waiter.ready.set()
+            for waiter in skipped:
+                heapq.heappush(queue, waiter)
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight': dict(self.in_flight),
+                    'queued': dict((bulk, len(queue)) for bulk, queue
+                                   in self.queues.items())}
+
+
+node_balancer = NodeBalancer()
+rest_scheduler = RestScheduler(REST_CONCURRENCY or 1, REST_USER_CONCURRENCY,
+                               REST_BULK_SHARE)
+untracked_rest_request = qumulo.lib.request.rest_request
+scheduled = threading.local()  # .calls: scheduled calls this thread is in
+
+
+def tracked_rest_request(conninfo, credentials, method, uri, *args, **kwargs):
+    """Every REST call made by any RestClient goes through here, which is
+    how rest_scheduler gets to hold session calls back, how node_balancer
+    sees each node's load, latency and failures and moves clients off nodes
+    that went away, and how the metrics account for every call
+    """
+    # named after the qumulo.rest function making the call, e.g. get_file_attr
+    caller = sys._getframe(1)
+    if caller.f_code.co_name.startswith('<'):  # a lambda in that function
+        caller = caller.f_back
+    name = caller.f_code.co_name
+    # only a session's own clients are scheduled, admin calls and logins go
+    # straight out. So do calls made in the middle of a scheduled one, like
+    # the library probing a node on first contact: they would wait for a
+    # slot the call they're part of is holding
+    share = getattr(conninfo, 'share', None)
+    if share is None or getattr(scheduled, 'calls', 0):
+        return failover_rest_request(name, conninfo, credentials, method, uri,
+                                     args, kwargs)
+    bulk = name in BULK_CALLS
+    queued = rest_scheduler.acquire(share, bulk, wait=not on_ioloop())
+    metrics.observe('qftpd_rest_queue_seconds',
+                    (('class', 'bulk' if bulk else 'metadata'),), queued)
+    scheduled.calls = 1
+    try:
+        return failover_rest_request(name, conninfo, credentials, method, uri,
+                                     args, kwargs)
+    finally:
+        scheduled.calls = 0
+        rest_scheduler.release(share, bulk)
+
+
+def failover_rest_request(name, conninfo, credentials, method, uri, args,
+                          kwargs):
+    """measured_rest_request(), moving the client to another node when the
+    one it's on can't be reached or drops the connection. A GET that hasn't
+    written anything to its response file yet is tried again there, other
+    calls may have been carried out and are raised
+    """
+    response_file = kwargs.get('response_file')
+    start = response_file.tell() if response_file is not None else None
+    try:
+        return measured_rest_request(name, conninfo, credentials, method, uri,
+                                     args, kwargs)
+    except (socket.error, httplib.HTTPException), e:
+        host = conninfo.host
+        conninfo.close()
+        conninfo.host = node_balancer.pick(avoid=host)
+        metrics.inc('qftpd_rest_failovers_total', (('call', name),))
+        logger.warn("%s on %s failed (%r), moving to %s" %
+                    (name, host, e, conninfo.host))
+        if method != 'GET' or (response_file is not None and
+                               response_file.tell() != start):
+            raise
+    return measured_rest_request(name, conninfo, credentials, method, uri,
+                                 args, kwargs)
+
+
+def measured_rest_request(name, conninfo, credentials, method, uri, args,
+                          kwargs):
+    host = getattr(conninfo, 'host', None)
+    labels = (('call', name),)
+    # a session's own clients carry its trace, anything else run for it
+    # (the login, admin lookups) finds it on the thread
+    trace = getattr(conninfo, 'trace', None) or tracer.active()
+    call = response = None
+    status = 'error'
+    if trace is not None:
+        call = RestCall(name, method, uri, args, kwargs)
+        trace.begin_call(call)
+    node_balancer.begin(host)
+    start = time.time()
+    failed = True
+    try:
+        response = untracked_rest_request(conninfo, credentials, method, uri,
+                                          *args, **kwargs)
+        failed = False
+        status = 'ok'
+        return response
+    except RequestError, e:
+        status = e.status_code
+        metrics.inc('qftpd_rest_request_errors_total',
+                    labels + (('status', e.status_code),))
+        # the node answered, only count it against the node if it's sick
+        failed = e.status_code >= 500
+        raise
+    except Exception:
+        metrics.inc('qftpd_rest_request_errors_total',
+                    labels + (('status', 'error'),))
+        raise
+    finally:
+        elapsed = time.time() - start
+        node_balancer.end(host, elapsed, failed)
+        metrics.observe('qftpd_rest_request_seconds', labels, elapsed)
+        if call is not None:
+            call.finish(response, status)
+            trace.end_call(call)
+
+qumulo.lib.request.rest_request = tracked_rest_request
+
+
+def on_ioloop():
+    """Whether this is the async server's IOLoop thread, which can't wait"""
+    executor = QFTPHandler.executor
+    return executor is not None and executor.in_loop()
+
+
+class SessionExpiry(object):
+    """RestClient.handle_request_error() for a session's clients. The
+    RestClient retries a call once when this returns, so on a 401 it logs
+    in again through relogin() first; anything else is raised as is
+    """
+    def __init__(self, rc, relogin):
+        self.rc = weakref.proxy(rc)  # no cycle keeping the connection open
+        self.relogin = relogin
+
+    def __call__(self, request_error):
+        if request_error.status_code != 401:
+            raise
+        logger.debug("session expired on the cluster, logging in again")
+        self.rc.credentials = self.relogin()
+
+
+def make_rest_client(credentials=None, relogin=None):
+    """A RestClient on whichever node node_balancer picks, whose calls give
+    up after REST_TIMEOUT rather than hang on a node that stopped answering.
+    With relogin, calls the cluster turns away with 401 are retried once
+    with the credentials relogin() returns
+    """
+    rc = RestClient(node_balancer.pick(), API_PORT, credentials,
+                    timeout=REST_TIMEOUT)
+    rc.relogin = relogin
+    if relogin is not None:
+        rc.handle_request_error = SessionExpiry(rc, relogin)
+    return rc
+
+
+def discover_nodes(rc):
+    """Every node's address according to the cluster, or [] if it won't
+    say
+    """
+    try:
+        statuses = rc.network.list_network_status()
+    except RequestError, e:
+        logger.warn("Couldn't discover cluster nodes: %s" % e)
+        return []
+    hosts = []
+    for status in statuses:
+        address = status.get('network_details', {}).get('address')
+        if address:
+            hosts.append(address)
+    return hosts
+
+
+def refresh_nodes(rc):
+    hosts = list(API_HOSTS or [API_HOST])
+    if NODE_DISCOVERY:
+        hosts = discover_nodes(rc) or hosts
+    node_balancer.set_hosts(hosts)
+    logger.info("balancing API requests across %s" % ', '.join(hosts))
 
 
 def get_rc():
-    rc = RestClient(API_HOST, API_PORT)
+    rc = make_rest_client()
     rc.login(API_USER, API_PASS)
     return rc
 
 
+def warm_identity_caches(rc):
+    """Fill the uid/gid -> name caches from one list_users() and one
+    list_groups() call so listings don't have to look owners up one by one
+    """
+    try:
+        users = rc.users.list_users()
+        groups = rc.groups.list_groups()
+    except RequestError, e:
+        logger.warn("Couldn't pre-warm identity caches: %s" % e)
+        return
+    for user in users:
+        AbstractedQSFS.user_cache.put(str(user['id']), user['name'])
+    for group in groups:
+        AbstractedQSFS.group_cache.put(str(group['id']), group['name'])
+    logger.info("Pre-warmed identity caches with %s users and %s groups" %
+                (len(users), len(groups)))
+
+
+def timestamp_to_epoch_ns(timestamp):
+    """Nanoseconds since the epoch for a QSFS timestamp. QSFS always sends
+    YYYY-MM-DDTHH:MM:SS.nnnnnnnnnZ, which is sliced apart directly; anything
+    else goes through dateutil
+    """
+    if len(timestamp) >= 20 and timestamp[-1] == 'Z' and \
+            timestamp[19] in '.Z':
+        try:
+            seconds = calendar.timegm((int(timestamp[0:4]),
+                                       int(timestamp[5:7]),
+                                       int(timestamp[8:10]),
+                                       int(timestamp[11:13]),
+                                       int(timestamp[14:16]),
+                                       int(timestamp[17:19])))
+            fraction = timestamp[20:-1]
+            return seconds * 1000000000 + int(fraction.ljust(9, '0') or 0)
+        except ValueError:
+            pass
+    delta = dateutil.parser.parse(timestamp) - EPOCH
+    return ((delta.days * 86400 + delta.seconds) * 1000000000 +
+            delta.microseconds * 1000)
+
+
+def add_epoch_times(qstats):
+    """Parse the timestamps of a page of entries in one pass, storing them
+    on each entry as qstat['epoch_ns'][field]. Entries in a page often share
+    timestamps, so each distinct string is only parsed once
+    """
+    parsed = {}
+    for qstat in qstats:
+        epoch_ns = {}
+        for field in TIME_FIELDS:
+            timestamp = qstat[field]
+            if timestamp not in parsed:
+                parsed[timestamp] = timestamp_to_epoch_ns(timestamp)
+            epoch_ns[field] = parsed[timestamp]
+        qstat['epoch_ns'] = epoch_ns
+    return qstats
+
+
+def iter_pages(iterable, page_size):
+    """Yield lists of up to page_size items from iterable without reading
+    any further ahead than that
+    """
+    iterator = iter(iterable)
+    while True:
+        page = list(itertools.islice(iterator, page_size))
+        if not page:
+            return
+        yield page
+
+
+class DirectoryListing(object):
+    """The names listdir() returns, iterated like any listing, which also
+    hands formatters the read_directory pages they came from so nothing
+    has to be looked up again per entry
+    """
+    def __init__(self, pages):
+        self.pages = pages
+
+    def __iter__(self):
+        for entries in self.pages:
+            for entry in entries:
+                yield entry['name']
+
+
+def fs_error(request_error):
+    """FilesystemError for a RequestError, keeping only the first line of
+    its message since the reply to the client has to fit on one
+    """
+    return FilesystemError(str(request_error).splitlines()[0])
+
+
+def file_ref(path, file_id, id_arg='id_', path_arg='path'):
+    """Keyword arguments telling an rc.fs call which file: by its id when
+    we have one, which the cluster finds without walking the path
+    """
+    if file_id is not None:
+        return {id_arg: file_id}
+    return {path_arg: path}
+
+
+def try_by_id(function, path, file_id, id_arg='id_', **kwargs):
+    """function(**kwargs) naming path by file_id, for calls that only read
+    and whose response, or first page, says what path the file has now.
+    Something else on the cluster can rename, replace or delete the file
+    behind the id's back, so unless the response names path this returns
+    None, and the call has to be made by path
+    """
+    try:
+        response = function(**dict(kwargs, **{id_arg: file_id}))
+        first = response
+        if not isinstance(response, dict):  # read_entire_directory() pages
+            first = next(response)
+            response = itertools.chain([first], response)
+    except RequestError, e:
+        if e.status_code != 404:
+            raise
+        first = {}
+    if posixpath.normpath(first.get('path') or '') == posixpath.normpath(path):
+        return response
+    logger.debug("id %s no longer names %s, going by path" % (file_id, path))
+    return None
+
+
+def read_entire_directory(rc, page_size=None, path=None, id_=None):
+    """rc.fs.read_entire_directory(), with each page's call retried through
+    rc.handle_request_error() like rc's other calls. The library's generator
+    makes its calls after rc has handed it back, so a 401 there never got
+    as far as logging the session in again
+    """
+    page = rc.fs.read_directory(page_size=page_size, path=path, id_=id_)
+    yield page
+    while page['paging']['next']:
+        uri = page['paging']['next']
+        try:
+            response = qumulo.lib.request.rest_request(
+                rc.conninfo, rc.credentials, 'GET', uri)
+        except RequestError, e:
+            rc.handle_request_error(e)
+            response = qumulo.lib.request.rest_request(
+                rc.conninfo, rc.credentials, 'GET', uri)
+        page = response.data
+        yield page
+
+
 class stat_result(object):
     """a dummy object used to move stat() results around"""
     pass
 
 
+class TTLCache(object):
+    """A thread-safe LRU cache whose entries expire ttl seconds after they are
+    stored. Errors can be stored as negative entries, which expire after
+    negative_ttl seconds and are re-raised by get().
+
+    An entry can be stored for a scope, such as the user whose call
+    fetched it, and only gets for the same scope see it. Invalidating a key
+    drops it in every scope
+    """
+    def __init__(self, ttl, max_size, negative_ttl=None):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_size = max_size
+        # key -> {scope: (expires, value, error)}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, scope=None):
+        """Return the cached value for key, or None on a miss"""
+        with self.lock:
+            scopes = self.entries.pop(key, None)
+            entry = scopes and scopes.get(scope)
+            if entry is not None and entry[0] < time.time():
+                del scopes[scope]
+                entry = None
+            if scopes:
+                self.entries[key] = scopes  # most recently used goes last
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def put(self, key, value, scope=None):
+        self.store(key, self.ttl, value, None, scope)
+
+    def put_error(self, key, error, scope=None):
+        self.store(key, self.negative_ttl, None, error, scope)
+
+    def store(self, key, ttl, value, error, scope=None):
+        if ttl <= 0:
+            return
+        with self.lock:
+            scopes = self.entries.pop(key, None) or {}
+            scopes[scope] = (time.time() + ttl, value, error)
+            self.entries[key] = scopes
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def invalidate_prefix(self, prefix):
+        """Drop every entry whose key starts with prefix"""
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries)}
+
+
+FILE_TYPES = ('FS_FILE_TYPE_FILE', 'FS_FILE_TYPE_DIRECTORY',
+              'FS_FILE_TYPE_SYMLINK', 'FS_FILE_TYPE_UNIX_PIPE',
+              'FS_FILE_TYPE_UNIX_CHARACTER_DEVICE',
+              'FS_FILE_TYPE_UNIX_BLOCK_DEVICE', 'FS_FILE_TYPE_UNIX_SOCKET')
+# type, mode, num_links, size, id, file_number, owner, group, TIME_FIELDS
+QSTAT_RECORD = struct.Struct('<BHIQQQQQqqq')
+
+
+def encode_qstat(qstat):
+    """The fields of a qstat that stat() and listings use, packed into
+    QSTAT_RECORD, or None if they don't fit it
+    """
+    try:
+        if 'epoch_ns' not in qstat:
+            add_epoch_times([qstat])
+        return QSTAT_RECORD.pack(
+            FILE_TYPES.index(qstat['type']), int(qstat['mode'], 8),
+            int(qstat['num_links']), int(qstat['size']), int(qstat['id']),
+            int(qstat['file_number']), int(qstat['owner']),
+            int(qstat['group']),
+            *[qstat['epoch_ns'][field] for field in TIME_FIELDS])
+    except (KeyError, TypeError, ValueError, struct.error):
+        return None
+
+
+def decode_qstat(data, key):
+    fields = QSTAT_RECORD.unpack(data)
+    return {'name': posixpath.basename(key), 'type': FILE_TYPES[fields[0]],
+            'mode': '%04o' % fields[1], 'num_links': fields[2],
+            'size': str(fields[3]), 'id': str(fields[4]),
+            'file_number': str(fields[5]), 'owner': str(fields[6]),
+            'group': str(fields[7]),
+            'epoch_ns': dict(zip(TIME_FIELDS, fields[8:]))}
+
+
+def encode_name(name):
+    return name.encode('utf8')
+
+
+def decode_name(data, key):
+    return data.decode('utf8')
+
+
+class SharedTTLCache(TTLCache):
+    """A TTLCache kept in an anonymous shared mapping, so every process
+    forked after it is made sees the entries and invalidations of the
+    others.
+
+    Each entry is a fixed size record in one of max_size slots, grouped in
+    sets of ways slots that a key hashes to. Readers take no lock: a
+    record's sequence number is odd while it is being written, and a read
+    that sees it odd or changed is a miss. Writers lock the key's set with
+    a byte range lock on a shared file, which the kernel releases if a
+    worker dies holding it, as well as the process's own lock. A full set
+    evicts with a clock hand that skips slots read since it last passed.
+
+    A scoped entry's record is keyed by the key and scope together, but
+    its generation counter is picked by the key alone. Invalidating a key
+    bumps that counter, which every record stored under the old generation
+    is checked against, so it drops the key in every scope along with the
+    few other keys sharing the counter. Prefix invalidation and clear()
+    bump an epoch that every record carries.
+
+    Keys longer than KEY_BYTES with their scope, and values encode()
+    can't fit into VALUE_BYTES, are kept in the process's own LRU like a
+    TTLCache's
+    """
+    KEY_BYTES = 256
+    VALUE_BYTES = 128
+    SEQ = struct.Struct('<I')  # also an epoch or generation counter
+    # tag, key's own tag, epoch, generation, expires, kind, key length,
+    # value length
+    HEADER = struct.Struct('<IIIIdBHH')
+    EMPTY, VALUE, ERROR = range(3)
+    FREE, STORED, REFERENCED = '\0', '\1', '\2'  # a slot's clock state
+    READ_RETRIES = 3
+
+    def __init__(self, ttl, max_size, negative_ttl=None, encode=encode_name,
+                 decode=decode_name, ways=SHARED_CACHE_WAYS):
+        TTLCache.__init__(self, ttl, max_size, negative_ttl)
+        self.encode = encode
+        self.decode = decode
+        self.ways = ways
+        self.sets = max(-(-max_size // ways), 1)
+        self.slots = self.sets * ways
+        self.record_size = (self.SEQ.size + self.HEADER.size +
+                            self.KEY_BYTES + self.VALUE_BYTES + 7) & ~7
+        # epoch, a generation counter per slot, clock hands, slot states,
+        # then the records
+        self.generations = self.SEQ.size
+        self.hands = self.generations + self.SEQ.size * self.slots
+        self.states = self.hands + self.sets
+        self.records = (self.states + self.slots + 7) & ~7
+        self.region = mmap.mmap(-1, self.records +
+                                self.slots * self.record_size)
+        self.lock_file = TemporaryFile()
+
+    def locked_range(self, index, function, *args):
+        """function(*args) holding this process's lock and byte index of
+        the lock file: a set's, or past them the counters'
+        """
+        with self.lock:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, index)
+            try:
+                return function(*args)
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, index)
+
+    def encode_key(self, key):
+        encoded = key.encode('utf8') if isinstance(key, unicode) else key
+        if len(encoded) > self.KEY_BYTES:
+            return None
+        return encoded
+
+    def record_key(self, key, scope):
+        """(record key, its tag, the key's own tag) for key in scope, or
+        None if the record key doesn't fit
+        """
+        encoded = self.encode_key(key)
+        if encoded is None:
+            return None
+        key_tag = zlib.crc32(encoded) & 0xffffffff
+        if scope is not None:
+            if isinstance(scope, unicode):
+                scope = scope.encode('utf8')
+            encoded = self.encode_key(encoded + '\0' + scope)
+            if encoded is None:
+                return None
+        return encoded, zlib.crc32(encoded) & 0xffffffff, key_tag
+
+    def counter(self, offset):
+        return self.SEQ.unpack_from(self.region, offset)[0]
+
+    def bump(self, *offsets):
+        for offset in offsets:
+            self.SEQ.pack_into(self.region, offset,
+                               (self.counter(offset) + 1) & 0xffffffff)
+
+    def generation(self, tag):
+        return self.generations + self.SEQ.size * (tag % self.slots)
+
+    def read_record(self, slot):
+        """The record in slot as it was between writes, None if a writer
+        kept getting in the way
+        """
+        offset = self.records + slot * self.record_size
+        for _ in range(self.READ_RETRIES):
+            seq = self.counter(offset)
+            if seq & 1:
+                continue
+            record = self.region[offset + self.SEQ.size:
+                                 offset + self.record_size]
+            if self.counter(offset) == seq:
+                return record
+        return None
+
+    def write_record(self, slot, header, key, value):
+        offset = self.records + slot * self.record_size
+        # odd while we write, readers stay away. It already is if a worker
+        # died halfway through writing this slot
+        seq = self.counter(offset) | 1
+        self.SEQ.pack_into(self.region, offset, seq)
+        start = offset + self.SEQ.size
+        self.HEADER.pack_into(self.region, start, *header)
+        start += self.HEADER.size
+        self.region[start:start + len(key)] = key
+        start += self.KEY_BYTES
+        self.region[start:start + len(value)] = value
+        self.SEQ.pack_into(self.region, offset, (seq + 1) & 0xffffffff)
+
+    def parse(self, record):
+        """(header, key, value) of a record read_record() returned"""
+        header = self.HEADER.unpack_from(record)
+        start = self.HEADER.size
+        key = record[start:start + header[6]]
+        start += self.KEY_BYTES
+        return header, key, record[start:start + header[7]]
+
+    def current(self, header, now):
+        key_tag, epoch, generation, expires, kind = header[1:6]
+        return (kind != self.EMPTY and expires >= now and
+                epoch == self.counter(0) and
+                generation == self.counter(self.generation(key_tag)))
+
+    def get(self, key, scope=None):
+        scoped = self.record_key(key, scope)
+        if scoped is None:
+            return TTLCache.get(self, key, scope)
+        encoded, tag, _ = scoped
+        first = (tag % self.sets) * self.ways
+        for slot in range(first, first + self.ways):
+            # a quick look at the tag skips the other keys in the set
+            offset = self.records + slot * self.record_size
+            if self.counter(offset + self.SEQ.size) != tag:
+                continue
+            record = self.read_record(slot)
+            if record is None:
+                continue
+            header, record_key, value = self.parse(record)
+            if header[0] != tag or record_key != encoded:
+                continue
+            if not self.current(header, time.time()):
+                break
+            self.region[self.states + slot] = self.REFERENCED
+            # counted without the lock, so a hit can go missing in a race
+            self.hits += 1
+            if header[5] == self.ERROR:
+                status_code, status_message, json_error = json.loads(value)
+                raise RequestError(status_code, status_message, json_error)
+            return self.decode(value, key)
+        return TTLCache.get(self, key, scope)
+
+    def store(self, key, ttl, value, error, scope=None):
+        if ttl <= 0:
+            return
+        scoped = self.record_key(key, scope)
+        if error is None:
+            kind, data = self.VALUE, self.encode(value)
+        else:
+            kind, data = self.ERROR, self.encode_error(error)
+        if scoped is None or data is None or len(data) > self.VALUE_BYTES:
+            if scoped is not None:
+                self.invalidate(key)  # a shared record would win over it
+            return TTLCache.store(self, key, ttl, value, error, scope)
+        encoded, tag, key_tag = scoped
+        set_index = tag % self.sets
+        self.locked_range(set_index, self.store_record, set_index, tag,
+                          key_tag, time.time() + ttl, kind, encoded, data)
+
+    def encode_error(self, error):
+        if not isinstance(error, RequestError):
+            return None
+        return json.dumps([error.status_code, error.status_message,
+                           {'error_class': error.error_class,
+                            'description': error.description,
+                            'module': error.module}])
+
+    def store_record(self, set_index, tag, key_tag, expires, kind, key,
+                     data):
+        slot = self.choose_slot(set_index, tag, key)
+        header = (tag, key_tag, self.counter(0),
+                  self.counter(self.generation(key_tag)), expires, kind,
+                  len(key), len(data))
+        self.write_record(slot, header, key, data)
+        self.region[self.states + slot] = self.STORED
+
+    def choose_slot(self, set_index, tag, key):
+        """The slot in set_index holding key, else a free or dead one,
+        else the one the clock hand evicts
+        """
+        first = set_index * self.ways
+        now = time.time()
+        dead = None
+        for slot in range(first, first + self.ways):
+            # no writer can be busy in a set we hold the lock of
+            offset = self.records + slot * self.record_size
+            header, record_key, _ = self.parse(
+                self.region[offset + self.SEQ.size:
+                            offset + self.record_size])
+            if (header[5] != self.EMPTY and header[0] == tag and
+                    record_key == key):
+                return slot
+            if dead is None and not self.current(header, now):
+                dead = slot
+        if dead is not None:
+            return dead
+        hand = ord(self.region[self.hands + set_index])
+        for _ in range(2 * self.ways):
+            slot = first + hand
+            hand = (hand + 1) % self.ways
+            if self.region[self.states + slot] != self.REFERENCED:
+                break
+            self.region[self.states + slot] = self.STORED
+        self.region[self.hands + set_index] = chr(hand)
+        return slot
+
+    def invalidate(self, *keys):
+        offsets = []
+        for key in keys:
+            encoded = self.encode_key(key)
+            if encoded is not None:
+                offsets.append(self.generation(zlib.crc32(encoded) &
+                                               0xffffffff))
+        if offsets:
+            self.locked_range(self.sets, self.bump, *offsets)
+        TTLCache.invalidate(self, *keys)
+
+    def invalidate_prefix(self, prefix):
+        """Drop every entry, in every process: records aren't indexed by
+        prefix, and renaming a directory is rare enough not to need it
+        """
+        self.locked_range(self.sets, self.bump, 0)
+        TTLCache.invalidate_prefix(self, prefix)
+
+    def clear(self):
+        self.locked_range(self.sets, self.bump, 0)
+        TTLCache.clear(self)
+
+    def stats(self):
+        """TTLCache.stats(), with size counting the records a get() could
+        still return: invalidating or expiring an entry leaves its slot
+        used until something else is stored there. Records are read
+        without the set locks, so one being written may be miscounted
+        """
+        stats = TTLCache.stats(self)
+        now = time.time()
+        states = self.region[self.states:self.states + self.slots]
+        for slot, state in enumerate(states):
+            if state == self.FREE:
+                continue
+            header = self.HEADER.unpack_from(
+                self.region,
+                self.records + slot * self.record_size + self.SEQ.size)
+            stats['size'] += self.current(header, now)
+        return stats
+
+
+def share_caches():
+    """Replace the attribute, id and uid/gid -> name caches with
+    SharedTTLCaches, for processes forked from here on to share. The id
+    cache has to go along with the attributes, or a worker would keep using
+    an id that another worker's rename or delete has invalidated
+    """
+    fs = AbstractedQSFS
+    fs.attr_cache = SharedTTLCache(ATTR_CACHE_TTL, ATTR_CACHE_SIZE,
+                                   ATTR_CACHE_NEGATIVE_TTL,
+                                   encode_qstat, decode_qstat)
+    fs.id_cache = SharedTTLCache(ID_CACHE_TTL, ID_CACHE_SIZE)
+    fs.user_cache = SharedTTLCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE,
+                                   IDENTITY_CACHE_NEGATIVE_TTL)
+    fs.group_cache = SharedTTLCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE,
+                                    IDENTITY_CACHE_NEGATIVE_TTL)
+
+
+class BufferBudget(object):
+    """Bytes of file data that transfers may hold in memory at once,
+    shared by every session in the process. Transfers take what they need
+    next before receiving or fetching it, and give it back once it has gone
+    to the cluster or to the client. Optional requests, like read-ahead
+    past the range a download needs next, leave a quarter of the budget
+    for transfers that need it to make progress at all
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def fits(self, size, optional):
+        if self.limit is None or not self.used:
+            return True
+        return self.used + size <= self.limit - self.limit // 4 * optional
+
+    def has_room(self, size, optional=False):
+        """Whether try_acquire() would have size right now"""
+        with self.lock:
+            return self.fits(size, optional)
+
+    def try_acquire(self, size, optional=False):
+        with self.lock:
+            if not self.fits(size, optional):
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def acquire(self, size):
+        """Take size whether or not the budget has it, for data that's
+        already here
+        """
+        with self.lock:
+            self.used += size
+            self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+    def stats(self):
+        with self.lock:
+            return {'used': self.used, 'peak': self.peak,
+                    'limit': self.limit}
+
+
+buffer_budget = BufferBudget(TRANSFER_BUFFER_BUDGET)
+
+
+class RangeUploader(object):
+    """Writes ranges of one QSFS file concurrently, each worker thread with a
+    RestClient of its own. At most concurrency ranges are in flight, plus
+    one waiting: put() blocks past that, and has_room() tells callers that
+    can't wait whether it would. A session only has one upload going at a
+    time, which makes this a per-session limit
+    """
+    def __init__(self, fs, path, concurrency, ref=None, waker=None):
+        self.fs = fs
+        self.path = path
+        self.ref = ref or {'path': path}  # how the API is told which file
+        self.waker = waker  # called once a range is written
+        self.ranges = Queue.Queue()
+        self.queued = 0  # ranges put and not written yet
+        self.written = threading.Condition()
+        self.errors = []
+        self.threads = []
+        self.grow(concurrency)
+
+    def grow(self, concurrency):
+        """Start workers until there are concurrency of them"""
+        while len(self.threads) < concurrency:
+            thread = threading.Thread(target=self.work,
+                                      name='qftpd-upload %s' % self.path)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def has_room(self):
+        with self.written:
+            return self.queued <= len(self.threads)
+
+    def put(self, offset, data, wait=True):
+        """Queue a range to be written, first waiting for room unless wait
+        is False
+        """
+        if self.errors:
+            raise FilesystemError(str(self.errors[0]))
+        with self.written:
+            while wait and self.queued > len(self.threads):
+                self.written.wait()
+            self.queued += 1
+        self.ranges.put((offset, data))
+
+    def work(self):
+        rc = self.fs.transfer_rc()
+        while True:
+            item = self.ranges.get()
+            if item is None:
+                return
+            offset, data = item
+            logger.debug("RangeUploader writing %s bytes to %s at offset %s" %
+                         (len(data), self.path, offset))
+            try:
+                rc.fs.write_file(io.BytesIO(data), offset=offset, **self.ref)
+            except Exception, e:
+                self.errors.append(e)
+            finally:
+                buffer_budget.release(len(data))
+                with self.written:
+                    self.queued -= 1
+                    self.written.notify_all()
+                if self.waker is not None:
+                    self.waker()
+
+    def finish(self):
+        """Wait for every range to be written, raising if any weren't"""
+        for _ in self.threads:
+            self.ranges.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.errors:
+            raise FilesystemError(str(self.errors[0]))
+
+
 class WriteBuffer(SpooledTemporaryFile):
-    def __init__(self, path, filename, fs, max_size=WRITE_BUFFER_SIZE):
-        """We need the path so we can write the buffered file to the API"""
+    """Stages at most max_size bytes of an upload at a time and writes each
+    full chunk through to the QSFS file at its offset while the data channel
+    is still receiving, so memory per upload stays bounded. What it holds,
+    staged or promised to the data channel, comes out of buffer_budget
+    """
+    def __init__(self, path, filename, fs, max_size=WRITE_BUFFER_SIZE,
+                 offset=None):
+        """We need the path so we can write the buffered file to the API.
+        With an offset, write into the existing file from there instead of
+        creating it. Writes go to the id create_file() returns where there
+        is one, since that is the file we just made
+        """
         SpooledTemporaryFile.__init__(self, max_size=max_size)  # old-style!
         self.path = path
         self.filename = filename
         self.fs = fs
-        self.fullpath = ''
+        self.rc = fs.transfer_rc()
+        self.chunk_size = max_size
+        self.offset = offset or 0  # where the next chunk lands in QSFS
+        self.uploader = None  # a RangeUploader once the upload gets big
+        self.waker = None  # set by a data channel waiting on the uploader
+        self.credit = 0  # budget held for data the channel hasn't sent yet
+        self.fullpath = posixpath.join(path, filename)
+        self.ref = {'path': self.fullpath}
+        if offset is not None:
+            return
         try:
             self.fullpath = self.create_file()
         except RequestError, e:
             SpooledTemporaryFile.close(self)
             raise FilesystemError(str(e))
 
-    def create_file(self):
-        """Attempt to create the file before finishing __init__() so we can bail
-        out early return full_path
+    def create_file(self):
+        """Attempt to create the file before finishing __init__() so we can bail
+        out early return full_path
+        """
+        response = self.rc.fs.create_file(name=self.filename,
+                                          dir_path=self.path)
+        self.fs.invalidate(response['path'])
+        self.ref = file_ref(response['path'], response.get('id'))
+        return response['path']
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        """pyftpdlib seeks to the REST offset before any data arrives, which
+        moves where the upload starts landing in the QSFS file
+        """
+        if whence != os.SEEK_SET or self.tell():
+            raise IOError("WriteBuffer can only seek before it's written to")
+        self.offset = pos
+
+    def buffer_ready(self, size):
+        """Hold budget for the next size bytes from the data channel,
+        False if it can't be spared right now. On the IOLoop, also False
+        while those bytes would fill a chunk the uploader has no room for
+        """
+        if (self.uploader is not None and on_ioloop() and
+                self.tell() + size >= self.chunk_size and
+                not self.uploader.has_room()):
+            return False
+        if self.credit < size:
+            if (not buffer_budget.try_acquire(size - self.credit) and
+                    not self.flush_for_budget(size)):
+                return False
+            self.credit = size
+        return True
+
+    def flush_for_budget(self, size):
+        """Write the partial chunk staged so far, which gives its budget
+        back, and try again for size. Uploads each staging part of a chunk
+        could otherwise hold the whole budget between them and wait on each
+        other forever
+        """
+        if not self.tell() or (self.uploader is not None and on_ioloop() and
+                               not self.uploader.has_room()):
+            return False  # the ranges in flight will give budget back
+        self.flush_chunk()
+        return buffer_budget.try_acquire(size - self.credit)
+
+    def wake(self):
+        if self.waker is not None:
+            self.waker()
+
+    def write(self, data):
+        """Stage data, never letting the buffer grow past chunk_size so it
+        doesn't roll over to disk
+        """
+        if len(data) > self.credit:
+            buffer_budget.acquire(len(data) - self.credit)
+            self.credit = len(data)
+        self.credit -= len(data)
+        while data:
+            room = self.chunk_size - self.tell()
+            SpooledTemporaryFile.write(self, data[:room])
+            data = data[room:]
+            if self.tell() >= self.chunk_size:
+                self.flush_chunk()
+
+    def flush_chunk(self):
+        """Write whatever is staged to QSFS at the current offset and empty
+        the buffer for the next chunk
+        """
+        size = self.tell()
+        if not size:
+            return
+        wide = (UPLOAD_CONCURRENCY > 1 and
+                self.offset + size > PARALLEL_UPLOAD_THRESHOLD)
+        if self.uploader is None and (wide or on_ioloop()):
+            # the IOLoop can't wait on a write, so there even the ranges of
+            # a small upload go to a worker, one at a time
+            self.uploader = RangeUploader(self.fs, self.fullpath, 1,
+                                          self.ref, self.wake)
+        if wide:
+            self.uploader.grow(UPLOAD_CONCURRENCY)
+        metrics.inc('qftpd_upload_chunks_total',
+                    (('mode', 'parallel' if wide else 'serial'),))
+        SpooledTemporaryFile.seek(self, 0)
+        data = self.read(size)
+        if self.uploader is not None:
+            # the uploader gives the budget back once the range is written
+            self.uploader.put(self.offset, data, wait=not on_ioloop())
+        else:
+            logger.debug("flush_chunk() writing %s bytes to %s at offset %s" %
+                         (size, self.fullpath, self.offset))
+            try:
+                self.rc.fs.write_file(io.BytesIO(data), offset=self.offset,
+                                      **self.ref)
+            except RequestError, e:
+                raise FilesystemError(str(e))
+            buffer_budget.release(size)
+        self.offset += size
+        SpooledTemporaryFile.seek(self, 0)
+        self.truncate()
+
+    def close(self):
+        """On close, write the last partial chunk via the API, then close()
+        for realz
+        """
+        logger.debug("close() called on WriteBuffer")
+        try:
+            try:
+                self.flush_chunk()
+            finally:
+                if self.uploader is not None:
+                    self.uploader.finish()
+        finally:
+            self.fs.invalidate(self.fullpath)
+            # unused credit, and anything staged that couldn't be written
+            buffer_budget.release(self.credit + self.tell())
+            self.credit = 0
+            SpooledTemporaryFile.close(self)  # old-style class!
+
+
+class RangeFetch(object):
+    """One read-ahead range, filled in by a ReadBuffer worker thread"""
+    def __init__(self, offset):
+        self.offset = offset
+        self.done = threading.Event()
+        self.cancelled = False
+        self.data = None
+        self.error = None
+
+
+class ReadBuffer(object):
+    """A read-only file object that fetches a QSFS file from the API one
+    bounded byte range at a time, as pyftpdlib's FileProducer asks for data,
+    instead of downloading the whole file before the transfer starts.
+
+    When the file's size is known, ranges are read ahead by worker threads,
+    each with a RestClient of its own, started as ranges are first put in
+    flight. The number in flight grows while the client is left waiting on
+    a range and shrinks while ranges sit there ready because the client is
+    draining them slower than they arrive.
+
+    Every range held, current or read ahead, comes out of buffer_budget.
+    The range the client needs next always gets its share, read-ahead only
+    while the budget has room to spare.
+
+    The IOLoop can't wait on a fetch, so there even the range the client
+    needs next is fetched by a worker, read-ahead or not, and the data
+    channel holds off until it has arrived
+    """
+    def __init__(self, path, fs, chunk_size=READ_CHUNK_SIZE, size=None):
+        self.name = path
+        self.fs = fs
+        self.rc = fs.transfer_rc()
+        self.chunk_size = chunk_size
+        self.size = size  # read-ahead needs to know where the file ends
+        self.closed = False
+        self.offset = 0  # file offset of the next range to fetch
+        self.chunk = ''
+        self.chunk_pos = 0
+        self.eof = False
+        self.window = READ_AHEAD_MIN
+        self.stalled = False  # buffer_ready() found the next range missing
+        self.waker = None  # set by a data channel waiting on a range
+        self.pending = deque()  # RangeFetches in flight, in file order
+        self.next_offset = 0  # where the next read-ahead range starts
+        self.fetches = Queue.Queue()
+        self.workers = []
+        self.reserved = 0  # bytes of buffer_budget held
+
+    def chunks_held(self):
+        return len(self.pending) + (self.chunk_pos < len(self.chunk))
+
+    def reserve(self, chunks, optional=False, force=False):
+        """Hold budget for chunks ranges in all, False if it can't be had"""
+        size = chunks * self.chunk_size - self.reserved
+        if size <= 0:
+            return True
+        if force:
+            buffer_budget.acquire(size)
+        elif not buffer_budget.try_acquire(size, optional):
+            return False
+        self.reserved += size
+        return True
+
+    def trim(self):
+        """Give back budget held beyond the ranges we have"""
+        excess = self.reserved - self.chunks_held() * self.chunk_size
+        if excess > 0:
+            buffer_budget.release(excess)
+            self.reserved -= excess
+
+    def buffer_ready(self, size):
+        """Whether the next read() has its data, or the budget to fetch
+        it. On the IOLoop the data itself, which is asked for here
+        """
+        if self.chunk_pos < len(self.chunk) or self.eof:
+            return True
+        if self.size is None or not on_ioloop():
+            return bool(self.pending) or self.reserve(1)
+        if not self.pending and self.offset < self.size:
+            if not self.reserve(1):
+                return False
+            self.read_ahead()
+        if self.range_ready():
+            return True
+        self.stalled = True
+        return False
+
+    def range_ready(self):
+        """Whether fetch_chunk() can go without waiting on a fetch"""
+        return self.size is not None and (
+            self.offset >= self.size or
+            bool(self.pending) and self.pending[0].done.is_set())
+
+    def read_range(self, rc, offset):
+        response_file = io.BytesIO()
+        logger.debug("read_range() reading %s bytes of %s at offset %s" %
+                     (self.chunk_size, self.name, offset))
+        try:
+            rc.fs.read_file(response_file, path=self.name, offset=offset,
+                            length=self.chunk_size)
+        except RequestError, e:
+            raise FilesystemError(str(e))
+        return response_file.getvalue()
+
+    def fetch_chunk(self):
+        """Replace the current chunk with the next range of the file"""
+        if self.size is not None and self.offset >= self.size:
+            self.set_chunk('')
+            return
+        if self.size is None or (READ_AHEAD_MAX <= 0 and not self.pending):
+            self.reserve(1, force=True)
+            self.set_chunk(self.read_range(self.rc, self.offset))
+            return
+        if READ_AHEAD_MAX > 0:
+            self.read_ahead()
+        fetch = self.pending.popleft()
+        stalled = self.stalled or not fetch.done.is_set()
+        self.stalled = False
+        fetch.done.wait()
+        if READ_AHEAD_MAX > 0:
+            self.adapt(stalled)
+        if fetch.error is not None:
+            raise FilesystemError(str(fetch.error))
+        self.set_chunk(fetch.data)
+        if READ_AHEAD_MAX > 0:
+            self.read_ahead()
+        self.trim()
+
+    def set_chunk(self, data):
+        self.chunk = data
+        self.chunk_pos = 0
+        self.offset += len(data)
+        # a short range means we have hit the end of the file
+        self.eof = (len(data) < self.chunk_size or
+                    (self.size is not None and self.offset >= self.size))
+
+    def read_ahead(self):
+        """Keep window ranges in flight past the current chunk"""
+        if not self.pending:
+            self.next_offset = self.offset
+        while (len(self.pending) < self.window and
+               self.next_offset < self.size):
+            held = self.chunks_held()
+            if not held:
+                self.reserve(1, force=True)
+            elif not self.reserve(held + 1, optional=True):
+                break
+            fetch = RangeFetch(self.next_offset)
+            self.pending.append(fetch)
+            self.fetches.put(fetch)
+            self.next_offset += self.chunk_size
+        # a worker, and a RestClient, per range in flight at most: a small
+        # file or a slow client never starts them all
+        while len(self.workers) < min(len(self.pending),
+                                      max(READ_AHEAD_MAX, 1)):
+            worker = threading.Thread(target=self.fetch_ranges,
+                                      name='qftpd-read %s' % self.name)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def adapt(self, stalled):
+        if stalled:
+            metrics.inc('qftpd_read_ahead_stalls_total')
+            self.window = min(self.window + 1, READ_AHEAD_MAX)
+        elif self.pending and all(f.done.is_set() for f in self.pending):
+            # everything is already here, the client is what's slow
+            self.window = max(self.window - 1, READ_AHEAD_MIN)
+
+    def fetch_ranges(self):
+        rc = self.fs.transfer_rc()
+        while True:
+            fetch = self.fetches.get()
+            if fetch is None:
+                return
+            if not fetch.cancelled:
+                try:
+                    fetch.data = self.read_range(rc, fetch.offset)
+                except Exception, e:
+                    fetch.error = e
+            fetch.done.set()
+            if self.waker is not None:
+                self.waker()
+
+    def cancel_read_ahead(self):
+        for fetch in self.pending:
+            fetch.cancelled = True
+        self.pending.clear()
+        self.stalled = False
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self.chunk_pos >= len(self.chunk):
+                if self.eof:
+                    break
+                if pieces and on_ioloop() and not self.range_ready():
+                    break  # a short read rather than wait on the IOLoop
+                self.fetch_chunk()
+                continue
+            end = len(self.chunk)
+            if size > 0:
+                end = min(end, self.chunk_pos + size)
+                size -= end - self.chunk_pos
+            pieces.append(self.chunk[self.chunk_pos:end])
+            self.chunk_pos = end
+        return ''.join(pieces)
+
+    def tell(self):
+        return self.offset - (len(self.chunk) - self.chunk_pos)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        """Seeking inside the current chunk just moves within it, anywhere
+        else throws the chunk away and the next read() fetches a range
+        starting at the new position
+        """
+        if whence == os.SEEK_CUR:
+            pos += self.tell()
+        elif whence != os.SEEK_SET:
+            raise IOError("ReadBuffer only supports SEEK_SET and SEEK_CUR")
+        chunk_start = self.offset - len(self.chunk)
+        if chunk_start <= pos <= self.offset:
+            self.chunk_pos = pos - chunk_start
+        else:
+            self.cancel_read_ahead()
+            self.offset = pos
+            self.chunk = ''
+            self.chunk_pos = 0
+            self.eof = False
+            self.trim()
+
+    def close(self):
+        self.cancel_read_ahead()
+        for _ in self.workers:
+            self.fetches.put(None)
+        self.workers = []
+        self.chunk = ''
+        self.closed = True
+        buffer_budget.release(self.reserved)
+        self.reserved = 0
+
+
+class TreeWalk(object):
+    """Lists every directory below root with up to concurrency
+    read_directory calls in flight, each worker thread with a RestClient of
+    its own. Iterating yields (path, entries) for each directory as soon as
+    it has been read, or depth first in listing order if ordered, which
+    holds back directories that finish early. Directories more than
+    max_depth levels down aren't read, and the walk stops after
+    max_entries entries.
+
+    Directories are read no faster than the listing is taken: those found
+    wait their turn while max_buffered entries are held back from it, or
+    while buffer_budget, which the entries held count against, has no room
+    to spare. Only the directory the listing needs next is read regardless
+    """
+    def __init__(self, fs, root, concurrency, ordered=False, max_depth=None,
+                 max_entries=None, max_buffered=TREE_WALK_MAX_BUFFERED):
+        self.fs = fs
+        self.root = root.rstrip('/') or '/'
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.max_buffered = max_buffered
+        # (path, depth, file id), None stops a worker
+        self.pending = Queue.Queue()
+        self.done = Queue.Queue()  # (path, depth, entries, error)
+        self.waiting = OrderedDict()  # path -> (depth, file id), not read yet
+        self.outstanding = 0
+        self.received = 0  # entries read
+        self.buffered = 0  # entries read and not yielded yet
+        self.stopped = False
+        self.truncated = False
+        self.threads = []
+
+    def __iter__(self):
+        self.start()
+        try:
+            listed = 0
+            for path, entries in self.walk():
+                if self.max_entries is not None:
+                    if listed + len(entries) > self.max_entries:
+                        entries = entries[:self.max_entries - listed]
+                        self.truncated = True
+                    listed += len(entries)
+                yield path, entries
+                if self.truncated:
+                    break
+            if self.truncated or self.waiting:
+                self.truncated = True
+                logger.warn("listing of %s stopped after %d entries" %
+                            (self.root, listed))
+        finally:
+            self.close()
+
+    def start(self):
+        self.submit(self.root, 0)
+        for _ in range(max(self.concurrency, 1)):
+            thread = threading.Thread(target=self.work,
+                                      name='qftpd-walk %s' % self.root)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, path, depth, file_id=None):
+        self.outstanding += 1
+        self.pending.put((path, depth, file_id))
+
+    def has_room(self):
+        """Whether another directory can be read ahead of the listing"""
+        return (self.outstanding < self.concurrency and
+                self.buffered < self.max_buffered and
+                buffer_budget.has_room(LISTDIR_PAGE_SIZE * TREE_ENTRY_SIZE,
+                                       optional=True))
+
+    def fill(self, needed=None):
+        """Read needed, the directory the listing can't go on without, and
+        as many of the others found so far as there is room for. One is
+        read even without room while none are, until max_entries have
+        been read
+        """
+        if needed in self.waiting:
+            self.submit(needed, *self.waiting.pop(needed))
+        while self.waiting and (self.max_entries is None or
+                                self.received < self.max_entries):
+            if self.outstanding and not self.has_room():
+                return
+            path, (depth, file_id) = self.waiting.popitem(last=self.ordered)
+            self.submit(path, depth, file_id)
+
+    def hold(self, count):
+        self.buffered += count
+        buffer_budget.acquire(count * TREE_ENTRY_SIZE)
+
+    def release(self, count):
+        self.buffered -= count
+        buffer_budget.release(count * TREE_ENTRY_SIZE)
+
+    def work(self):
+        rc = self.fs.transfer_rc()
+        while True:
+            item = self.pending.get()
+            if item is None or self.stopped:
+                return
+            path, depth, file_id = item
+            entries, error = [], None
+            try:
+                # subdirectories go by the id their parent's listing gave
+                pages = None
+                if file_id is not None:
+                    pages = try_by_id(
+                        functools.partial(read_entire_directory, rc), path,
+                        file_id, page_size=LISTDIR_PAGE_SIZE)
+                if pages is None:
+                    pages = read_entire_directory(
+                        rc, page_size=LISTDIR_PAGE_SIZE, path=path)
+                for page in pages:
+                    entries.extend(page['files'])
+                    if self.stopped:
+                        return
+                add_epoch_times(entries)
+            except Exception, e:
+                error = e
+            self.done.put((path, depth, entries, error))
+
+    def receive(self):
+        """Wait for the next directory to be read and note its
+        subdirectories to be read in turn. Returns (path, entries,
+        subdirectories), with entries None if the directory couldn't be
+        read. The entries are held until release()d
         """
-        response = self.fs.rc.fs.create_file(name=self.filename,
-                                             dir_path=self.path)
-        return response['path']
+        path, depth, entries, error = self.done.get()
+        self.outstanding -= 1
+        if error is not None:
+            if path == self.root:
+                if isinstance(error, RequestError):
+                    raise fs_error(error)
+                raise error
+            logger.warn("skipping %s in listing: %s" % (path, error))
+            return path, None, []
+        self.received += len(entries)
+        self.hold(len(entries))
+        subdirs = []
+        if self.max_depth is None or depth < self.max_depth:
+            for entry in entries:
+                if entry['type'] == u'FS_FILE_TYPE_DIRECTORY':
+                    subdir = posixpath.join(path, entry['name'])
+                    self.waiting[subdir] = (depth + 1, entry.get('id'))
+                    subdirs.append(subdir)
+        return path, entries, subdirs
+
+    def walk(self):
+        if not self.ordered:
+            while True:
+                self.fill()
+                if not self.outstanding:
+                    return
+                path, entries, _ = self.receive()
+                if entries is not None:
+                    self.release(len(entries))
+                    yield path, entries
+        received = {}
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            while path not in received:
+                self.fill(path)
+                result = self.receive()
+                received[result[0]] = result[1:]
+            entries, subdirs = received.pop(path)
+            if entries is not None:
+                self.release(len(entries))
+                yield path, entries
+            stack.extend(reversed(subdirs))
 
     def close(self):
-        """On close, seek to 0 and write the data via the API, then close()
-        for realz
-        """
-        logger.debug("close() called on WriteBuffer")
-        self.seek(0)
-        logger.debug("Attempting to create file at dir_path %s with name %s" %
-                     (self.path, self.filename))
-        self.fs.rc.fs.write_file(self, self.fullpath)
-        SpooledTemporaryFile.close(self)  # old-style class!
+        """Stop the workers; directories already being read are dropped"""
+        self.stopped = True
+        for _ in self.threads:
+            self.pending.put(None)
+        self.threads = []
+        self.release(self.buffered)
 
 
 class AbstractedQSFS(AbstractedFS):
+    # shared by every session in the server, keyed by normalized path
+    attr_cache = TTLCache(ATTR_CACHE_TTL, ATTR_CACHE_SIZE,
+                          negative_ttl=ATTR_CACHE_NEGATIVE_TTL)
+    # uid/gid -> name, also shared by every session
+    user_cache = TTLCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE,
+                          negative_ttl=IDENTITY_CACHE_NEGATIVE_TTL)
+    group_cache = TTLCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE,
+                           negative_ttl=IDENTITY_CACHE_NEGATIVE_TTL)
+    # normalized path -> file id, from listings and stats
+    id_cache = TTLCache(ID_CACHE_TTL, ID_CACHE_SIZE)
+
     def __init__(self, root, cmd_channel):
         super(AbstractedQSFS, self).__init__(root, cmd_channel)
         self.rc = None
@@ -101,6 +2308,85 @@ class AbstractedQSFS(AbstractedFS):
     def set_rc(self, rc):
         self.rc = rc
 
+    def transfer_rc(self):
+        """A client of the transfer's own, so bulk data is spread across
+        nodes and doesn't share the session client's connection
+        """
+        if self.rc.credentials is None:
+            return self.rc
+        rc = make_rest_client(self.rc.credentials,
+                              getattr(self.rc, 'relogin', None))
+        # its calls are still the session's
+        for name in ('trace', 'share'):
+            setattr(rc.conninfo, name, getattr(self.rc.conninfo, name, None))
+        return rc
+
+    def cache_key(self, path):
+        return posixpath.normpath(path)
+
+    def cache_scope(self):
+        """Whose attributes and ids the caches hand out. The cluster checks
+        permissions per user, so what one user's calls returned, or could
+        reach by id, mustn't be given to another
+        """
+        return getattr(self.cmd_channel, 'username', None)
+
+    def get_qstat(self, path, fresh=False):
+        """rc.fs.get_file_attr() through the attribute cache. Paths that don't
+        exist are remembered too, and raise the same RequestError again.
+        fresh asks the cluster even if the cache has the path, for when a
+        stale size would lose or overwrite data
+        """
+        key = self.cache_key(path)
+        qstat = None if fresh else self.attr_cache.get(key,
+                                                       self.cache_scope())
+        if qstat is not None:
+            return qstat
+        try:
+            qstat = self.call_by_ref(self.rc.fs.get_file_attr, path)
+        except RequestError, e:
+            if e.status_code == 404:
+                self.attr_cache.put_error(key, e, self.cache_scope())
+            raise
+        self.cache_qstat(key, qstat)
+        return qstat
+
+    def cache_qstat(self, key, qstat):
+        scope = self.cache_scope()
+        self.attr_cache.put(key, qstat, scope)
+        if qstat.get('id') is not None:
+            self.id_cache.put(key, qstat['id'], scope)
+
+    def call_by_ref(self, function, path, id_arg='id_', path_arg='path',
+                    **kwargs):
+        """function(**kwargs) by the id the id cache has for path, if
+        try_by_id() finds it still names path, else by path and without the
+        id. Calls that change anything name the path instead: by the time
+        their response could show the id was stale, the wrong file has been
+        changed
+        """
+        key = self.cache_key(path)
+        file_id = self.id_cache.get(key, self.cache_scope())
+        if file_id is not None:
+            response = try_by_id(function, path, file_id, id_arg, **kwargs)
+            if response is not None:
+                return response
+            self.id_cache.invalidate(key)
+        kwargs[path_arg] = path
+        return function(**kwargs)
+
+    def invalidate(self, *paths):
+        """Drop cached attributes for paths and their parent directories,
+        whose mtime and child count change along with them
+        """
+        keys = []
+        for path in paths:
+            key = self.cache_key(path)
+            keys.extend([key, posixpath.dirname(key)])
+        self.attr_cache.invalidate(*keys)
+        # a directory keeps its id when its entries change
+        self.id_cache.invalidate(*[self.cache_key(path) for path in paths])
+
     def open(self, filename, mode):
         """Return a file handler for the filename and mode specified. This will
         need to get the file id from the Qumulo REST client and do something
@@ -108,21 +2394,27 @@ class AbstractedQSFS(AbstractedFS):
         """
         logger.debug("open(%s, %s)" % (filename, mode))
         assert isinstance(filename, unicode), filename
-        if 'r' in mode:  # read files!
+        if 'a' in mode or '+' in mode:  # APPE, or STOR after REST
+            return self.resume_file_handle(filename, append='a' in mode)
+        elif 'r' in mode:  # read files!
             return self.read_file_handle(filename)
         elif 'w' in mode:   # write files!
             return self.write_file_handle(filename)
 
     def read_file_handle(self, filename):
-        """Get the file data, put it in a SpooledTemporaryFile object for return
-        and reading
+        """Return a ReadBuffer that streams the file data from QSFS as the
+        data channel drains it
         """
         logger.debug("read_file_handle('%s')" % filename)
-        read_buffer = SpooledTemporaryFile()
-        response = self.rc.fs.read_file(read_buffer, filename)
-        logger.debug(response)
-        read_buffer.seek(0)
-        return read_buffer
+        try:
+            # ReadBuffer stops at this size, so a file that grew since it
+            # was listed mustn't come out truncated
+            qstat = self.get_qstat(filename, fresh=True)
+        except RequestError, e:
+            raise FilesystemError(str(e))
+        # nothing is read until the data channel asks, so a RETR after REST
+        # starts reading at the restart offset
+        return ReadBuffer(filename, fs=self, size=int(qstat['size']))
 
     def write_file_handle(self, filename):
         """This is trickier than the read, because we need a callback on close()
@@ -135,6 +2427,26 @@ class AbstractedQSFS(AbstractedFS):
         write_buffer = WriteBuffer(dirname, basename, fs=self)
         return write_buffer
 
+    def resume_file_handle(self, filename, append):
+        """Write into an existing file without sending what's already
+        stored again: from its end for APPE, or from wherever pyftpdlib seeks
+        to for REST+STOR
+        """
+        logger.debug("resume_file_handle('%s', %s)" % (filename, append))
+        path = self.realpath(filename)
+        (dirname, basename) = os.path.split(path)
+        try:
+            # APPE writes from the size, and pyftpdlib checks a REST offset
+            # against getsize(), which this puts in the cache: both have to
+            # see what the cluster holds now, not what was listed
+            qstat = self.get_qstat(path, fresh=True)
+        except RequestError, e:
+            if e.status_code == 404 and append:
+                return self.write_file_handle(filename)
+            raise FilesystemError(str(e))
+        return WriteBuffer(dirname, basename, fs=self,
+                           offset=int(qstat['size']) if append else 0)
+
     def mkstemp(self, suffix='', prefix='', directory=None, mode='wb'):
         logger.debug("mkstemp(suffix='%s', prefix='%s', dir='%s', mode='%s')" %
                      (suffix, prefix, directory, mode))
@@ -163,24 +2475,56 @@ class AbstractedQSFS(AbstractedFS):
             self.rc.fs.create_directory(name=name, dir_path=path)
         except RequestError, e:
             raise FilesystemError(str(e))
+        finally:
+            self.invalidate(os.path.join(path, name))
 
     def listdir(self, path):
-        """list the contents of a directory path"""
+        """list the contents of a directory path. The DirectoryListing only
+        fetches the next read_directory page once the names from the
+        previous one have been consumed, so huge directories list in bounded
+        memory
+        """
         logger.debug("listdir(%s)" % path)
         assert isinstance(path, unicode), path
-        # use the restclient to get the contents of a real path
-        response = self.rc.fs.read_directory(page_size=1000, path=path)
-        logger.debug(str(response))
-        dir_list = [f['name'] for f in response['files']]
-        logger.debug("listdir() will return " + str(dir_list))
-        return dir_list
+        return DirectoryListing(self.iter_directory_pages(path))
+
+    def iter_directory_pages(self, path):
+        """Yield the entries of every read_directory page, following the
+        paging links. The pages are read as the listing is sent, well after
+        any check that path exists, so a failed read raises FilesystemError
+        for the reply like that check would have
+        """
+        try:
+            # by id if we have one that still names path
+            pages = self.call_by_ref(
+                functools.partial(read_entire_directory, self.rc), path,
+                page_size=LISTDIR_PAGE_SIZE)
+            for page in pages:
+                logger.debug("read_directory(%s) returned %s entries" %
+                             (path, len(page['files'])))
+                # the entries carry the same attributes get_file_attr()
+                # returns, so stash them in the attribute cache for any
+                # lstat() that follows
+                add_epoch_times(page['files'])
+                self.cache_entries(path, page['files'])
+                yield page['files']
+        except RequestError, e:
+            raise fs_error(e)
+
+    def cache_entries(self, path, entries):
+        for entry in entries:
+            key = self.cache_key(os.path.join(path, entry['name']))
+            self.cache_qstat(key, entry)
 
     def rmdir(self, path):
         logger.debug("rmdir(%s)" % path)
         # make sure the path has one and only one trailing slash or this fails
         # in the RestClient
         path = path.rstrip('/') + '/'
+        self.invalidate(path)
         try:
+            # by path, since the trailing slash is what keeps this from
+            # deleting a file
             self.rc.fs.delete(path)
         except RequestError:  # This can explode if we try to rmdir a file
             message = 'Ignoring rmdir(%s) because %s is not a dir' % \
@@ -190,11 +2534,63 @@ class AbstractedQSFS(AbstractedFS):
 
     def remove(self, path):
         logger.debug("remove(%s)" % path)
-        self.rc.fs.delete(path)
+        try:
+            self.rc.fs.delete(path)
+        finally:
+            self.invalidate(path)
 
     def rename(self, src, dst):
-        logger.debug("NOT IMPLEMENTED rename('%s', '%s')" % (src, dst))
-        return super(AbstractedQSFS, self).rename(src, dst)
+        """Move src to dst on the cluster, which only touches metadata no
+        matter how much data lives under src. Like rename(2), and the
+        os.rename() pyftpdlib's own filesystem uses, a file already at dst
+        is replaced, so uploading to a temporary name and renaming it over
+        the real one works
+        """
+        logger.debug("rename('%s', '%s')" % (src, dst))
+        is_dir = self.isdir(src)
+        (dirname, basename) = posixpath.split(dst.rstrip('/'))
+        try:
+            # the library str()s both names
+            self.rc.fs.rename(name=basename.encode('utf8'),
+                              source=src.encode('utf8'), dir_path=dirname,
+                              clobber=True)
+        except RequestError, e:
+            raise fs_error(e)
+        finally:
+            self.invalidate(src, dst)
+            if is_dir:
+                # everything below src is cached under its old path, and
+                # paths below dst found missing before may exist now
+                for path in (src, dst):
+                    prefix = self.cache_key(path).rstrip('/') + '/'
+                    self.attr_cache.invalidate_prefix(prefix)
+                    self.id_cache.invalidate_prefix(prefix)
+
+    def copy(self, src, dst):
+        """Copy the file src to the new file dst on the cluster, without
+        the data passing through this server
+        """
+        logger.debug("copy('%s', '%s')" % (src, dst))
+        if not self.isfile(src):
+            raise FilesystemError('%s is not a file' % src)
+        (dirname, basename) = posixpath.split(dst)
+        try:
+            # the copy goes into an existing file, so create it first; like
+            # STOR without REST this fails if dst exists
+            response = self.rc.fs.create_file(name=basename,
+                                              dir_path=dirname)
+            # the file just made is the one to fill, whatever its path
+            target = file_ref(dst, response.get('id'), 'target_id',
+                              'target_path')
+            try:
+                self.rc.fs.copy(source_path=src, **target)
+            except RequestError:
+                self.rc.fs.delete(**file_ref(dst, response.get('id')))
+                raise
+        except RequestError, e:
+            raise fs_error(e)
+        finally:
+            self.invalidate(dst)
 
     def chmod(self, path, mode):
         logger.debug("NOT IMPLEMENTED chmod(%s, %s)" % (path, mode))
@@ -207,8 +2603,9 @@ class AbstractedQSFS(AbstractedFS):
             st_nlink=1, st_uid=2090, st_gid=2000, st_size=181331,
             st_atime=1425167786, st_mtime=1424917246, st_ctime=1424917246)
         """
-        logger.debug("NOT IMPLEMENTED stat(%s)" % path)
-        return super(AbstractedQSFS, self).stat(path)
+        logger.debug("stat(%s)" % path)
+        # QSFS symlinks aren't surfaced over FTP, so there is nothing to follow
+        return self.lstat(path)
 
     def lstat(self, path):
         """This gets called on every file when a user is trying to 'ls' or 'dir'
@@ -237,7 +2634,13 @@ class AbstractedQSFS(AbstractedFS):
                 }
         """
         logger.debug("lstat(%s)" % path)
-        qstat = self.rc.fs.get_attr(path=path)
+        try:
+            qstat = self.get_qstat(path)
+        except RequestError as err:
+            raise FilesystemError(err)
+        return self.qstat_to_stat_result(qstat)
+
+    def qstat_to_stat_result(self, qstat):
         stat_r = stat_result()
         setattr(stat_r, 'st_mode', self.get_st_mode(qstat))
         setattr(stat_r, 'st_ino', self.get_st_ino(qstat))
@@ -257,7 +2660,7 @@ class AbstractedQSFS(AbstractedFS):
 
     def isfile(self, path):
         logger.debug("isfile(%s)" % path)
-        response = self.rc.fs.get_attr(path=path)
+        response = self.get_qstat(path)
         #return super(AbstractedQSFS, self).isfile(path)
         retval = response['type'] == u'FS_FILE_TYPE_FILE'
         logger.debug("isfile(%s) will return %s" % (path, retval))
@@ -271,7 +2674,7 @@ class AbstractedQSFS(AbstractedFS):
         logger.debug("isdir(%s)" % path)
         # if this path has "type": "FS_FILE_TYPE_DIRECTORY", return true
         try:
-            response = self.rc.fs.get_attr(path=path)
+            response = self.get_qstat(path)
         except RequestError as err:
             raise FilesystemError(err)
         #return super(AbstractedQSFS, self).isdir(path)
@@ -281,11 +2684,17 @@ class AbstractedQSFS(AbstractedFS):
 
     def getsize(self, path):
         logger.debug("getsize(%s)" % path)
-        return super(AbstractedQSFS, self).getsize(path)
+        try:
+            return int(self.get_qstat(path)['size'])
+        except RequestError as err:
+            raise FilesystemError(err)
 
     def getmtime(self, path):
         logger.debug("getmtime(%s)" % path)
-        return super(AbstractedQSFS, self).getmtime(path)
+        try:
+            return self.get_st_mtime(self.get_qstat(path))
+        except RequestError as err:
+            raise FilesystemError(err)
 
     def realpath(self, path):
         """Return the canonical version of path eliminating any symlinks
@@ -297,12 +2706,17 @@ class AbstractedQSFS(AbstractedFS):
 
     def lexists(self, path):
         logger.debug("lexists(%s)" % path)
-        return super(AbstractedQSFS, self).lexists(path)
+        try:
+            self.get_qstat(path)
+        except RequestError:
+            return False
+        return True
 
     def get_user_by_uid(self, uid):
         logger.debug("get_user_by_uid(%s)" % uid)
         try:
-            response = self.rc.users.list_user(uid)['name']
+            response = self.lookup_name(self.user_cache,
+                                        self.rc.users.list_user, uid)
         except RequestError:
             response = str(uid)
         logger.debug("get_user_by_uid returned " + str(response))
@@ -311,34 +2725,259 @@ class AbstractedQSFS(AbstractedFS):
     def get_group_by_gid(self, gid):
         logger.debug("get_group_by_gid(%s)" % gid)
         try:
-            response = self.rc.groups.list_group(gid)['name']
+            response = self.lookup_name(self.group_cache,
+                                        self.rc.groups.list_group, gid)
         except RequestError:
             response = str(gid)
         logger.debug("get_group_by_gid returned " + str(response))
         return response
 
+    def lookup_name(self, cache, lookup, auth_id):
+        """Resolve auth_id to a name through cache, remembering ids the
+        cluster doesn't know (common for AD-mapped ids) as negative entries
+        """
+        key = str(auth_id)
+        name = cache.get(key)
+        if name is None:
+            try:
+                name = lookup(auth_id)['name']
+            except RequestError, e:
+                # only a 404 says anything about the id, other errors
+                # (an expired session, a busy node) must not stick
+                if e.status_code == 404:
+                    cache.put_error(key, e)
+                raise
+            cache.put(key, name)
+        return name
+
     def get_list_dir(self, path):
+        """Same as AbstractedFS.get_list_dir() except that the listing is
+        streamed in directory order instead of being sorted, which would
+        mean reading the whole directory first
+        """
         logger.debug("get_list_dir(%s)" % path)
-        return super(AbstractedQSFS, self).get_list_dir(path)
+        assert isinstance(path, unicode), path
+        if self.isdir(path):
+            return self.format_list(path, self.listdir(path))
+        basedir, filename = os.path.split(path)
+        self.lstat(path)  # raise exc in case of problems
+        return self.format_list(basedir, [filename])
+
+    def get_list_tree(self, path, ordered=True, max_depth=None,
+                      max_entries=None):
+        """ls -lR output for path, read by a TreeWalk"""
+        logger.debug("get_list_tree(%s)" % path)
+        assert isinstance(path, unicode), path
+        if not self.isdir(path):
+            return self.get_list_dir(path)
+        walk = TreeWalk(self, path, TREE_WALK_CONCURRENCY, ordered,
+                        max_depth, max_entries)
+        return self.format_tree(walk, self.list_lines)
+
+    def get_tree_mlsx(self, path, perms, facts, ordered=False,
+                      max_depth=None, max_entries=None):
+        """MLSD style facts for everything below path, each line naming the
+        entry by its full path
+        """
+        logger.debug("get_tree_mlsx(%s, %s, %s)" % (path, perms, facts))
+        assert isinstance(path, unicode), path
+        walk = TreeWalk(self, path, TREE_WALK_CONCURRENCY, ordered,
+                        max_depth, max_entries)
+        format_page = self.mlsx_formatter(perms, facts)
+        return self.format_tree(walk, format_page, full_paths=True)
+
+    def format_tree(self, walk, format_page, full_paths=False):
+        """Run each directory a walk yields through format_page(), headed
+        like ls -R does unless the lines carry full paths
+        """
+        first = True
+        for path, entries in walk:
+            self.cache_entries(path, entries)
+            if full_paths:
+                names = [posixpath.join(path, entry['name'])
+                         for entry in entries]
+            else:
+                names = [entry['name'] for entry in entries]
+                header = u'%s:\r\n' % self.fs2ftp(path)
+                if not first:
+                    header = u'\r\n' + header
+                first = False
+                yield header.encode('utf8', self.cmd_channel.unicode_errors)
+            for page in iter_pages(zip(names, entries), LISTDIR_PAGE_SIZE):
+                yield ''.join(format_page(page))
+
+    def listing_pages(self, basedir, listing, ignore_err):
+        """Pages of (name, qstat) pairs for listing, taken straight from the
+        read_directory entries when it is a DirectoryListing
+        """
+        if isinstance(listing, DirectoryListing):
+            for entries in listing.pages:
+                yield [(entry['name'], entry) for entry in entries]
+            return
+        for page in iter_pages(listing, LISTDIR_PAGE_SIZE):
+            yield self.page_qstats(basedir, page, ignore_err)
+
+    def page_qstats(self, basedir, names, ignore_err):
+        """(name, qstat) for each name, skipping names that don't exist if
+        ignore_err
+        """
+        result = []
+        for name in names:
+            try:
+                result.append(
+                    (name, self.get_qstat(posixpath.join(basedir, name))))
+            except RequestError, e:
+                if not ignore_err:
+                    raise fs_error(e)
+        return result
 
     def format_list(self, basedir, listing, ignore_err=True):
-        logger.debug("format_list(%s, %s, %s)" %
-                     (basedir, listing, ignore_err))
-        return super(AbstractedQSFS, self).format_list(basedir,
-                                                       listing,
-                                                       ignore_err)
+        """Same lines as AbstractedFS.format_list(), but listing may be the
+        DirectoryListing listdir() returns, which is formatted a page at a
+        time
+        """
+        logger.debug("format_list(%s, %s)" % (basedir, ignore_err))
+        for entries in self.listing_pages(basedir, listing, ignore_err):
+            for line in self.list_lines(entries):
+                yield line
+
+    def list_lines(self, entries):
+        """Encoded ls -l lines for (name, qstat) pairs, matching proftpd's
+        format like pyftpdlib's do
+        """
+        if self.cmd_channel.use_gmt_times:
+            timefunc = time.gmtime
+        else:
+            timefunc = time.localtime
+        now = time.time()
+        lines = []
+        for name, qstat in entries:
+            st = self.qstat_to_stat_result(qstat)
+            mtime = timefunc(st.st_mtime)
+            # older than 6 months shows the year instead of the time
+            if (now - st.st_mtime) > 180 * 24 * 60 * 60:
+                fmtstr = "%d  %Y"
+            else:
+                fmtstr = "%d %H:%M"
+            try:
+                mtimestr = "%s %s" % (_months_map[mtime.tm_mon],
+                                      time.strftime(fmtstr, mtime))
+            except ValueError:
+                # before 1900, show the current time like pyftpdlib does
+                mtime = timefunc()
+                mtimestr = "%s %s" % (_months_map[mtime.tm_mon],
+                                      time.strftime("%d %H:%M", mtime))
+            line = "%s %3s %-8s %-8s %8s %s %s\r\n" % (
+                _filemode(st.st_mode), st.st_nlink or 1,
+                self.get_user_by_uid(st.st_uid),
+                self.get_group_by_gid(st.st_gid),
+                st.st_size, mtimestr, name)
+            lines.append(line.encode('utf8', self.cmd_channel.unicode_errors))
+        return lines
 
     def format_mlsx(self, basedir, listing, perms, facts, ignore_err=True):
-        logger.debug("format_mlsx(%s, %s, %s, %s, %s)" %
-                     (basedir, listing, perms, facts, ignore_err))
-        return super(AbstractedQSFS, self).format_mlsx(basedir,
-                                                       listing,
-                                                       perms,
-                                                       facts,
-                                                       ignore_err)
+        """Same facts as AbstractedFS.format_mlsx(), but taken straight from
+        the read_directory entries instead of from a stat_result per entry,
+        and yielded as one string per page of entries
+        """
+        logger.debug("format_mlsx(%s, %s, %s, %s)" %
+                     (basedir, perms, facts, ignore_err))
+        assert isinstance(basedir, unicode), basedir
+        format_page = self.mlsx_formatter(perms, facts)
+        for entries in self.listing_pages(basedir, listing, ignore_err):
+            if entries:
+                yield ''.join(format_page(entries))
+
+    def mlsx_formatter(self, perms, facts):
+        """Return a function formatting a page of (name, qstat) pairs into
+        encoded MLSD lines with the given perms and facts
+        """
+        permdir = ''.join([x for x in perms if x not in 'arw'])
+        permfile = ''.join([x for x in perms if x not in 'celmp'])
+        if ('w' in perms) or ('a' in perms) or ('f' in perms):
+            permdir += 'c'
+        if 'd' in perms:
+            permdir += 'p'
+        perm = {True: permdir, False: permfile}
+        facts = frozenset(facts)
+        times = {}  # siblings mostly share a handful of timestamps
+
+        def format_page(entries):
+            lines = []
+            for name, qstat in entries:
+                retfacts = self.mlsx_facts(qstat, name, facts, perm, times)
+                factstring = "".join(["%s=%s;" % (x, retfacts[x])
+                                      for x in sorted(retfacts)])
+                lines.append(("%s %s\r\n" % (factstring, name)).encode(
+                    'utf8', self.cmd_channel.unicode_errors))
+            return lines
+        return format_page
+
+    def mlsx_facts(self, qstat, basename, facts, perm, times):
+        """RFC 3659 facts for one qstat. perm maps isdir to the perm fact,
+        times memoizes formatted timestamps
+        """
+        retfacts = {}
+        isdir = qstat['type'] == u'FS_FILE_TYPE_DIRECTORY'
+        if 'type' in facts:
+            if not isdir:
+                retfacts['type'] = 'file'
+            elif basename == '.':
+                retfacts['type'] = 'cdir'
+            elif basename == '..':
+                retfacts['type'] = 'pdir'
+            else:
+                retfacts['type'] = 'dir'
+        if 'perm' in facts:
+            retfacts['perm'] = perm[isdir]
+        if 'size' in facts:
+            retfacts['size'] = qstat['size']
+        for fact, field in (('modify', 'modification_time'),
+                            ('create', 'creation_time')):
+            if fact in facts:
+                value = self.mlsx_time(qstat, field, times)
+                if value is not None:  # strftime() refuses years before 1900
+                    retfacts[fact] = value
+        if 'unix.mode' in facts:
+            retfacts['unix.mode'] = oct(int(qstat['mode'], 8) & 0777)
+        if 'unix.uid' in facts:
+            retfacts['unix.uid'] = qstat['owner']
+        if 'unix.gid' in facts:
+            retfacts['unix.gid'] = qstat['group']
+        if 'unique' in facts:
+            # file numbers are unique cluster-wide, no device to mix in
+            retfacts['unique'] = '%x' % int(qstat['file_number'])
+        return retfacts
+
+    def mlsx_time(self, qstat, field, times):
+        epoch_ns = self.get_epoch_ns(qstat, field)
+        if epoch_ns not in times:
+            if self.cmd_channel.use_gmt_times:
+                timefunc = time.gmtime
+            else:
+                timefunc = time.localtime
+            seconds = int(self.epoch_ns_to_seconds(epoch_ns))
+            try:
+                times[epoch_ns] = time.strftime("%Y%m%d%H%M%S",
+                                                timefunc(seconds))
+            except ValueError:
+                times[epoch_ns] = None
+        return times[epoch_ns]
 
     def convert_timestamp_to_epoch_seconds(self, timestamp):
-        return (dateutil.parser.parse(timestamp) - EPOCH).total_seconds()
+        return self.epoch_ns_to_seconds(timestamp_to_epoch_ns(timestamp))
+
+    def epoch_ns_to_seconds(self, epoch_ns):
+        # microsecond precision, same as the datetime arithmetic this replaced
+        return (epoch_ns // 1000) / 1e6
+
+    def get_epoch_ns(self, qstat, field):
+        """Nanosecond timestamp for field, parsing and storing all of the
+        qstat's timestamps the first time one is asked for
+        """
+        if 'epoch_ns' not in qstat:
+            add_epoch_times([qstat])
+        return qstat['epoch_ns'][field]
 
     def get_st_mode(self, qstat):
         """return an integer compatible with st_mode from a stat() call"""
@@ -375,28 +3014,187 @@ class AbstractedQSFS(AbstractedFS):
 
     def get_st_atime(self, qstat):
         # posix stat call ignores ms
-        return int(self.convert_timestamp_to_epoch_seconds(
-            qstat['change_time'])
+        return int(self.epoch_ns_to_seconds(
+            self.get_epoch_ns(qstat, 'change_time'))
         )
 
     def get_st_mtime(self, qstat):
-        return int(self.convert_timestamp_to_epoch_seconds(
-            qstat['modification_time'])
+        return int(self.epoch_ns_to_seconds(
+            self.get_epoch_ns(qstat, 'modification_time'))
         )
 
     def get_st_ctime(self, qstat):
-        return int(self.convert_timestamp_to_epoch_seconds(
-            qstat['creation_time'])
+        return int(self.epoch_ns_to_seconds(
+            self.get_epoch_ns(qstat, 'creation_time'))
         )
 
 
+class AdminClientPool(object):
+    """Long-lived admin RestClients shared by every session, so admin
+    lookups reuse a logged in client instead of logging in each time. A call
+    that fails because the admin session expired logs in again and retries
+    """
+    def __init__(self, size):
+        self.size = size
+        self.clients = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.clients.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.clients.get()
+        try:
+            return get_rc()
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, rc):
+        self.clients.put(rc)
+
+    def call(self, function, *args, **kwargs):
+        """Run function(rc, *args, **kwargs) with a pooled admin client"""
+        rc = self.acquire()
+        try:
+            try:
+                return function(rc, *args, **kwargs)
+            except RequestError, e:
+                if e.status_code != 401:
+                    raise
+                logger.debug("admin session expired, logging in again")
+                rc.login(API_USER, API_PASS)
+                return function(rc, *args, **kwargs)
+        finally:
+            self.release(rc)
+
+
+class ClusterCache(object):
+    """Cluster name, version and user names, which almost never change,
+    reloaded by a background thread so the login path only reads memory
+    """
+    def __init__(self, pool, refresh_interval):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.banner = None
+        self.user_names = set()
+        self.refreshed = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def refresh(self):
+        conf = self.pool.call(lambda rc: rc.cluster.get_cluster_conf())
+        version = self.pool.call(lambda rc: rc.version.version())
+        users = self.pool.call(lambda rc: rc.users.list_users())
+        self.banner = (conf[u'cluster_name'], version['revision_id'])
+        self.update_users(users)
+        self.refreshed = time.time()
+
+    def update_users(self, users):
+        """Apply only the differences to the existing name set, and keep
+        the uid -> name cache used by listings warm while we're at it
+        """
+        names = set()
+        for user in users:
+            names.add(user['name'])
+            AbstractedQSFS.user_cache.put(str(user['id']), user['name'])
+        with self.lock:
+            added = names - self.user_names
+            removed = self.user_names - names
+            self.user_names.difference_update(removed)
+            self.user_names.update(added)
+        if added or removed:
+            logger.debug("user directory: %d added, %d removed" %
+                         (len(added), len(removed)))
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+                self.pool.call(refresh_nodes)
+            except Exception, e:
+                logger.warn("Couldn't refresh cluster cache: %s" % e)
+
+    def start(self):
+        """Load everything once, then keep it fresh from a daemon thread"""
+        if self.thread is not None:
+            return
+        self.refresh()
+        self.thread = threading.Thread(target=self.refresh_forever,
+                                       name='qftpd-cluster-cache')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_banner(self):
+        if self.banner is None:
+            self.refresh()
+        return self.banner
+
+    def has_user(self, username):
+        if not self.refreshed:
+            self.refresh()
+        if username in self.user_names:
+            return True
+        # maybe a brand new user, but don't let unknown names hammer the API
+        if time.time() - self.refreshed >= CLUSTER_CACHE_MISS_REFRESH:
+            self.refresh()
+        return username in self.user_names
+
+
 class QSFSAuthorizer(DummyAuthorizer):
     """We need a wedge that attempts authentication with the Qumulo API and
     allows a user in based on their credentials
     """
+    # logged in credentials keyed by a salted HMAC of username and password,
+    # shared by every session so reconnects within the TTL skip the login
+    session_cache = TTLCache(SESSION_CACHE_TTL, SESSION_CACHE_SIZE)
+    session_salt = os.urandom(32)
+    admin_pool = AdminClientPool(ADMIN_POOL_SIZE)
+    cluster_cache = ClusterCache(admin_pool, CLUSTER_CACHE_REFRESH)
+
     def __init__(self):
         super(QSFSAuthorizer, self).__init__()
-        self.rc = RestClient(API_HOST, API_PORT)
+
+    def session_key(self, username, password):
+        """The plain password never goes into the cache, only a keyed hash
+        of it that can't be checked without the per-process salt
+        """
+        secret = u'%s\0%s' % (username, password)
+        return hmac.new(self.session_salt, secret.encode('utf8'),
+                        hashlib.sha256).hexdigest()
+
+    def login(self, username, password):
+        """Return credentials for username, logging in with the REST API
+        only if there is no live session for the same username and password
+        """
+        key = self.session_key(username, password)
+        credentials = self.session_cache.get(key)
+        if credentials is None:
+            logger.debug("session cache miss for %s, logging in" % username)
+            local_rc = make_rest_client()
+            local_rc.login(username, password)
+            credentials = local_rc.credentials
+            self.session_cache.put(key, credentials)
+        return credentials
+
+    def logout(self, username, password):
+        self.session_cache.invalidate(self.session_key(username, password))
+
+    def relogin(self, username, password):
+        """Fresh credentials for a session the cluster has expired, which
+        also replace the dead ones in the session cache
+        """
+        self.logout(username, password)
+        return self.login(username, password)
 
     def add_user(self, username, password, homedir, perm='elr',
                  msg_login="Login successful.", msg_quit="Goodbye."):
@@ -425,24 +3223,29 @@ class QSFSAuthorizer(DummyAuthorizer):
         """
         logger.debug("validate_authentication(%s, %s, handler)" %
                      (username, password))
-        # attempt login with restclient
+        # attempt login with restclient, failures are never cached
         try:
-            self.rc.login(username, password)
+            if hasattr(handler, 'run_prepared'):
+                # a worker thread may have made this login for the handler
+                handler.run_prepared(self.login, username, password)
+            else:
+                self.login(username, password)
         except RequestError:
+            metrics.inc('qftpd_logins_total', (('result', 'failed'),))
             raise AuthenticationFailed
+        metrics.inc('qftpd_logins_total', (('result', 'ok'),))
 
     def get_home_dir(self, username):
         logger.debug("get_home_dir() will return '/' for all users")
         return u'/'
 
     def impersonate_user(self, username, password):
-        """This should probably return a RestClient assuming it gets called
-        after login
+        """Return a RestClient for the user, reusing the session that
+        validate_authentication() just logged in
         """
         logger.debug("impersonate_user() returning RestClient")
-        local_rc = RestClient(API_HOST, API_PORT)
-        local_rc.login(username, password)
-        return local_rc
+        return make_rest_client(self.login(username, password),
+                                lambda: self.relogin(username, password))
 
     def terminate_impersonation(self, username):
         """This should kill off the restclient created when impersonating the
@@ -452,26 +3255,22 @@ class QSFSAuthorizer(DummyAuthorizer):
 
     def has_user(self, username):
         logger.debug("has_user(%s)" % username)
-        local_rc = RestClient(API_HOST, API_PORT)
-        local_rc.login(API_USER, API_PASS)
-        response = local_rc.users.list_users()
-        name_list = [user['name'] for user in response]
-        return username in name_list
+        return self.cluster_cache.has_user(username)
 
     def has_perm(self, username, perm, path=None):
         logger.debug("has_perm() will always return True")
         return True
 
     def get_perms(self, username):
-        logger.debug("NOT IMPLEMENTED get_perms()")
-        super(QSFSAuthorizer, self).get_perms(username)
+        """Everything, like has_perm(); the cluster enforces permissions on
+        each REST call
+        """
+        logger.debug("get_perms() will return every permission")
+        return self.read_perms + self.write_perms
 
     def get_msg_login(self, username):
         logger.debug("get_msg_login() returns the same message for everyone")
-        admin_rc = get_rc()
-        response = admin_rc.cluster.get_cluster_conf()
-        cluster_name = response[u'cluster_name']
-        version = self.rc.version.version()['revision_id']
+        cluster_name, version = self.cluster_cache.get_banner()
         return u"Welcome to qftpd on %s (%s)" % (cluster_name, version)
 
     def get_msg_quit(self, username):
@@ -487,7 +3286,720 @@ class QSFSAuthorizer(DummyAuthorizer):
         super(QSFSAuthorizer, self)._issubpath(a, b)
 
 
+def collect_cache_stats():
+    samples = []
+    for name, cache in (('attr', AbstractedQSFS.attr_cache),
+                        ('id', AbstractedQSFS.id_cache),
+                        ('user', AbstractedQSFS.user_cache),
+                        ('group', AbstractedQSFS.group_cache),
+                        ('session', QSFSAuthorizer.session_cache)):
+        stats = cache.stats()
+        labels = (('cache', name),)
+        lookups = stats['hits'] + stats['misses']
+        samples.extend([
+            ('qftpd_cache_hits_total', labels, stats['hits']),
+            ('qftpd_cache_misses_total', labels, stats['misses']),
+            ('qftpd_cache_hit_ratio', labels,
+             float(stats['hits']) / lookups if lookups else 0.0),
+            ('qftpd_cache_entries', labels, stats['size'])])
+    return samples
+
+
+def collect_node_stats():
+    samples = []
+    for host, stats in node_balancer.stats().items():
+        labels = (('node', host),)
+        samples.extend([
+            ('qftpd_node_requests_in_flight', labels, stats['in_flight']),
+            ('qftpd_node_latency_seconds', labels, stats['latency']),
+            ('qftpd_node_ejected', labels, int(stats['ejected']))])
+    return samples
+
+
+def collect_buffer_stats():
+    stats = buffer_budget.stats()
+    samples = [('qftpd_buffer_bytes_in_use', (), stats['used']),
+               ('qftpd_buffer_bytes_peak', (), stats['peak'])]
+    if stats['limit'] is not None:
+        samples.append(('qftpd_buffer_bytes_limit', (), stats['limit']))
+    return samples
+
+
+def collect_scheduler_stats():
+    stats = rest_scheduler.stats()
+    samples = []
+    for bulk in (False, True):
+        labels = (('class', 'bulk' if bulk else 'metadata'),)
+        samples.extend([
+            ('qftpd_rest_in_flight', labels, stats['in_flight'][bulk]),
+            ('qftpd_rest_queued', labels, stats['queued'][bulk])])
+    return samples
+
+metrics.add_collector(collect_cache_stats)
+metrics.add_collector(collect_node_stats)
+metrics.add_collector(collect_buffer_stats)
+metrics.add_collector(collect_scheduler_stats)
+
+
+def prime(generator):
+    """Pull the first item out of generator now, so whatever blocking call
+    produces it happens here, and return an iterator over everything
+    """
+    try:
+        first = next(generator)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], generator)
+
+
+class Waker(object):
+    """The read end of a socketpair registered with the IOLoop. Writing a
+    byte to the other end from any thread wakes the loop up to run callback
+    """
+    def __init__(self, ioloop, callback):
+        self.ioloop = ioloop
+        self.callback = callback
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self._fileno = self.reader.fileno()  # IOLoop.close() sorts on this
+        ioloop.register(self._fileno, self, ioloop.READ)
+
+    def wake(self):
+        try:
+            self.writer.send('x')
+        except socket.error:
+            pass  # socket buffer is full, the loop has wakeups pending
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            while self.reader.recv(4096):
+                pass
+        except socket.error:
+            pass
+        self.callback()
+
+    def handle_error(self):
+        logger.exception("unhandled exception running IOLoop callbacks")
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.ioloop.unregister(self._fileno)
+        self.reader.close()
+        self.writer.close()
+
+
+class IOLoopExecutor(object):
+    """A fixed pool of worker threads for blocking REST calls. Each task's
+    callback is handed back to the IOLoop thread, so callbacks can touch
+    channels like any other IOLoop code
+    """
+    def __init__(self, num_threads, ioloop):
+        self.tasks = Queue.Queue()
+        self.callbacks = deque()
+        self.local = threading.local()
+        self.waker = Waker(ioloop, self.run_callbacks)
+        self.loop_thread = threading.current_thread().ident
+        self.threads = []
+        for i in range(num_threads):
+            thread = threading.Thread(target=self.work,
+                                      name='qftpd-worker-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def in_worker(self):
+        return getattr(self.local, 'worker', False)
+
+    def in_loop(self):
+        return threading.current_thread().ident == self.loop_thread
+
+    def submit(self, function, callback):
+        """Run function() in a worker, then callback(result, exc_info) on
+        the IOLoop. exc_info is None unless function() raised
+        """
+        self.tasks.put((function, callback))
+
+    def call_soon(self, function, *args):
+        """Run function(*args) on the IOLoop, callable from any thread"""
+        self.callbacks.append((function, args))
+        self.waker.wake()
+
+    def work(self):
+        self.local.worker = True
+        while True:
+            function, callback = self.tasks.get()
+            try:
+                result, error = function(), None
+            except Exception:
+                result, error = None, sys.exc_info()
+            self.call_soon(callback, result, error)
+
+    def run_callbacks(self):
+        self.loop_thread = threading.current_thread().ident
+        while self.callbacks:
+            function, args = self.callbacks.popleft()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("unhandled exception in IOLoop callback")
+
+
+class WorkerProducer(object):
+    """BufferedIteratorProducer for iterators that make REST calls as they
+    go, like a listing paging in its entries. Each batch of lines is pulled
+    in a worker while the data channel waits for it, and the session's
+    commands wait too, since they would share its RestClient
+    """
+    loops = LISTDIR_PAGE_SIZE
+
+    def __init__(self, iterator, cmd_channel):
+        self.iterator = iterator
+        self.cmd_channel = cmd_channel
+        self.batch = None  # lines pulled and not sent yet
+        self.error = None
+        self.pulling = False
+        self.waker = None  # set by the data channel waiting on a batch
+
+    def buffer_ready(self, size):
+        if self.batch is not None or self.error is not None:
+            return True
+        if not self.pulling:
+            self.pull()
+        return False
+
+    def pull(self):
+        cmd_channel = self.cmd_channel
+        self.pulling = True
+        cmd_channel.busy = True
+
+        def done(result, error):
+            self.pulling = False
+            self.batch, self.error = result, error
+            cmd_channel.busy = False
+            if self.waker is not None:
+                self.waker()
+            cmd_channel.process_pending_lines()
+        cmd_channel.executor.submit(
+            lambda: tracer.run(cmd_channel.trace, list,
+                               itertools.islice(self.iterator, self.loops)),
+            done)
+
+    def more(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        if self.batch is None:  # not asked for through buffer_ready()
+            return ''.join(itertools.islice(self.iterator, self.loops))
+        batch, self.batch = self.batch, None
+        return ''.join(batch)
+
+
+class QDTPHandler(DTPHandler):
+    """DTPHandler.close() replies before closing the file. For an upload,
+    closing is what writes the last ranges to QSFS, so close it first: 226
+    then means the whole file is on the cluster, and a failed write gets an
+    error reply instead. On the IOLoop that close runs in a worker.
+
+    Before each read from or write to the client, the file object, or the
+    producer of a listing, has to find buffer space or data for it. When it
+    can't, the channel stops polling like ThrottledDTPHandler does and TCP
+    holds the client back, until it retries or the source wakes it up
+    """
+    def __init__(self, sock, cmd_channel):
+        DTPHandler.__init__(self, sock, cmd_channel)
+        self.paused = None  # the call_later() that will retry
+        self.closing = False  # the upload's file is closing in a worker
+
+    def buffer_ready(self):
+        if self.paused is not None:
+            return False
+        source = self.file_obj
+        if source is None and self.producer_fifo:
+            source = self.producer_fifo[0]
+        if not hasattr(source, 'buffer_ready'):
+            return True
+        if getattr(source, 'waker', False) is None and on_ioloop():
+            source.waker = self.wake_soon
+        if source.buffer_ready(self.ac_in_buffer_size):
+            return True
+        metrics.inc('qftpd_buffer_waits_total')
+        self.del_channel()
+        self.paused = self.ioloop.call_later(
+            BUFFER_WAIT_INTERVAL, self.resume, _errback=self.handle_error)
+        return False
+
+    def resume(self):
+        self.paused = None
+        if not self._closed and not self.closing:
+            self.add_channel(events=self.ioloop.READ if self.receive
+                             else self.ioloop.WRITE)
+
+    def wake(self):
+        """Retry now rather than at the next interval"""
+        if self.paused is not None:
+            self.paused.cancel()
+            self.resume()
+
+    def wake_soon(self):
+        """wake() from any thread"""
+        self.cmd_channel.executor.call_soon(self.wake)
+
+    def handle_read(self):
+        if not self.receive or self.buffer_ready():
+            DTPHandler.handle_read(self)
+
+    handle_read_event = handle_read
+
+    def initiate_send(self):
+        if self.receive or self.buffer_ready():
+            DTPHandler.initiate_send(self)
+
+    def close(self):
+        if self.paused is not None and not self.paused.cancelled:
+            self.paused.cancel()
+        if self.closing:
+            return
+        if (not self._closed and self.receive and self.file_obj is not None
+                and not self.file_obj.closed):
+            if on_ioloop():
+                self.close_file()
+                return
+            try:
+                self.file_obj.close()
+            except (OSError, FilesystemError):
+                self.file_failed(sys.exc_info()[1])
+        if not self._closed:
+            if self.receive:
+                metrics.inc('qftpd_transfer_bytes_total',
+                            (('direction', 'in'),), self.tot_bytes_received)
+            else:
+                metrics.inc('qftpd_transfer_bytes_total',
+                            (('direction', 'out'),), self.tot_bytes_sent)
+        DTPHandler.close(self)
+        self.cmd_channel.transfer_done()
+
+    def file_failed(self, err):
+        self.transfer_finished = False
+        if self._resp:
+            self._resp = ("451 %s." % _strerror(err), logger.error)
+
+    def close_file(self):
+        """Close the upload's file in a worker, where it writes its last
+        ranges, and finish closing the channel back on the IOLoop
+        """
+        self.closing = True
+        self.del_channel()
+
+        def done(result, error):
+            self.closing = False
+            if error is not None:
+                if not isinstance(error[1], (OSError, FilesystemError)):
+                    logger.error("closing %s failed" % self.file_obj.name,
+                                 exc_info=error)
+                self.file_failed(error[1])
+            if self.cmd_channel._closed:
+                self._resp = None  # nobody left to reply to
+            self.close()
+        self.cmd_channel.executor.submit(self.file_obj.close, done)
+
+
 class QFTPHandler(FTPHandler):
+    # file data is streamed from the REST API, there is no local fd to hand
+    # to sendfile(2)
+    use_sendfile = False
+    dtp_handler = QDTPHandler
+    proto_cmds = dict(FTPHandler.proto_cmds)
+    # perm=None keeps pre_process_command() from treating both paths as one
+    proto_cmds['SITE COPY'] = dict(
+        perm=None, auth=True, arg=True,
+        help='Syntax: SITE <SP> COPY <SP> source <SP> destination '
+             '(server-side file copy).')
+    proto_cmds['SITE TREE'] = dict(
+        perm=None, auth=True, arg=None,
+        help='Syntax: SITE <SP> TREE [<SP> -s] [<SP> -d depth] '
+             '[<SP> -n entries] [<SP> path] (recursive MLSD, -s sorted).')
+    # set by main() to keep blocking REST calls off the IOLoop, when None
+    # every command runs on the IOLoop
+    executor = None
+    # commands that run start to finish in a worker thread, their responses
+    # are pushed from the IOLoop
+    worker_cmds = frozenset(['CWD', 'XCWD', 'CDUP', 'XCUP', 'MKD', 'XMKD',
+                             'RMD', 'XRMD', 'DELE', 'RNFR', 'RNTO', 'SIZE',
+                             'MDTM', 'MLST', 'SITE CHMOD', 'SITE COPY'])
+    # commands that drive the data channel or login state, so they run on
+    # the IOLoop after prepare_command() made their REST calls in a worker
+    prepared_cmds = frozenset(['PASS', 'RETR', 'STOR', 'APPE', 'LIST',
+                               'NLST', 'MLSD', 'SITE TREE'])
+
+    def __init__(self, conn, server, ioloop=None):
+        FTPHandler.__init__(self, conn, server, ioloop)
+        self.busy = False  # a command is out in a worker thread
+        # format_mlsx() has every fact on hand whatever the local platform
+        for fact in ('unique', 'unix.mode', 'unix.uid', 'unix.gid',
+                     'create'):
+            if fact not in self._available_facts:
+                self._available_facts.append(fact)
+        self.pending_lines = []
+        self.prepared = {}
+        self.list_recursive = False  # LIST -R
+        self.share = None  # where the scheduler queues our REST calls
+        self.trace = None
+        if tracer.enabled():
+            self.trace = SessionTrace('session %s:%s' % (self.remote_ip,
+                                                         self.remote_port))
+        if not self._closed:
+            metrics.inc('qftpd_sessions_active')
+
+    def found_terminator(self):
+        """Commands that arrive while one is running in a worker wait their
+        turn, so a session's commands still run one at a time and in order
+        """
+        if self.busy:
+            self.pending_lines.append(''.join(self._in_buffer))
+            self._in_buffer = []
+            self._in_buffer_len = 0
+            return
+        FTPHandler.found_terminator(self)
+
+    def process_pending_lines(self):
+        partial = self._in_buffer, self._in_buffer_len
+        while self.pending_lines and not self.busy and not self._closed:
+            self._in_buffer = [self.pending_lines.pop(0)]
+            FTPHandler.found_terminator(self)
+        self._in_buffer, self._in_buffer_len = partial
+
+    def transfer_active(self):
+        """A running or queued transfer may use this session's RestClient
+        from the IOLoop at any time, so nothing else may use it from a worker
+        """
+        if self._closed:
+            return False  # close() let go of the data channel and queues
+        return (self._in_dtp_queue is not None or
+                self._out_dtp_queue is not None or
+                (self.data_channel is not None and
+                 self.data_channel.cmd is not None))
+
+    def process_command(self, cmd, *args, **kwargs):
+        start = time.time()
+        if ((cmd in self.worker_cmds or cmd in self.prepared_cmds) and
+                REST_CONCURRENCY is not None and
+                rest_scheduler.overloaded()):
+            self.shed(cmd)
+            return
+        if self.trace is not None:
+            self.trace.begin(cmd, '******' if cmd == 'PASS' else args[0])
+        if (self.executor is None or self.executor.in_worker() or
+                self.transfer_active()):
+            try:
+                tracer.run(self.trace, FTPHandler.process_command, self, cmd,
+                           *args, **kwargs)
+            finally:
+                self.command_done(cmd, start)
+        elif cmd in self.worker_cmds:
+            self.offload(cmd, start, lambda: FTPHandler.process_command(
+                self, cmd, *args, **kwargs))
+        elif cmd in self.prepared_cmds:
+            self.offload(cmd, start,
+                         lambda: self.prepare_command(cmd, args[0]),
+                         lambda: FTPHandler.process_command(
+                             self, cmd, *args, **kwargs))
+        else:
+            try:
+                tracer.run(self.trace, FTPHandler.process_command, self, cmd,
+                           *args, **kwargs)
+            finally:
+                self.command_done(cmd, start)
+
+    def shed(self, cmd):
+        """Turn the command away, and the session with it, rather than
+        queue it behind a backlog of REST calls it would only add to
+        """
+        metrics.inc('qftpd_commands_shed_total', (('command', cmd),))
+        self.log("REST queue is full, refusing %s" % cmd, logfun=logger.warn)
+        self.respond("421 Server busy, try again later.")
+        self.close_when_done()
+
+    def command_done(self, cmd, start):
+        metrics.observe('qftpd_command_seconds', (('command', cmd),),
+                        time.time() - start)
+        if self.trace is not None:
+            self.trace.end(transferring=self.transfer_active())
+
+    def transfer_done(self):
+        if self.trace is not None:
+            self.trace.end_transfer()
+
+    def offload(self, cmd, start, work, then=None):
+        """Run work() in a worker, then then() on the IOLoop, holding back
+        further commands from the client until both are done
+        """
+        self.busy = True
+
+        def done(result, error):
+            self.busy = False
+            try:
+                if not self._closed:
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    if then is not None:
+                        tracer.run(self.trace, then)
+            except Exception:
+                self.handle_error()
+            finally:
+                self.discard_prepared()
+                self.command_done(cmd, start)
+            self.process_pending_lines()
+        self.executor.submit(lambda: tracer.run(self.trace, work), done)
+
+    def prepare_command(self, cmd, arg):
+        """Make the blocking REST calls cmd is about to make, from a worker
+        thread, leaving their results for run_prepared()
+        """
+        if cmd == 'PASS':
+            if self.username and not self.authenticated:
+                self.prepare(self.authorizer.login, self.username, arg)
+        elif cmd == 'RETR':
+            self.prepare(self.fs.open, arg, 'rb')
+        elif cmd == 'STOR':
+            self.prepare(self.fs.open, arg,
+                         'r+b' if self._restart_position else 'wb')
+        elif cmd == 'APPE':
+            self.prepare(self.fs.open, arg, 'ab')
+        elif cmd == 'LIST':
+            if self.list_recursive:
+                self.prepare(self.fs.get_list_tree, arg, True,
+                             TREE_WALK_MAX_DEPTH, TREE_WALK_MAX_ENTRIES)
+            else:
+                self.prepare(self.fs.get_list_dir, arg)
+        elif cmd == 'SITE TREE':
+            try:
+                args = self.parse_tree_args(arg)
+            except ValueError:
+                return
+            self.prepare(self.fs.get_tree_mlsx, *args)
+        elif self.fs.isdir(arg):  # NLST, MLSD
+            self.prepare(self.fs.listdir, arg)
+
+    def prepare(self, function, *args):
+        """Call function(*args) and keep the outcome. Generators and
+        DirectoryListings get their first item pulled too, which for a
+        listing is the first REST page
+        """
+        try:
+            if self.authenticated:
+                result = self.run_as_current_user(function, *args)
+            else:
+                result = function(*args)
+            if isinstance(result, types.GeneratorType):
+                result = prime(result)
+            elif isinstance(result, DirectoryListing):
+                result = DirectoryListing(prime(result.pages))
+            outcome = (result, None)
+        except Exception:
+            outcome = (None, sys.exc_info())
+        self.prepared[(function.__name__, args)] = outcome
+
+    def run_prepared(self, function, *args):
+        """Return or raise what prepare() got from function(*args) for the
+        current command, or call it now if it wasn't prepared
+        """
+        key = (function.__name__, args)
+        if key not in self.prepared:
+            return function(*args)
+        result, error = self.prepared.pop(key)
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return result
+
+    def discard_prepared(self):
+        """Close anything prepared that the command didn't end up using"""
+        for result, error in self.prepared.values():
+            if hasattr(result, 'close'):
+                result.close()
+        self.prepared.clear()
+
+    def push(self, data):
+        if self.executor is not None and self.executor.in_worker():
+            self.executor.call_soon(self.push_from_worker, data)
+        else:
+            FTPHandler.push(self, data)
+
+    def push_from_worker(self, data):
+        if not self._closed:
+            FTPHandler.push(self, data)
+
+    def push_dtp_data(self, data, isproducer=False, file=None, cmd=None):
+        """Listings page in their entries as they are sent, so their
+        producers pull from the listing in a worker instead of on the IOLoop
+        """
+        if (isproducer and self.executor is not None and
+                isinstance(data, BufferedIteratorProducer)):
+            data = WorkerProducer(data.iterator, self)
+        FTPHandler.push_dtp_data(self, data, isproducer, file, cmd)
+
+    def _on_dtp_close(self):
+        # an upload's file may finish closing after the session did
+        if not self._closed:
+            FTPHandler._on_dtp_close(self)
+
+    def ftp_NLST(self, path):
+        """Same as FTPHandler.ftp_NLST() except that names are streamed to
+        the data channel as listdir() pages them in, rather than sorted and
+        joined into one string
+        """
+        try:
+            if self.fs.isdir(path):
+                listing = self.run_as_current_user(self.fs.listdir, path)
+            else:
+                # if path is a file we just list its name
+                self.fs.lstat(path)  # raise exc in case of problems
+                listing = [os.path.basename(path)]
+        except (OSError, FilesystemError):
+            err = sys.exc_info()[1]
+            self.respond('550 %s.' % _strerror(err))
+        else:
+            iterator = (name.encode('utf8', self.unicode_errors) + '\r\n'
+                        for name in listing)
+            producer = BufferedIteratorProducer(iterator)
+            self.push_dtp_data(producer, isproducer=True, cmd="NLST")
+            return path
+
+    def pre_process_command(self, line, cmd, arg):
+        """Take the options out of LIST -R (or -lR, -alR ...) before
+        pyftpdlib mistakes them for a path
+        """
+        self.list_recursive = False
+        if cmd == 'LIST' and arg:
+            words = arg.split(' ')
+            options = ''
+            while words and words[0].startswith('-'):
+                options += words.pop(0)[1:]
+            if 'R' in options:
+                self.list_recursive = True
+                arg = ' '.join(words)
+        FTPHandler.pre_process_command(self, line, cmd, arg)
+
+    def ftp_LIST(self, path):
+        """FTPHandler.ftp_LIST(), or a recursive listing for LIST -R"""
+        if not self.list_recursive:
+            return FTPHandler.ftp_LIST(self, path)
+        try:
+            iterator = self.run_as_current_user(
+                self.fs.get_list_tree, path, True, TREE_WALK_MAX_DEPTH,
+                TREE_WALK_MAX_ENTRIES)
+        except (OSError, FilesystemError):
+            err = sys.exc_info()[1]
+            self.respond('550 %s.' % _strerror(err))
+        else:
+            producer = BufferedIteratorProducer(iterator)
+            self.push_dtp_data(producer, isproducer=True, cmd="LIST")
+            return path
+
+    def parse_tree_args(self, line):
+        """SITE TREE arguments as get_tree_mlsx() arguments, raising
+        ValueError if they don't parse
+        """
+        words = [word.decode('utf8')
+                 for word in shlex.split(line.encode('utf8'))]
+        ordered = False
+        max_depth = TREE_WALK_MAX_DEPTH
+        max_entries = TREE_WALK_MAX_ENTRIES
+        while words and words[0].startswith('-'):
+            option = words.pop(0)
+            if option == '-s':
+                ordered = True
+            elif option == '-d' and words:
+                max_depth = int(words.pop(0))
+            elif option == '-n' and words:
+                limit = int(words.pop(0))
+                if max_entries is None or limit < max_entries:
+                    max_entries = limit
+            else:
+                raise ValueError(option)
+        if len(words) > 1:
+            raise ValueError(line)
+        path = self.fs.ftp2fs(words[0] if words else self.fs.cwd)
+        perms = self.authorizer.get_perms(self.username)
+        return (path, perms, tuple(self._current_facts), ordered, max_depth,
+                max_entries)
+
+    def ftp_SITE_TREE(self, line):
+        """Facts for everything below a directory, on the data channel like
+        MLSD, one line per entry named by its full path
+        """
+        try:
+            args = self.parse_tree_args(line)
+        except ValueError:
+            self.respond("501 Syntax error: " +
+                         self.proto_cmds['SITE TREE']['help'])
+            return
+        path = args[0]
+        if not self.fs.validpath(path):
+            self.respond('550 "%s" points to a path which is outside '
+                         "the user's root directory." % self.fs.fs2ftp(path))
+            return
+        try:
+            if not self.run_as_current_user(self.fs.isdir, path):
+                self.respond("501 No such directory.")
+                return
+            iterator = self.run_as_current_user(self.fs.get_tree_mlsx, *args)
+        except (OSError, FilesystemError):
+            err = sys.exc_info()[1]
+            self.respond('550 %s.' % _strerror(err))
+        else:
+            producer = BufferedIteratorProducer(iterator)
+            self.push_dtp_data(producer, isproducer=True, cmd="SITE TREE")
+            return path
+
+    def ftp_SITE_COPY(self, line):
+        """Copy a file to a new path on the cluster. Paths containing
+        spaces can be double quoted
+        """
+        try:
+            paths = [p.decode('utf8')
+                     for p in shlex.split(line.encode('utf8'))]
+        except ValueError:
+            paths = []
+        if len(paths) != 2:
+            self.respond("501 Syntax error: command needs two arguments.")
+            return
+        src, dst = [self.fs.ftp2fs(path) for path in paths]
+        for path in (src, dst):
+            if not self.fs.validpath(path):
+                self.respond('550 "%s" points to a path which is outside '
+                             "the user's root directory." %
+                             self.fs.fs2ftp(path))
+                return
+        try:
+            self.run_as_current_user(self.fs.copy, src, dst)
+        except (OSError, FilesystemError):
+            err = sys.exc_info()[1]
+            self.respond('550 %s.' % _strerror(err))
+        else:
+            self.respond("250 Copy successful.")
+            return (src, dst)
+
+    def close(self):
+        if not self._closed:
+            metrics.inc('qftpd_sessions_active', value=-1)
+        FTPHandler.close(self)
+        self.transfer_done()  # one that never got its data connection
+
+    def on_logout(self, username):
+        logger.info("attribute cache stats: %s" %
+                    AbstractedQSFS.attr_cache.stats())
+        logger.info("identity cache stats: users %s, groups %s" %
+                    (AbstractedQSFS.user_cache.stats(),
+                     AbstractedQSFS.group_cache.stats()))
+
     def run_as_current_user(self, function, *args, **kwargs):
         """Execute a function impersonating the current logged-in user.
         This needs to set up the restclient in the filesystem so it do its thing
@@ -496,21 +4008,169 @@ class QFTPHandler(FTPHandler):
             local_rc = self.authorizer.impersonate_user(
                 self.username, self.password)
             logger.debug("local_rc: " + str(local_rc))
+            if REST_CONCURRENCY is not None:
+                self.share = FairShare(
+                    self.username, USER_WEIGHTS.get(self.username, 1))
+            local_rc.conninfo.share = self.share
+            local_rc.conninfo.trace = self.trace
             self.fs.set_rc(local_rc)
         try:
-            return function(*args, **kwargs)
+            if kwargs:
+                return function(*args, **kwargs)
+            return self.run_prepared(function, *args)
         finally:
             self.authorizer.terminate_impersonation(self.username)
 
 
+def reset_worker_state():
+    """Call first thing in a forked process. Locks may have been held by
+    parent threads that don't exist here and pooled admin clients share
+    their connections with the parent, so both are replaced. The cached
+    data itself is still good and is kept
+    """
+    for cache in (AbstractedQSFS.attr_cache, AbstractedQSFS.id_cache,
+                  AbstractedQSFS.user_cache, AbstractedQSFS.group_cache,
+                  QSFSAuthorizer.session_cache):
+        cache.lock = threading.Lock()
+    node_balancer.lock = threading.Lock()
+    metrics.lock = threading.Lock()
+    tracer.lock = threading.Lock()
+    profiler.thread = None
+    buffer_budget.lock = threading.Lock()
+    buffer_budget.used = buffer_budget.peak = 0
+    rest_scheduler.reset()
+    pool = AdminClientPool(ADMIN_POOL_SIZE)
+    QSFSAuthorizer.admin_pool = pool
+    QSFSAuthorizer.cluster_cache.pool = pool
+    QSFSAuthorizer.cluster_cache.lock = threading.Lock()
+    QSFSAuthorizer.cluster_cache.thread = None
+
+
+class QFTPMultiprocessServer(MultiprocessFTPServer):
+    """MultiprocessFTPServer, with each session's process starting from
+    clean locks and client pools
+    """
+    def _loop(self, handler):
+        reset_worker_state()
+        MultiprocessFTPServer._loop(self, handler)
+
+
+def make_listener(address):
+    """A socket several processes can bind to the same address at once,
+    letting the kernel spread incoming connections across them
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    return sock
+
+
+def serve_async(handler, listener):
+    ioloop = IOLoop()
+    server = FTPServer(listener, handler, ioloop=ioloop)
+    if WORKER_THREADS:
+        handler.executor = IOLoopExecutor(WORKER_THREADS, ioloop)
+    handler.authorizer.cluster_cache.start()
+    server.serve_forever()
+
+
+def fork_worker(handler, slot):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        reset_worker_state()
+        start_metrics_server(slot)
+        serve_async(handler, make_listener(LISTEN_ADDRESS))
+        status = 0
+    except (KeyboardInterrupt, SystemExit):
+        status = 0
+    except Exception:
+        logger.exception("prefork: worker %d failed" % slot)
+    finally:
+        os._exit(status)
+
+
+def serve_prefork(handler, processes):
+    """Run processes async servers, each with its own IOLoop, worker
+    threads, client pools and caches, and replace any that die. Workers
+    that keep dying as they start are replaced ever more slowly, then not
+    at all; the server returns once no workers are left
+    """
+    if TRANSFER_BUFFER_BUDGET is not None:
+        buffer_budget.limit = TRANSFER_BUFFER_BUDGET // processes
+    if REST_CONCURRENCY is not None:
+        rest_scheduler.resize(max(REST_CONCURRENCY // processes, 1))
+    children = {}
+    started = {}  # slot -> when its worker was forked
+    failures = {}  # slot -> workers in a row that died starting
+
+    def start(slot):
+        started[slot] = time.time()
+        children[fork_worker(handler, slot)] = slot
+
+    for slot in range(1, processes + 1):
+        start(slot)
+    logger.info("prefork: started %d workers" % processes)
+    try:
+        while children:
+            pid, status = os.wait()
+            slot = children.pop(pid, None)
+            if slot is None:
+                continue
+            if time.time() - started[slot] < PREFORK_STARTUP_TIME:
+                failures[slot] = failures.get(slot, 0) + 1
+            else:
+                failures[slot] = 0
+            if failures[slot] >= PREFORK_MAX_FAILURES:
+                logger.error("prefork: worker %d exited with status %d, the "
+                             "last of %d in a row to fail starting; not "
+                             "replacing it" % (pid, status, failures[slot]))
+                continue
+            delay = (PREFORK_RESTART_DELAY * 2 ** (failures[slot] - 1)
+                     if failures[slot] else 0)
+            logger.warn("prefork: worker %d exited with status %d, "
+                        "replacing it in %gs" % (pid, status, delay))
+            time.sleep(delay)
+            start(slot)
+    except (KeyboardInterrupt, SystemExit):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        return
+    logger.error("prefork: no workers left")
+
+
 def main():
     authorizer = QSFSAuthorizer()
     handler = QFTPHandler
     handler.authorizer = authorizer
     handler.abstracted_fs = AbstractedQSFS
-    server = FTPServer(('127.0.0.1', 21), handler)
     pyftpdlib.log.LEVEL = logging.DEBUG
-    server.serve_forever()
+    install_profiler()
+    if SHARED_CACHES and SERVER_MODE in ('prefork', 'multiprocess'):
+        share_caches()
+    authorizer.admin_pool.call(refresh_nodes)
+    authorizer.admin_pool.call(warm_identity_caches)
+    if SERVER_MODE == 'async':
+        start_metrics_server()
+        serve_async(handler, LISTEN_ADDRESS)
+    elif SERVER_MODE == 'prefork':
+        serve_prefork(handler,
+                      PREFORK_PROCESSES or multiprocessing.cpu_count())
+    elif SERVER_MODE in ('threaded', 'multiprocess'):
+        # multiprocess sessions count in their own processes, so only the
+        # cache and node metrics are meaningful there
+        start_metrics_server()
+        authorizer.cluster_cache.start()
+        if SERVER_MODE == 'threaded':
+            server = ThreadedFTPServer(LISTEN_ADDRESS, handler)
+        else:
+            server = QFTPMultiprocessServer(LISTEN_ADDRESS, handler)
+        server.serve_forever()
+    else:
+        raise ValueError("unknown SERVER_MODE %r" % SERVER_MODE)
 
 
 if __name__ == '__main__':
@@ -1,17 +1,23 @@
 __author__ = 'mbott'
 
 
+import errno
+import io
 import os
 import json
+import socket
+import threading
 import unittest
 
 from time import sleep
 
+import qumulo.lib.request
 from qumulo.rest_client import RestClient
 from qumulo.lib.request import RequestError
 
 # Modules under test
 import qftpd
+import fake_qumulo
 
 # Qumulo RESTful API address/port and credentials
 # Requires a running cluster and admin creds
@@ -112,6 +118,55 @@ def create_files(cleanup, files):
             rc.fs.delete(f)
 
 
+def get_fake_qsfs(cluster, username=API_USER):
+    """return an AbstractedQSFS logged in to a fake_qumulo cluster as
+    username, with its own caches so tests don't see each other's entries
+    """
+    qsfs = qftpd.AbstractedQSFS(u'/', None)
+    qsfs.rc = qftpd.make_rest_client(cluster.session(username))
+    qsfs.attr_cache = qftpd.TTLCache(60, 100)
+    qsfs.id_cache = qftpd.TTLCache(60, 100)
+    qsfs.user_cache = qftpd.TTLCache(60, 100)
+    qsfs.group_cache = qftpd.TTLCache(60, 100)
+    return qsfs
+
+
+def make_tree(cluster, paths):
+    """Files and directories on cluster, directories are the paths ending
+    in /
+    """
+    for path in paths:
+        if path.endswith('/'):
+            cluster.create(path, 'DIRECTORY')
+        else:
+            cluster.make_file(path)
+
+
+class FakeClusterTest(unittest.TestCase):
+    """A test whose REST calls go to a fake_qumulo cluster, through the
+    same scheduling, balancing and metrics as calls to a real one.
+    self.fs is an AbstractedQSFS logged in to it
+    """
+    cluster_class = fake_qumulo.FakeCluster
+
+    def setUp(self):
+        self.threads = set(threading.enumerate())
+        self.cluster = self.cluster_class()
+        self.cluster.install()
+        self.fs = get_fake_qsfs(self.cluster)
+
+    def tearDown(self):
+        # transfer workers still winding down finish on this cluster rather
+        # than call out to a real one
+        for thread in set(threading.enumerate()) - self.threads:
+            thread.join(5)
+        self.cluster.uninstall()
+
+    def calls(self, name):
+        """The cluster's log of calls to the API function name"""
+        return [c for c in self.cluster.log if c[0] == name]
+
+
 class TestQftpdStat(unittest.TestCase):
     def setUp(self):
         self.qsfs = qftpd.AbstractedQSFS(u'/',None)
@@ -254,12 +309,12 @@ class TestTestData(unittest.TestCase):
 
     def test_testdir_creation(self):
         for d in self.dirs:
-            response = self.rc.fs.get_attr(d)
+            response = self.rc.fs.get_file_attr(d)
             self.assertEqual('FS_FILE_TYPE_DIRECTORY', response['type'])
 
     def test_testfile_creation(self):
         for f in self.files:
-            response = self.rc.fs.get_attr(f)
+            response = self.rc.fs.get_file_attr(f)
             self.assertEqual('FS_FILE_TYPE_FILE', response['type'])
 
 
@@ -290,7 +345,10 @@ class TestWriteBuffer(unittest.TestCase):
         test_file_contents = "test " * 100
         write_buffer = qftpd.WriteBuffer('/', 'test_foo.txt', self.fs)
         write_buffer.write(test_file_contents)
-        write_buffer.seek(0)
+        self.assertEqual(len(test_file_contents), write_buffer.tell())
+        # seek() only places the upload, once data is staged it refuses
+        self.assertRaises(IOError, write_buffer.seek, 0)
+        qftpd.SpooledTemporaryFile.seek(write_buffer, 0)
         result = write_buffer.read()
         self.assertEqual(test_file_contents, result)
 
@@ -313,6 +371,1735 @@ class TestWriteBuffer(unittest.TestCase):
         self.assertEqual(test_file_contents, file_contents)
 
 
+class TestTTLCache(unittest.TestCase):
+    def test_cache_evicts_least_recently_used(self):
+        cache = qftpd.TTLCache(60, 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'hits': 3, 'misses': 1, 'size': 2}, cache.stats())
+
+    def test_cache_entries_expire(self):
+        cache = qftpd.TTLCache(-1, 10)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_cache_reraises_negative_entries(self):
+        cache = qftpd.TTLCache(60, 10)
+        cache.put_error('a', KeyError('a'))
+        self.assertRaises(KeyError, cache.get, 'a')
+
+    def test_scopes_only_see_their_own_entries(self):
+        cache = qftpd.TTLCache(60, 10)
+        cache.put('/a', 1, 'alice')
+        self.assertIsNone(cache.get('/a', 'bob'))
+        self.assertIsNone(cache.get('/a'))
+        cache.put('/a', 2, 'bob')
+        self.assertEqual(1, cache.get('/a', 'alice'))
+        cache.invalidate('/a')
+        self.assertIsNone(cache.get('/a', 'alice'))
+        self.assertIsNone(cache.get('/a', 'bob'))
+
+
+class TestSharedTTLCache(unittest.TestCase):
+    def test_qstat_round_trip(self):
+        cache = qftpd.SharedTTLCache(60, 100, encode=qftpd.encode_qstat,
+                                     decode=qftpd.decode_qstat)
+        qstat = json.loads(FILE_QSTAT)
+        cache.put(u'/file.txt', qstat)
+        cached = cache.get(u'/file.txt')
+        for field in ('name', 'type', 'mode', 'num_links', 'size', 'id',
+                      'file_number', 'owner', 'group', 'epoch_ns'):
+            self.assertEqual(qstat[field], cached[field])
+        self.assertEqual({'hits': 1, 'misses': 0, 'size': 1}, cache.stats())
+
+    def test_forked_process_shares_entries_and_invalidations(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        cache.put('501', u'bob')
+        pid = os.fork()
+        if not pid:
+            cache.put('500', u'alice')
+            cache.invalidate('501')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(u'alice', cache.get('500'))
+        self.assertIsNone(cache.get('501'))
+
+    def test_negative_entries_are_shared(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        cache.put_error('7', RequestError(404, 'Not Found',
+                                          {'description': 'no such user'}))
+        try:
+            cache.get('7')
+            self.fail('expected a RequestError')
+        except RequestError, e:
+            self.assertEqual((404, 'no such user'),
+                             (e.status_code, e.description))
+
+    def test_clock_spares_entries_read_since_it_passed(self):
+        cache = qftpd.SharedTTLCache(60, 2, ways=2)
+        cache.put('a', u'1')
+        cache.put('b', u'2')
+        cache.get('a')
+        cache.put('c', u'3')
+        self.assertEqual(u'1', cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(u'3', cache.get('c'))
+
+    def test_record_being_written_is_a_miss(self):
+        cache = qftpd.SharedTTLCache(60, 1, ways=1)
+        cache.put('a', u'1')
+        cache.bump(cache.records)  # as if a writer were halfway through
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', u'2')
+        self.assertEqual(u'2', cache.get('a'))
+
+    def test_scopes_only_see_their_own_entries(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        cache.put(u'/a', u'1', u'alice')
+        self.assertIsNone(cache.get(u'/a', u'bob'))
+        cache.put(u'/a', u'2', u'bob')
+        self.assertEqual(u'1', cache.get(u'/a', u'alice'))
+        self.assertEqual(u'2', cache.get(u'/a', u'bob'))
+        cache.invalidate(u'/a')
+        self.assertIsNone(cache.get(u'/a', u'alice'))
+        self.assertIsNone(cache.get(u'/a', u'bob'))
+
+    def test_scopes_too_long_to_share_stay_local(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        scope = u'u' * (cache.KEY_BYTES + 1)
+        self.assertIsNone(cache.get(u'/a', scope))
+        cache.put(u'/a', u'1', scope)
+        self.assertEqual(u'1', cache.get(u'/a', scope))
+
+    def test_size_counts_only_live_entries(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, u'1')
+        cache.invalidate('a')
+        cache.store('b', 0.001, u'1', None)
+        sleep(0.01)
+        self.assertEqual(1, cache.stats()['size'])
+        cache.clear()
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_share_caches_includes_ids(self):
+        fs = qftpd.AbstractedQSFS
+        caches = fs.attr_cache, fs.id_cache, fs.user_cache, fs.group_cache
+        try:
+            qftpd.share_caches()
+            fs.id_cache.put(u'/dir/a.txt', '42', u'alice')
+            pid = os.fork()
+            if not pid:
+                fs.id_cache.invalidate(u'/dir/a.txt')
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self.assertIsNone(fs.id_cache.get(u'/dir/a.txt', u'alice'))
+            fs.id_cache.put(u'/dir/a.txt', '43', u'alice')
+            self.assertEqual(u'43', fs.id_cache.get(u'/dir/a.txt', u'alice'))
+        finally:
+            (fs.attr_cache, fs.id_cache, fs.user_cache,
+             fs.group_cache) = caches
+
+    def test_prefix_invalidation_and_long_keys(self):
+        cache = qftpd.SharedTTLCache(60, 100)
+        long_key = u'/' + u'x' * cache.KEY_BYTES
+        cache.put(long_key, u'local')
+        cache.put(u'/dir/a', u'shared')
+        self.assertEqual(u'local', cache.get(long_key))
+        cache.invalidate_prefix(u'/dir/')
+        self.assertIsNone(cache.get(u'/dir/a'))
+        self.assertEqual(u'local', cache.get(long_key))
+
+
+class TestAttrCache(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.create(u'/directory', 'DIRECTORY')
+        self.cluster.make_file(u'/file.txt', 5)
+
+    def test_isdir_and_lstat_share_cached_attrs(self):
+        self.assertTrue(self.fs.isdir(u'/directory/'))
+        self.fs.chdir(u'/directory')
+        self.assertEqual(16877, self.fs.lstat(u'/directory').st_mode)
+        self.assertEqual(1, len(self.calls('get_file_attr')))
+
+    def test_missing_path_is_cached(self):
+        for _ in range(2):
+            self.assertRaises(RequestError, self.fs.isfile, u'/nope.txt')
+        self.assertEqual(1, len(self.calls('get_file_attr')))
+
+    def test_users_dont_share_cached_attrs(self):
+        self.fs.cmd_channel = FakeCmdChannel()
+        self.fs.cmd_channel.username = 'alice'
+        self.assertTrue(self.fs.isfile(u'/file.txt'))
+        self.fs.cmd_channel.username = 'bob'
+        self.assertTrue(self.fs.isfile(u'/file.txt'))
+        self.assertEqual(2, len(self.calls('get_file_attr')))
+        # nor ids, which bob's calls might not have been able to reach
+        self.assertEqual([], self.cluster.ids_used)
+
+    def test_remove_invalidates_path(self):
+        self.assertTrue(self.fs.isfile(u'/file.txt'))
+        self.fs.remove(u'/file.txt')
+        self.assertFalse(self.fs.lexists(u'/file.txt'))
+        self.assertEqual(2, len(self.calls('get_file_attr')))
+
+
+class FakeCmdChannel(object):
+    use_gmt_times = True
+    unicode_errors = 'replace'
+
+
+class TestListing(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.create(u'/directory', 'DIRECTORY')
+        for i in range(50):
+            node = self.cluster.make_file(u'/directory/file%02d.txt' % i, 5)
+            node.modified = '2015-03-05T02:01:58.412045121Z'
+        self.fs.cmd_channel = FakeCmdChannel()
+        self.fs.get_user_by_uid = str
+        self.fs.get_group_by_gid = str
+
+    def tearDown(self):
+        FakeClusterTest.tearDown(self)
+        qftpd.LISTDIR_PAGE_SIZE = 1000
+
+    def test_list_costs_one_rest_call(self):
+        lines = list(self.fs.get_list_dir(u'/directory'))
+        self.assertEqual(50, len(lines))
+        self.assertTrue(lines[0].startswith('-rw-r--r--'))
+        self.assertEqual([('get_file_attr', u'/directory'),
+                          ('read_directory', u'/directory')],
+                         self.cluster.log)
+
+    def test_list_formats_entries_without_lookups(self):
+        # nothing comes from the attribute cache, even when it keeps nothing
+        self.fs.attr_cache = qftpd.TTLCache(0, 100)
+        facts = ['type', 'size']
+        self.assertEqual(50, len(list(self.fs.get_list_dir(u'/directory'))))
+        pages = self.fs.format_mlsx(u'/directory',
+                                    self.fs.listdir(u'/directory'),
+                                    'elr', facts)
+        self.assertEqual(50, len(''.join(pages).splitlines()))
+        self.assertEqual(['get_file_attr', 'read_directory', 'read_directory'],
+                         [c[0] for c in self.cluster.log])
+
+    def test_listing_fetches_pages_lazily(self):
+        qftpd.LISTDIR_PAGE_SIZE = 20
+        lines = self.fs.get_list_dir(u'/directory')
+        for _ in range(20):
+            next(lines)
+        self.assertEqual(1, len(self.calls('read_directory')))
+        self.assertEqual(30, len(list(lines)))
+        self.assertEqual(3, len(self.calls('read_directory')))
+
+    def test_failed_page_is_a_filesystem_error(self):
+        self.fs.isdir(u'/directory')
+        self.cluster.fail('read_directory',
+                          RequestError(403, 'Forbidden', None))
+        self.assertRaises(qftpd.FilesystemError, list,
+                          self.fs.get_list_dir(u'/directory'))
+
+    def test_stat_uses_qsfs_attributes(self):
+        self.assertEqual(5, self.fs.stat(u'/directory/file01.txt').st_size)
+
+    def test_lstat_missing_path_raises_filesystem_error(self):
+        self.assertRaises(qftpd.FilesystemError, self.fs.lstat, u'/nope')
+
+    def test_mlsd_costs_one_rest_call_per_page(self):
+        qftpd.LISTDIR_PAGE_SIZE = 20
+        facts = ['type', 'size', 'modify', 'perm', 'unique', 'unix.mode']
+        pages = list(self.fs.format_mlsx(u'/directory',
+                                         self.fs.listdir(u'/directory'),
+                                         'elradfmw', facts))
+        self.assertEqual(3, len(pages))
+        lines = ''.join(pages).splitlines()
+        self.assertEqual(50, len(lines))
+        unique = self.cluster.lookup(u'/directory/file00.txt').file_number
+        self.assertEqual('modify=20150305020158;perm=radfw;size=5;type=file;'
+                         'unique=%x;unix.mode=0644; file00.txt' % unique,
+                         lines[0])
+        self.assertEqual(['read_directory'] * 3,
+                         [c[0] for c in self.cluster.log])
+
+    def test_mlst_missing_path(self):
+        self.assertRaises(qftpd.FilesystemError, list,
+                          self.fs.format_mlsx(u'/', [u'nope'], 'elr',
+                                              ['type'], ignore_err=False))
+        self.assertEqual([], list(self.fs.format_mlsx(u'/', [u'nope'],
+                                                      'elr', ['type'])))
+
+
+class TestTreeWalk(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        make_tree(self.cluster, [
+            u'/a/', u'/a/x/', u'/a/x/1', u'/a/y/', u'/a/y/2', u'/a/3',
+            u'/b/', u'/b/4', u'/5'])
+        self.fs.cmd_channel = FakeCmdChannel()
+        self.fs.get_user_by_uid = str
+        self.fs.get_group_by_gid = str
+
+    def walk(self, **kwargs):
+        return qftpd.TreeWalk(self.fs, u'/', 4, **kwargs)
+
+    def test_walk_reads_every_directory(self):
+        result = dict((path, sorted(e['name'] for e in entries))
+                      for path, entries in self.walk())
+        self.assertEqual({u'/': [u'5', u'a', u'b'], u'/a': [u'3', u'x', u'y'],
+                          u'/a/x': [u'1'], u'/a/y': [u'2'], u'/b': [u'4']},
+                         result)
+
+    def test_ordered_walk_is_depth_first(self):
+        paths = [path for path, _ in self.walk(ordered=True)]
+        self.assertEqual([u'/', u'/a', u'/a/x', u'/a/y', u'/b'], paths)
+
+    def test_max_depth(self):
+        paths = [path for path, _ in self.walk(ordered=True, max_depth=1)]
+        self.assertEqual([u'/', u'/a', u'/b'], paths)
+
+    def test_max_entries(self):
+        walk = self.walk(ordered=True, max_entries=4)
+        self.assertEqual([3, 1], [len(entries) for _, entries in walk])
+        self.assertTrue(walk.truncated)
+
+    def test_missing_root(self):
+        self.assertRaises(qftpd.FilesystemError, list,
+                          qftpd.TreeWalk(self.fs, u'/nope', 2))
+
+    def test_reads_no_faster_than_the_listing_is_taken(self):
+        make_tree(self.cluster, [u'/wide/'] +
+                  [u'/wide/d%03d/' % i for i in range(200)])
+        used = qftpd.buffer_budget.used
+        walk = iter(qftpd.TreeWalk(self.fs, u'/wide', 4, ordered=True))
+        self.assertEqual(u'/wide', next(walk)[0])
+        sleep(0.1)
+        self.assertEqual(1, len(self.calls('read_directory')))
+        self.assertEqual(u'/wide/d000', next(walk)[0])
+        sleep(0.1)
+        self.assertEqual(5, len(self.calls('read_directory')))
+        self.assertEqual(199, len(list(walk)))
+        self.assertEqual(used, qftpd.buffer_budget.used)
+
+    def test_held_entries_hold_back_reads(self):
+        walk = qftpd.TreeWalk(self.fs, u'/', 4, max_buffered=0)
+        walk.start()
+        self.assertFalse(walk.has_room())
+        walk.close()
+
+    def test_max_entries_stops_reading(self):
+        make_tree(self.cluster, [u'/wide/'] +
+                  [u'/wide/d%03d/' % i for i in range(200)])
+        walk = qftpd.TreeWalk(self.fs, u'/wide', 4, max_entries=5)
+        self.assertEqual([5], [len(entries) for _, entries in walk])
+        self.assertTrue(walk.truncated)
+        self.assertEqual(1, len(self.calls('read_directory')))
+
+    def test_list_tree(self):
+        lines = ''.join(self.fs.get_list_tree(u'/a')).splitlines()
+        self.assertEqual(u'/a:', lines[0])
+        self.assertEqual(['', '/a/x:'], lines[4:6])
+        self.assertTrue(lines[6].endswith(' 1'))
+
+    def test_tree_mlsx_names_full_paths(self):
+        lines = ''.join(self.fs.get_tree_mlsx(u'/a', 'elr', ('type',),
+                                              ordered=True)).splitlines()
+        self.assertEqual(['type=file; /a/3', 'type=dir; /a/x',
+                          'type=dir; /a/y', 'type=file; /a/x/1',
+                          'type=file; /a/y/2'], lines)
+
+
+class TestIdentityCache(FakeClusterTest):
+    def test_lookups_are_cached(self):
+        for _ in range(3):
+            self.assertEqual(API_USER, self.fs.get_user_by_uid(500))
+            self.assertEqual('Users', self.fs.get_group_by_gid(513))
+        self.assertEqual([('list_user', u'500')], self.calls('list_user'))
+        self.assertEqual([('list_group', u'513')], self.calls('list_group'))
+
+    def test_failed_lookups_are_cached(self):
+        uid = 12884903978
+        for _ in range(3):
+            self.assertEqual(str(uid), self.fs.get_user_by_uid(uid))
+        self.assertEqual([('list_user', str(uid))], self.calls('list_user'))
+
+    def test_other_errors_are_not_cached(self):
+        self.cluster.fail('list_user',
+                          RequestError(503, 'Service Unavailable', None))
+        self.assertEqual('500', self.fs.get_user_by_uid(500))
+        self.cluster.fail('list_user')
+        self.assertEqual(API_USER, self.fs.get_user_by_uid(500))
+        self.assertEqual(2, len(self.calls('list_user')))
+
+    def test_warm_identity_caches(self):
+        self.fs.user_cache.clear()
+        user_cache = qftpd.AbstractedQSFS.user_cache
+        group_cache = qftpd.AbstractedQSFS.group_cache
+        try:
+            qftpd.AbstractedQSFS.user_cache = self.fs.user_cache
+            qftpd.AbstractedQSFS.group_cache = self.fs.group_cache
+            qftpd.warm_identity_caches(self.fs.rc)
+        finally:
+            qftpd.AbstractedQSFS.user_cache = user_cache
+            qftpd.AbstractedQSFS.group_cache = group_cache
+        self.assertEqual(API_USER, self.fs.get_user_by_uid(500))
+        self.assertEqual('Users', self.fs.get_group_by_gid(513))
+        self.assertEqual([('list_users',), ('list_groups',)],
+                         self.cluster.log)
+
+
+class TestTimestamps(unittest.TestCase):
+    def setUp(self):
+        self.qsfs = qftpd.AbstractedQSFS(u'/', None)
+
+    def test_fast_path_keeps_nanoseconds(self):
+        self.assertEqual(
+            1425520913498584694,
+            qftpd.timestamp_to_epoch_ns("2015-03-05T02:01:53.498584694Z"))
+
+    def test_fast_path_matches_dateutil(self):
+        for timestamp in ["2015-03-05T02:01:53.498584694Z",
+                          "1969-12-31T23:59:59.5Z",
+                          "2038-01-19T03:14:08Z"]:
+            self.assertEqual(
+                (qftpd.dateutil.parser.parse(timestamp) -
+                 qftpd.EPOCH).total_seconds(),
+                self.qsfs.convert_timestamp_to_epoch_seconds(timestamp))
+
+    def test_odd_timestamps_fall_back_to_dateutil(self):
+        self.assertEqual(
+            1425520913000000000,
+            qftpd.timestamp_to_epoch_ns("2015-03-05T02:01:53+00:00"))
+
+    def test_page_of_entries_converted_in_one_pass(self):
+        entries = [json.loads(FILE_QSTAT), json.loads(DIR_QSTAT)]
+        qftpd.add_epoch_times(entries)
+        self.assertEqual(1425520918412045121,
+                         entries[0]['epoch_ns']['modification_time'])
+        self.assertEqual(1425520918, self.qsfs.get_st_mtime(entries[0]))
+
+
+class TestWriteBufferChunks(FakeClusterTest):
+    def test_write_buffer_flushes_full_chunks(self):
+        write_buffer = qftpd.WriteBuffer(u'/', u'upload.bin', self.fs,
+                                         max_size=100)
+        for _ in range(5):
+            write_buffer.write('x' * 64)
+        # 320 bytes written, the first three 100 byte chunks are on QSFS
+        self.assertEqual('x' * 300, self.cluster.contents(u'/upload.bin'))
+        self.assertFalse(write_buffer._rolled)
+        write_buffer.close()
+        self.assertEqual('x' * 320, self.cluster.contents(u'/upload.bin'))
+        self.assertEqual([0, 100, 200, 300],
+                         [c[2] for c in self.calls('write_file')])
+
+    def test_chunk_writes_are_counted(self):
+        key = ('qftpd_upload_chunks_total', (('mode', 'serial'),))
+        before = qftpd.metrics.values.get(key, 0)
+        write_buffer = qftpd.WriteBuffer(u'/', u'upload.bin', self.fs,
+                                         max_size=100)
+        write_buffer.write('x' * 250)
+        write_buffer.close()
+        self.assertEqual(3, qftpd.metrics.values[key] - before)
+
+    def test_empty_upload_writes_nothing(self):
+        write_buffer = qftpd.WriteBuffer(u'/', u'empty.bin', self.fs)
+        write_buffer.close()
+        self.assertEqual('', self.cluster.contents(u'/empty.bin'))
+        self.assertEqual([('create_file', u'/empty.bin')], self.cluster.log)
+
+
+class TestParallelUpload(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.threshold = qftpd.PARALLEL_UPLOAD_THRESHOLD
+        qftpd.PARALLEL_UPLOAD_THRESHOLD = 250
+
+    def tearDown(self):
+        FakeClusterTest.tearDown(self)
+        qftpd.PARALLEL_UPLOAD_THRESHOLD = self.threshold
+
+    def test_large_upload_written_in_parallel_ranges(self):
+        data = ''.join(chr(i % 251) for i in range(1050))
+        write_buffer = qftpd.WriteBuffer(u'/', u'big.bin', self.fs,
+                                         max_size=100)
+        for start in range(0, len(data), 70):
+            write_buffer.write(data[start:start + 70])
+        self.assertIsNotNone(write_buffer.uploader)
+        write_buffer.close()
+        self.assertEqual(data, self.cluster.contents(u'/big.bin'))
+        offsets = [c[2] for c in self.calls('write_file')]
+        self.assertEqual(range(0, 1050, 100), sorted(offsets))
+
+    def test_failed_range_fails_close(self):
+        write_buffer = qftpd.WriteBuffer(u'/', u'big.bin', self.fs,
+                                         max_size=100)
+        write_buffer.write('x' * 300)
+        self.cluster.remove(u'/big.bin')  # later ranges get a 404
+        try:
+            write_buffer.write('x' * 200)
+        except qftpd.FilesystemError:
+            pass  # the failure may already have been noticed
+        self.assertRaises(qftpd.FilesystemError, write_buffer.close)
+        self.assertTrue(write_buffer.closed)
+
+
+class TestResume(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.make_file(u'/file.bin', 500, 'a' * 500)
+
+    def test_appe_writes_after_existing_data(self):
+        fd = self.fs.open(u'/file.bin', 'ab')
+        fd.write('b' * 100)
+        fd.close()
+        self.assertEqual('a' * 500 + 'b' * 100,
+                         self.cluster.contents(u'/file.bin'))
+        writes = [c for c in self.cluster.log if c[0] != 'get_file_attr']
+        self.assertEqual([('write_file', u'/file.bin', 500, 100)], writes)
+
+    def test_appe_writes_after_data_written_elsewhere(self):
+        self.fs.lstat(u'/file.bin')
+        self.cluster.lookup(u'/file.bin').data += 'c' * 50
+        fd = self.fs.open(u'/file.bin', 'ab')
+        fd.write('b')
+        fd.close()
+        self.assertEqual('a' * 500 + 'c' * 50 + 'b',
+                         self.cluster.contents(u'/file.bin'))
+
+    def test_rest_stor_checks_offset_against_current_size(self):
+        self.fs.lstat(u'/file.bin')
+        self.cluster.lookup(u'/file.bin').data += 'c' * 50
+        fd = self.fs.open(u'/file.bin', 'r+b')
+        self.assertEqual(550, self.fs.getsize(u'/file.bin'))
+        fd.close()
+
+    def test_appe_creates_missing_file(self):
+        fd = self.fs.open(u'/new.bin', 'ab')
+        fd.write('b' * 10)
+        fd.close()
+        self.assertEqual('b' * 10, self.cluster.contents(u'/new.bin'))
+
+    def test_rest_stor_writes_from_offset(self):
+        fd = self.fs.open(u'/file.bin', 'r+b')
+        fd.seek(300)
+        fd.write('b' * 300)
+        fd.close()
+        self.assertEqual('a' * 300 + 'b' * 300,
+                         self.cluster.contents(u'/file.bin'))
+
+    def test_seek_after_write_is_refused(self):
+        fd = self.fs.open(u'/file.bin', 'r+b')
+        fd.write('b' * 10)
+        self.assertRaises(IOError, fd.seek, 0)
+        fd.close()
+        self.assertEqual('b' * 10 + 'a' * 490,
+                         self.cluster.contents(u'/file.bin'))
+
+    def test_rest_retr_reads_from_offset(self):
+        fd = self.fs.open(u'/file.bin', 'rb')
+        fd.seek(450)
+        self.assertEqual('a' * 50, fd.read())
+        fd.close()
+        reads = self.calls('read_file')
+        self.assertEqual(450, reads[0][2])
+        self.assertEqual(1, len(reads))
+
+    def test_getsize_uses_qsfs(self):
+        self.assertEqual(500, self.fs.getsize(u'/file.bin'))
+        self.assertRaises(qftpd.FilesystemError,
+                          self.fs.getsize, u'/missing.bin')
+
+
+class TestRenameCopy(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.create(u'/dir', 'DIRECTORY')
+        self.cluster.make_file(u'/dir/a.txt', data='abc')
+
+    def test_rename_file_uses_cluster(self):
+        self.fs.rename(u'/dir/a.txt', u'/dir/b.txt')
+        self.assertIn(('rename', u'/dir/a.txt', u'/dir/b.txt'),
+                      self.cluster.log)
+        self.assertEqual('abc', self.cluster.contents(u'/dir/b.txt'))
+        self.assertFalse(self.fs.lexists(u'/dir/a.txt'))
+        self.assertTrue(self.fs.isfile(u'/dir/b.txt'))
+
+    def test_rename_directory_drops_cached_children(self):
+        self.assertTrue(self.fs.isfile(u'/dir/a.txt'))
+        self.fs.rename(u'/dir', u'/moved')
+        self.assertFalse(self.fs.lexists(u'/dir/a.txt'))
+        self.assertTrue(self.fs.lexists(u'/moved/a.txt'))
+
+    def test_rename_replaces_existing_file(self):
+        self.cluster.make_file(u'/dir/b.txt', data='old')
+        self.assertTrue(self.fs.isfile(u'/dir/b.txt'))
+        self.fs.rename(u'/dir/a.txt', u'/dir/b.txt')
+        self.assertEqual('abc', self.cluster.contents(u'/dir/b.txt'))
+        self.assertEqual(3, self.fs.getsize(u'/dir/b.txt'))
+        self.assertFalse(self.fs.lexists(u'/dir/a.txt'))
+
+    def test_rename_missing_source(self):
+        self.assertRaises(qftpd.FilesystemError,
+                          self.fs.rename, u'/nope', u'/dir/nope')
+
+    def test_copy_creates_target_and_copies(self):
+        self.assertFalse(self.fs.lexists(u'/dir/c.txt'))
+        self.fs.copy(u'/dir/a.txt', u'/dir/c.txt')
+        self.assertEqual([('create_file', u'/dir/c.txt'),
+                          ('copy', u'/dir/a.txt', u'/dir/c.txt')],
+                         [c for c in self.cluster.log
+                          if c[0] != 'get_file_attr'])
+        self.assertEqual('abc', self.cluster.contents(u'/dir/c.txt'))
+        # the negative entry from before the copy is gone
+        self.assertTrue(self.fs.lexists(u'/dir/c.txt'))
+
+    def test_copy_directory_fails(self):
+        self.assertRaises(qftpd.FilesystemError,
+                          self.fs.copy, u'/dir', u'/dir2')
+
+    def test_failed_copy_removes_target(self):
+        self.cluster.fail('copy',
+                          RequestError(507, 'Insufficient Storage', None))
+        self.assertRaises(qftpd.FilesystemError,
+                          self.fs.copy, u'/dir/a.txt', u'/dir/c.txt')
+        self.assertRaises(RequestError, self.cluster.lookup, u'/dir/c.txt')
+
+
+class TestIdCache(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        make_tree(self.cluster, [u'/dir/', u'/dir/sub/', u'/dir/sub/b.txt'])
+        self.cluster.make_file(u'/dir/a.txt', data='abc')
+
+    def id_of(self, path):
+        return self.cluster.lookup(path).attrs()['id']
+
+    def test_listed_entries_are_addressed_by_id(self):
+        list(self.fs.listdir(u'/dir'))
+        self.fs.attr_cache.clear()
+        self.assertTrue(self.fs.isfile(u'/dir/a.txt'))
+        fd = self.fs.open(u'/dir/a.txt', 'rb')
+        self.assertEqual('abc', fd.read())
+        fd.close()
+        # get_file_attr for isfile() and again on open, whose responses show
+        # the id still names the path; data is read by path
+        self.assertEqual([self.id_of(u'/dir/a.txt')] * 2,
+                         self.cluster.ids_used)
+
+    def test_stale_id_retries_by_path(self):
+        self.fs.id_cache.put(u'/dir/a.txt', '999')
+        self.assertTrue(self.fs.isfile(u'/dir/a.txt'))
+        self.assertEqual(self.id_of(u'/dir/a.txt'),
+                         self.fs.id_cache.get(u'/dir/a.txt'))
+
+    def test_rename_forgets_ids_below_directory(self):
+        list(self.fs.listdir(u'/dir/sub'))
+        self.assertIsNotNone(self.fs.id_cache.get(u'/dir/sub/b.txt'))
+        self.fs.rename(u'/dir/sub', u'/dir/moved')
+        self.assertIsNone(self.fs.id_cache.get(u'/dir/sub'))
+        self.assertIsNone(self.fs.id_cache.get(u'/dir/sub/b.txt'))
+
+    def test_listing_goes_by_id(self):
+        self.assertTrue(self.fs.isdir(u'/dir/sub'))
+        names = list(self.fs.listdir(u'/dir/sub'))
+        self.assertEqual([u'b.txt'], names)
+        self.assertEqual([self.id_of(u'/dir/sub')], self.cluster.ids_used)
+
+    def test_listing_of_replaced_directory_goes_by_path(self):
+        self.assertTrue(self.fs.isdir(u'/dir/sub'))
+        self.cluster.move(u'/dir/sub', u'/dir/moved')
+        self.cluster.create(u'/dir/sub', 'DIRECTORY')
+        self.assertEqual([], list(self.fs.listdir(u'/dir/sub')))
+        self.assertIsNone(self.fs.id_cache.get(u'/dir/sub'))
+
+    def test_remove_goes_by_path_and_forgets_id(self):
+        self.assertTrue(self.fs.isfile(u'/dir/a.txt'))
+        self.fs.remove(u'/dir/a.txt')
+        self.assertIn(('delete', u'/dir/a.txt'), self.cluster.log)
+        self.assertEqual([], self.cluster.ids_used)
+        self.assertIsNone(self.fs.id_cache.get(u'/dir/a.txt'))
+
+    def test_id_of_renamed_file_is_not_trusted(self):
+        list(self.fs.listdir(u'/dir'))
+        # another client renames the file the cached id points at
+        self.cluster.move(u'/dir/a.txt', u'/dir/b.txt')
+        self.fs.attr_cache.clear()
+        self.assertFalse(self.fs.lexists(u'/dir/a.txt'))
+        self.assertIsNone(self.fs.id_cache.get(u'/dir/a.txt'))
+        self.assertRaises(RequestError, self.fs.remove, u'/dir/a.txt')
+        self.assertEqual('abc', self.cluster.contents(u'/dir/b.txt'))
+
+    def test_listing_by_id_checks_the_first_page(self):
+        sub_id = self.id_of(u'/dir/sub')
+        # the directory is renamed and another one made in its place
+        self.cluster.move(u'/dir/sub', u'/dir/moved')
+        self.cluster.create(u'/dir/sub', 'DIRECTORY')
+        self.assertIsNone(qftpd.try_by_id(self.fs.rc.fs.read_entire_directory,
+                                          u'/dir/sub', sub_id, page_size=10))
+        pages = qftpd.try_by_id(self.fs.rc.fs.read_entire_directory,
+                                u'/dir/moved', sub_id, page_size=10)
+        self.assertEqual([[u'b.txt']],
+                         [[e['name'] for e in page['files']]
+                          for page in pages])
+
+
+class TestReadBuffer(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.contents = ''.join(chr(i % 256) for i in range(1000))
+        self.cluster.make_file(u'/file.bin', data=self.contents)
+
+    def test_read_buffer_streams_in_chunks(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=300)
+        result = ''
+        while True:
+            data = read_buffer.read(64)
+            if not data:
+                break
+            result += data
+        self.assertEqual(self.contents, result)
+        # 300 + 300 + 300 + 100 bytes
+        self.assertEqual(4, len(self.cluster.log))
+
+    def test_read_buffer_seek_fetches_from_offset(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=300)
+        read_buffer.seek(750)
+        self.assertEqual(self.contents[750:], read_buffer.read())
+        self.assertEqual(('read_file', u'/file.bin', 750, 300),
+                         self.cluster.log[0])
+
+    def test_open_missing_file_raises(self):
+        self.assertRaises(qftpd.FilesystemError,
+                          self.fs.open, u'/missing.bin', 'rb')
+
+    def test_open_reads_the_size_from_the_cluster(self):
+        self.fs.lstat(u'/file.bin')
+        self.cluster.lookup(u'/file.bin').data += self.contents
+        fd = self.fs.open(u'/file.bin', 'rb')
+        self.assertEqual(self.contents * 2, fd.read())
+        fd.close()
+
+
+class TestReadAhead(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.contents = ''.join(chr(i % 256) for i in range(1000))
+        self.cluster.make_file(u'/file.bin', data=self.contents)
+        self.cluster.latency = 0.01
+
+    def read_all(self, read_buffer):
+        result = ''
+        while True:
+            data = read_buffer.read(64)
+            if not data:
+                return result
+            result += data
+
+    def test_reads_every_range_once(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                                       size=1000)
+        self.assertEqual(self.contents, self.read_all(read_buffer))
+        read_buffer.close()
+        self.assertEqual(range(0, 1000, 100),
+                         sorted(c[2] for c in self.calls('read_file')))
+
+    def test_window_grows_while_client_waits(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                                       size=1000)
+        read_buffer.fetch_chunk()
+        read_buffer.fetch_chunk()
+        self.assertEqual(3, read_buffer.window)
+        read_buffer.close()
+
+    def test_window_shrinks_when_client_is_slow(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                                       size=1000)
+        read_buffer.window = 4
+        read_buffer.fetch_chunk()
+        window = read_buffer.window
+        sleep(0.1)
+        read_buffer.fetch_chunk()
+        self.assertEqual(window - 1, read_buffer.window)
+        read_buffer.close()
+
+    def test_workers_start_as_ranges_need_them(self):
+        self.cluster.make_file(u'/small.bin', data='abc')
+        read_buffer = qftpd.ReadBuffer(u'/small.bin', self.fs,
+                                       chunk_size=100, size=3)
+        self.assertEqual('abc', self.read_all(read_buffer))
+        self.assertEqual(1, len(read_buffer.workers))
+        read_buffer.close()
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                                       size=1000)
+        read_buffer.fetch_chunk()
+        self.assertEqual(read_buffer.window, len(read_buffer.workers))
+        read_buffer.close()
+
+    def test_seek_drops_read_ahead(self):
+        read_buffer = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                                       size=1000)
+        read_buffer.fetch_chunk()
+        read_buffer.seek(750)
+        self.assertEqual(self.contents[750:], self.read_all(read_buffer))
+        read_buffer.close()
+
+
+class TestSessionCache(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.add_user('bob', 'secret')
+        self.a = qftpd.QSFSAuthorizer()
+        self.a.session_cache = qftpd.TTLCache(60, 100)
+
+    def logins(self):
+        return [c[1] for c in self.calls('login')]
+
+    def test_impersonate_reuses_validated_session(self):
+        self.a.validate_authentication('bob', 'secret', None)
+        rc = self.a.impersonate_user('bob', 'secret')
+        self.assertEqual(u'/', rc.fs.get_file_attr(path=u'/')['path'])
+        self.a.validate_authentication('bob', 'secret', None)
+        self.assertEqual(['bob'], self.logins())
+
+    def test_failed_login_is_not_cached(self):
+        for _ in range(2):
+            self.assertRaises(qftpd.AuthenticationFailed,
+                              self.a.validate_authentication,
+                              'bob', 'guess', None)
+        self.a.validate_authentication('bob', 'secret', None)
+        self.assertEqual(['bob', 'bob', 'bob'], self.logins())
+        self.a.validate_authentication('bob', 'secret', None)
+        self.assertEqual(3, len(self.logins()))
+
+    def test_key_does_not_contain_password(self):
+        key = self.a.session_key('bob', 'secret')
+        self.assertNotIn('secret', key)
+        self.assertNotEqual(key, self.a.session_key('bob', 'secret2'))
+
+    def test_logout_forgets_session(self):
+        self.a.login('bob', 'secret')
+        self.a.logout('bob', 'secret')
+        self.a.login('bob', 'secret')
+        self.assertEqual(['bob', 'bob'], self.logins())
+
+    def test_expired_session_logs_in_again(self):
+        rc = self.a.impersonate_user('bob', 'secret')
+        self.cluster.expire_sessions()
+        # the call is turned away, and made again once logged in
+        self.assertEqual(u'/', rc.fs.get_file_attr(path=u'/')['path'])
+        self.assertEqual(['bob', 'bob'], self.logins())
+        # the dead credentials are gone from the cache too
+        self.assertEqual(rc.credentials.bearer_token,
+                         self.a.login('bob', 'secret').bearer_token)
+
+    def test_session_expiring_mid_listing_logs_in_again(self):
+        self.cluster.make_files(u'/dir', 30)
+        fs = get_fake_qsfs(self.cluster)
+        fs.rc = self.a.impersonate_user('bob', 'secret')
+        qftpd.LISTDIR_PAGE_SIZE = 20
+        try:
+            pages = fs.iter_directory_pages(u'/dir')
+            entries = next(pages)
+            self.cluster.expire_sessions()
+            for page in pages:
+                entries += page
+        finally:
+            qftpd.LISTDIR_PAGE_SIZE = 1000
+        self.assertEqual(30, len(entries))
+        self.assertEqual(['bob', 'bob'], self.logins())
+
+    def test_session_clients_time_out(self):
+        rc = self.a.impersonate_user('bob', 'secret')
+        self.assertEqual(qftpd.REST_TIMEOUT, rc.timeout)
+
+    def test_other_errors_are_not_retried(self):
+        rc = self.a.impersonate_user('bob', 'secret')
+        self.cluster.fail('get_file_attr',
+                          RequestError(403, 'Forbidden', None))
+        self.assertRaises(RequestError, rc.fs.get_file_attr, path=u'/')
+        self.assertEqual(1, len(self.calls('get_file_attr')))
+        self.assertEqual(['bob'], self.logins())
+
+
+class TestAdminCache(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.add_user('bob', 'secret')
+        self.pool = qftpd.AdminClientPool(2)
+        self.cache = qftpd.ClusterCache(self.pool, 60)
+
+    def list_users(self):
+        return self.pool.call(lambda rc: rc.users.list_users())
+
+    def test_pool_reuses_clients(self):
+        for _ in range(5):
+            self.list_users()
+        self.assertEqual(1, len(self.calls('login')))
+
+    def test_pool_logs_in_again_when_session_expires(self):
+        self.list_users()
+        self.cluster.expire_sessions()
+        self.assertEqual(2, len(self.list_users()))
+        self.assertEqual(2, len(self.calls('login')))
+
+    def test_banner_and_users_loaded_once(self):
+        self.assertEqual((u'fake', u'Qumulo Core (fake_qumulo)'),
+                         self.cache.get_banner())
+        self.assertTrue(self.cache.has_user('bob'))
+        self.assertTrue(self.cache.has_user(API_USER))
+        self.assertEqual(1, len(self.calls('list_users')))
+
+    def test_unknown_user_reload_is_rate_limited(self):
+        self.assertFalse(self.cache.has_user('carol'))
+        self.assertFalse(self.cache.has_user('carol'))
+        self.assertEqual(1, len(self.calls('list_users')))
+        self.cache.refreshed -= qftpd.CLUSTER_CACHE_MISS_REFRESH
+        self.cluster.add_user('carol', 'secret')
+        self.assertTrue(self.cache.has_user('carol'))
+
+
+class TestIOLoopExecutor(unittest.TestCase):
+    def setUp(self):
+        self.ioloop = qftpd.pyftpdlib.ioloop.IOLoop()
+        self.executor = qftpd.IOLoopExecutor(2, self.ioloop)
+        self.results = []
+
+    def tearDown(self):
+        self.ioloop.close()
+
+    def callback(self, result, error):
+        self.results.append((result, error, self.executor.in_worker()))
+
+    def wait_for_results(self, count):
+        for _ in range(100):
+            if len(self.results) >= count:
+                return
+            self.ioloop.poll(0.05)
+        self.fail("callbacks never ran")
+
+    def test_callback_runs_on_ioloop(self):
+        self.executor.submit(self.executor.in_worker, self.callback)
+        self.wait_for_results(1)
+        self.assertEqual([(True, None, False)], self.results)
+
+    def test_errors_are_handed_to_callback(self):
+        self.executor.submit(lambda: 1 / 0, self.callback)
+        self.wait_for_results(1)
+        result, error, in_worker = self.results[0]
+        self.assertIs(ZeroDivisionError, error[0])
+
+    def test_slow_task_does_not_hold_up_others(self):
+        self.executor.submit(lambda: sleep(0.5) or 'slow', self.callback)
+        self.executor.submit(lambda: 'fast', self.callback)
+        self.wait_for_results(2)
+        self.assertEqual(['fast', 'slow'], [r[0] for r in self.results])
+
+
+class TestServerModes(unittest.TestCase):
+    def test_reset_worker_state_replaces_pool_keeps_data(self):
+        old_pool = qftpd.QSFSAuthorizer.admin_pool
+        old_lock = qftpd.AbstractedQSFS.attr_cache.lock
+        qftpd.AbstractedQSFS.attr_cache.put('/kept', {'id': '1'})
+        qftpd.reset_worker_state()
+        self.assertIsNot(old_pool, qftpd.QSFSAuthorizer.admin_pool)
+        self.assertIs(qftpd.QSFSAuthorizer.admin_pool,
+                      qftpd.QSFSAuthorizer.cluster_cache.pool)
+        self.assertIsNot(old_lock, qftpd.AbstractedQSFS.attr_cache.lock)
+        self.assertEqual({'id': '1'},
+                         qftpd.AbstractedQSFS.attr_cache.get('/kept'))
+        qftpd.AbstractedQSFS.attr_cache.invalidate('/kept')
+
+    def test_workers_failing_to_start_are_given_up_on(self):
+        saved = dict((name, getattr(qftpd, name)) for name in (
+            'LISTEN_ADDRESS', 'PREFORK_RESTART_DELAY', 'PREFORK_MAX_FAILURES',
+            'TRANSFER_BUFFER_BUDGET', 'REST_CONCURRENCY', 'fork_worker'))
+        forks = []
+        statuses = []
+        wait = os.wait
+
+        def fork_worker(handler, slot):
+            forks.append(slot)
+            return saved['fork_worker'](handler, slot)
+
+        def waited():
+            pid, status = wait()
+            statuses.append(os.WEXITSTATUS(status))
+            return pid, status
+        qftpd.LISTEN_ADDRESS = ('192.0.2.1', 21)  # not an address of ours
+        qftpd.PREFORK_RESTART_DELAY = 0.01
+        qftpd.PREFORK_MAX_FAILURES = 3
+        qftpd.TRANSFER_BUFFER_BUDGET = qftpd.REST_CONCURRENCY = None
+        qftpd.fork_worker = fork_worker
+        os.wait = waited
+        try:
+            qftpd.serve_prefork(qftpd.QFTPHandler, 2)
+        finally:
+            os.wait = wait
+            for name, value in saved.items():
+                setattr(qftpd, name, value)
+        self.assertEqual([1, 1, 1, 2, 2, 2], sorted(forks))
+        self.assertEqual([1] * 6, statuses)
+
+    def test_listeners_share_a_port(self):
+        first = qftpd.make_listener(('127.0.0.1', 0))
+        second = qftpd.make_listener(first.getsockname())
+        self.assertEqual(first.getsockname(), second.getsockname())
+        first.close()
+        second.close()
+
+
+class FakeConnection(object):
+    def __init__(self, host):
+        self.host = host
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestNodeBalancer(unittest.TestCase):
+    def setUp(self):
+        self.balancer = qftpd.NodeBalancer(['a', 'b', 'c'])
+
+    def test_takes_idle_nodes_in_turn(self):
+        picks = [self.balancer.pick() for _ in range(6)]
+        self.assertEqual(['a', 'b', 'c'], sorted(set(picks)))
+
+    def test_prefers_least_loaded(self):
+        self.balancer.begin('a')
+        self.balancer.begin('b')
+        self.assertEqual('c', self.balancer.pick())
+
+    def test_prefers_faster_nodes(self):
+        self.balancer.nodes['a'].latency = 1.0
+        self.balancer.nodes['b'].latency = 1.0
+        self.balancer.nodes['c'].latency = 0.01
+        self.balancer.begin('c')
+        self.assertEqual('c', self.balancer.pick())
+
+    def test_failing_node_is_ejected(self):
+        for _ in range(qftpd.NODE_EJECT_FAILURES):
+            self.balancer.begin('a')
+            self.balancer.end('a', 0.1, True)
+        self.assertNotIn('a', [self.balancer.pick() for _ in range(6)])
+        self.assertTrue(self.balancer.stats()['a']['ejected'])
+
+    def test_set_hosts_keeps_known_nodes(self):
+        self.balancer.begin('a')
+        self.balancer.set_hosts(['a', 'd'])
+        self.assertEqual(1, self.balancer.stats()['a']['in_flight'])
+        self.assertEqual(['a', 'd'], sorted(self.balancer.stats()))
+
+    def test_requests_are_tracked(self):
+        untracked = qftpd.untracked_rest_request
+        balancer = qftpd.node_balancer
+        qftpd.node_balancer = self.balancer
+
+        def request(conninfo, credentials, method, uri):
+            self.assertEqual(1, self.balancer.stats()['b']['in_flight'])
+            if uri == '/broken':
+                raise RequestError(503, 'Unavailable', None)
+            return 'ok'
+        qftpd.untracked_rest_request = request
+        try:
+            self.assertEqual('ok', qftpd.tracked_rest_request(
+                FakeConnection('b'), None, 'GET', '/v1/version'))
+            self.assertRaises(RequestError, qftpd.tracked_rest_request,
+                              FakeConnection('b'), None, 'GET', '/broken')
+        finally:
+            qftpd.untracked_rest_request = untracked
+            qftpd.node_balancer = balancer
+        self.assertEqual(0, self.balancer.stats()['b']['in_flight'])
+        self.assertEqual(1, self.balancer.nodes['b'].failures)
+
+
+class TestFailover(unittest.TestCase):
+    def setUp(self):
+        self.untracked = qftpd.untracked_rest_request
+        self.balancer = qftpd.node_balancer
+        qftpd.node_balancer = qftpd.NodeBalancer(['a', 'b', 'c'])
+        self.calls = []
+
+        def request(conninfo, credentials, method, uri, response_file=None):
+            self.calls.append((conninfo.host, method))
+            if conninfo.host == 'b':
+                if response_file is not None:
+                    response_file.write('partial')
+                raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+            return 'ok'
+        qftpd.untracked_rest_request = request
+
+    def tearDown(self):
+        qftpd.untracked_rest_request = self.untracked
+        qftpd.node_balancer = self.balancer
+
+    def test_pick_avoids_failed_node(self):
+        picks = [qftpd.node_balancer.pick(avoid='b') for _ in range(6)]
+        self.assertEqual(['a', 'c'], sorted(set(picks)))
+        qftpd.node_balancer.set_hosts(['b'])
+        self.assertEqual('b', qftpd.node_balancer.pick(avoid='b'))
+
+    def test_get_is_retried_on_another_node(self):
+        conninfo = FakeConnection('b')
+        self.assertEqual('ok', qftpd.tracked_rest_request(
+            conninfo, None, 'GET', '/v1/file/'))
+        self.assertTrue(conninfo.closed)
+        self.assertNotEqual('b', conninfo.host)
+        self.assertEqual([('b', 'GET'), (conninfo.host, 'GET')], self.calls)
+
+    def test_other_calls_move_but_are_not_retried(self):
+        conninfo = FakeConnection('b')
+        self.assertRaises(socket.error, qftpd.tracked_rest_request,
+                          conninfo, None, 'POST', '/v1/files/')
+        self.assertNotEqual('b', conninfo.host)
+        self.assertEqual([('b', 'POST')], self.calls)
+
+    def test_partly_read_response_is_not_retried(self):
+        conninfo = FakeConnection('b')
+        self.assertRaises(socket.error, qftpd.tracked_rest_request,
+                          conninfo, None, 'GET', '/v1/files/1/data',
+                          response_file=io.BytesIO())
+        self.assertEqual(1, len(self.calls))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = qftpd.Metrics((0.1, 1))
+        self.metrics.describe('requests_total', 'counter', 'Requests')
+        self.metrics.describe('latency_seconds', 'histogram', 'Latency')
+
+    def test_counters(self):
+        self.metrics.inc('requests_total', (('call', 'get_file_attr'),))
+        self.metrics.inc('requests_total', (('call', 'get_file_attr'),), 2)
+        self.metrics.inc('requests_total', (('call', 'say "hi"'),))
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(['# HELP requests_total Requests',
+                          '# TYPE requests_total counter',
+                          'requests_total{call="get_file_attr"} 3',
+                          'requests_total{call="say \\"hi\\""} 1'], lines)
+
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0.05, 0.1, 0.5, 5):
+            self.metrics.observe('latency_seconds', (), value)
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(['latency_seconds_bucket{le="0.1"} 2',
+                          'latency_seconds_bucket{le="1"} 3',
+                          'latency_seconds_bucket{le="+Inf"} 4',
+                          'latency_seconds_sum 5.65',
+                          'latency_seconds_count 4'], lines[2:])
+
+    def test_collectors_run_at_render(self):
+        self.metrics.add_collector(
+            lambda: [('requests_total', (('call', 'x'),), 7)])
+        self.assertIn('requests_total{call="x"} 7', self.metrics.render())
+
+    def test_rest_calls_are_named_by_api_function(self):
+        untracked = qftpd.untracked_rest_request
+        metrics = qftpd.metrics
+        qftpd.metrics = self.metrics
+
+        def request(conninfo, credentials, method, uri):
+            raise RequestError(404, 'Not Found', None)
+        qftpd.untracked_rest_request = request
+
+        def get_file_attr():
+            qftpd.tracked_rest_request(FakeConnection('a'), None, 'GET', '/')
+        try:
+            self.assertRaises(RequestError, get_file_attr)
+        finally:
+            qftpd.untracked_rest_request = untracked
+            qftpd.metrics = metrics
+        values = self.metrics.values
+        self.assertEqual(1, values[('qftpd_rest_request_errors_total',
+                                    (('call', 'get_file_attr'),
+                                     ('status', 404)))])
+        self.assertIn(('qftpd_rest_request_seconds',
+                       (('call', 'get_file_attr'),)), values)
+
+    def test_cache_stats(self):
+        samples = dict(((name, labels), value) for name, labels, value
+                       in qftpd.collect_cache_stats())
+        self.assertIn(('qftpd_cache_hit_ratio', (('cache', 'attr'),)),
+                      samples)
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.trace_file = '/tmp/test_qftpd-%d.trace' % os.getpid()
+        if os.path.exists(self.trace_file):
+            os.remove(self.trace_file)
+        self.knobs = qftpd.TRACE_FILE, qftpd.SLOW_COMMAND_SECONDS
+        qftpd.TRACE_FILE = self.trace_file
+        qftpd.tracer = qftpd.Tracer()
+        self.trace = qftpd.SessionTrace(u'session 127.0.0.1:1234')
+        self.untracked = qftpd.untracked_rest_request
+
+        def request(conninfo, credentials, method, uri, body=None,
+                    body_file=None, response_file=None):
+            if uri == '/missing':
+                raise RequestError(404, 'Not Found', None)
+            if response_file is not None:
+                response_file.write('x' * 100)
+                return qumulo.lib.request.RestResponse(None, None)
+            return qumulo.lib.request.RestResponse({'name': 'f'}, None)
+        qftpd.untracked_rest_request = request
+
+    def tearDown(self):
+        qftpd.untracked_rest_request = self.untracked
+        qftpd.TRACE_FILE, qftpd.SLOW_COMMAND_SECONDS = self.knobs
+        qftpd.tracer = qftpd.Tracer()
+        if os.path.exists(self.trace_file):
+            os.remove(self.trace_file)
+
+    def events(self):
+        with open(self.trace_file) as f:
+            return json.loads(f.read().rstrip(',\n') + ']')
+
+    def test_calls_are_recorded_under_their_command(self):
+        conninfo = FakeConnection('a')
+        conninfo.trace = self.trace
+
+        def get_file_attr():
+            qftpd.tracked_rest_request(conninfo, None, 'GET', '/attr')
+
+        def read_file():
+            qftpd.tracked_rest_request(conninfo, None, 'GET', '/data',
+                                       response_file=io.BytesIO())
+        self.trace.begin('RETR', u'/file')
+        get_file_attr()
+        read_file()
+        self.trace.end()
+        events = self.events()
+        self.assertEqual(['thread_name', 'RETR', 'get_file_attr', 'read_file'],
+                         [event['name'] for event in events])
+        command, attr, data = events[1:]
+        self.assertEqual(u'/file', command['args']['arg'])
+        self.assertEqual(2, command['args']['calls'])
+        self.assertEqual(self.trace.id, attr['tid'])
+        self.assertEqual(len(json.dumps({'name': 'f'})),
+                         attr['args']['received'])
+        self.assertEqual(100, data['args']['received'])
+        self.assertEqual('RETR', data['args']['command'])
+
+    def test_calls_are_found_through_the_thread(self):
+        self.trace.begin('PASS', '******')
+
+        def login():
+            self.assertRaises(RequestError, qftpd.tracked_rest_request,
+                              FakeConnection('a'), None, 'POST', '/missing',
+                              body={'username': 'admin'})
+        qftpd.tracer.run(self.trace, login)
+        qftpd.tracked_rest_request(FakeConnection('a'), None, 'GET', '/other')
+        command = self.trace.command
+        self.trace.end()
+        self.assertEqual(1, len(command.calls))
+        self.assertEqual(404, command.calls[0].status)
+        self.assertEqual(len(json.dumps({'username': 'admin'})),
+                         command.calls[0].sent)
+
+    def test_calls_outliving_their_command_are_written_alone(self):
+        conninfo = FakeConnection('a')
+        conninfo.trace = self.trace
+        self.trace.begin('RETR', u'/file')
+        self.trace.end()
+        qftpd.tracked_rest_request(conninfo, None, 'GET', '/data',
+                                   response_file=io.BytesIO())
+        event = self.events()[-1]
+        self.assertEqual('RETR', event['args']['command'])
+        self.assertEqual(threading.current_thread().ident, event['tid'])
+
+    def test_slow_command_description(self):
+        conninfo = FakeConnection('a')
+        conninfo.trace = self.trace
+
+        def get_file_attr():
+            qftpd.tracked_rest_request(conninfo, None, 'GET', '/attr')
+        self.trace.begin('LIST', u'/big')
+        command = self.trace.command
+        for _ in range(3):
+            get_file_attr()
+        self.trace.end()
+        lines = command.describe(self.trace).splitlines()
+        self.assertIn('LIST /big', lines[0])
+        self.assertIn('in 3 REST calls', lines[0])
+        self.assertTrue(lines[1].startswith('  get_file_attr: 3 calls'),
+                        lines[1])
+        # and each of them, slowest first
+        self.assertEqual(5, len(lines))
+
+    def test_stack_sampler_writes_folded_stacks(self):
+        sampler = qftpd.StackSampler(0.001, 5, '/tmp')
+        sampler.toggle()
+        sleep(0.05)
+        sampler.toggle()
+        sampler.thread.join(5)
+        path = [name for name in os.listdir('/tmp')
+                if name.startswith('qftpd-%d-' % os.getpid())]
+        self.assertTrue(path)
+        try:
+            with open(os.path.join('/tmp', path[0])) as f:
+                lines = f.read().splitlines()
+        finally:
+            for name in path:
+                os.remove(os.path.join('/tmp', name))
+        self.assertTrue(any(line.startswith('MainThread;') and
+                            'test_stack_sampler_writes_folded_stacks' in line
+                            for line in lines))
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(int(count) > 0)
+
+
+class TestBufferBudget(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.budget = qftpd.buffer_budget
+        qftpd.buffer_budget = qftpd.BufferBudget(4000)
+
+    def tearDown(self):
+        FakeClusterTest.tearDown(self)
+        qftpd.buffer_budget = self.budget
+
+    def test_limit(self):
+        budget = qftpd.buffer_budget
+        self.assertTrue(budget.try_acquire(3000))
+        self.assertFalse(budget.try_acquire(1001))
+        # optional requests leave a quarter of it free
+        self.assertFalse(budget.try_acquire(1000, optional=True))
+        self.assertTrue(budget.try_acquire(1000))
+        budget.release(4000)
+        # however big, one request can go when nothing else is held
+        self.assertTrue(budget.try_acquire(10000))
+        self.assertEqual({'used': 10000, 'peak': 10000, 'limit': 4000},
+                         budget.stats())
+
+    def test_upload_waits_for_budget(self):
+        fd = qftpd.WriteBuffer(u'/', u'file', self.fs, max_size=1000)
+        qftpd.buffer_budget.acquire(3500)
+        self.assertFalse(fd.buffer_ready(1000))
+        self.assertTrue(fd.buffer_ready(500))
+        fd.write('x' * 500)
+        self.assertEqual(4000, qftpd.buffer_budget.used)
+        qftpd.buffer_budget.release(3500)
+        self.assertTrue(fd.buffer_ready(1000))
+        fd.write('x' * 1000)  # a full chunk is written and let go
+        self.assertEqual(500, qftpd.buffer_budget.used)
+        fd.close()
+        self.assertEqual(0, qftpd.buffer_budget.used)
+        self.assertEqual(1500, self.fs.getsize(u'/file'))
+
+    def test_uploads_staging_the_whole_budget_keep_going(self):
+        fds = [qftpd.WriteBuffer(u'/', u'file%d' % i, self.fs, max_size=1000)
+               for i in range(8)]
+        sent = dict.fromkeys(fds, 0)
+        while any(n < 2000 for n in sent.values()):
+            progress = False
+            for fd in fds:
+                if sent[fd] < 2000 and fd.buffer_ready(300):
+                    fd.write('x' * 300)
+                    sent[fd] += 300
+                    progress = True
+            self.assertTrue(progress, qftpd.buffer_budget.used)
+        for fd in fds:
+            fd.close()
+        self.assertEqual(0, qftpd.buffer_budget.used)
+        self.assertEqual(2100, self.fs.getsize(u'/file7'))
+
+    def test_read_ahead_within_budget(self):
+        self.cluster.make_file('/file', 10000)
+        fd = qftpd.ReadBuffer(u'/file', self.fs, chunk_size=1000, size=10000)
+        fd.window = 8
+        self.assertTrue(fd.buffer_ready(1000))
+        self.assertEqual(1000, len(fd.read(1000)))
+        # the next range, plus read-ahead while a quarter is left over
+        self.assertEqual(3000, qftpd.buffer_budget.used)
+        self.assertEqual(2, len(fd.pending))
+        self.assertEqual(9000, len(fd.read(9000)))
+        fd.close()
+        self.assertEqual(0, qftpd.buffer_budget.used)
+
+    def test_download_waits_for_budget(self):
+        self.cluster.make_file('/file', 10000)
+        fd = qftpd.ReadBuffer(u'/file', self.fs, chunk_size=1000, size=10000)
+        qftpd.buffer_budget.acquire(3500)
+        self.assertFalse(fd.buffer_ready(1000))
+        qftpd.buffer_budget.release(3500)
+        self.assertTrue(fd.buffer_ready(1000))
+        fd.close()
+        self.assertEqual(0, qftpd.buffer_budget.used)
+
+
+class FakeLoopExecutor(object):
+    """An IOLoopExecutor whose IOLoop is the test itself, running tasks
+    when the test says so
+    """
+    def __init__(self):
+        self.tasks = []
+
+    def in_loop(self):
+        return True
+
+    def in_worker(self):
+        return False
+
+    def submit(self, function, callback):
+        self.tasks.append((function, callback))
+
+    def run_tasks(self):
+        tasks, self.tasks = self.tasks, []
+        for function, callback in tasks:
+            callback(function(), None)
+
+
+class GatedCluster(fake_qumulo.FakeCluster):
+    """Holds reads and writes until the test opens the gate"""
+    def __init__(self):
+        fake_qumulo.FakeCluster.__init__(self)
+        self.gate = threading.Event()
+
+    def call(self, name, *details, **kwargs):
+        if name in qftpd.BULK_CALLS:
+            self.gate.wait()
+        fake_qumulo.FakeCluster.call(self, name, *details, **kwargs)
+
+
+class FakeSession(object):
+    data_channel = None
+    trace = None
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.busy = False
+
+    def process_pending_lines(self):
+        pass
+
+
+class TestIOLoopTransfers(FakeClusterTest):
+    """The data channel's side of a transfer, which on the IOLoop must
+    never wait on the cluster
+    """
+    cluster_class = GatedCluster
+
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.cluster.make_file(u'/file.bin', data='x' * 250)
+        self.executor = qftpd.QFTPHandler.executor
+        qftpd.QFTPHandler.executor = FakeLoopExecutor()
+
+    def tearDown(self):
+        self.cluster.gate.set()
+        FakeClusterTest.tearDown(self)
+        qftpd.QFTPHandler.executor = self.executor
+        qftpd.READ_AHEAD_MAX = 8
+
+    def wait_ready(self, fd):
+        for _ in range(500):
+            if fd.buffer_ready(100):
+                return
+            sleep(0.01)
+        self.fail("buffer never got ready")
+
+    def test_download_waits_for_range_to_arrive(self):
+        fd = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                              size=250)
+        self.assertFalse(fd.buffer_ready(100))  # asked for, not here yet
+        self.assertEqual(1, len(fd.pending))
+        self.cluster.gate.set()
+        self.wait_ready(fd)
+        self.assertEqual('x' * 100, fd.read(100))
+        fd.close()
+
+    def test_read_comes_up_short_rather_than_wait(self):
+        fd = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                              size=250)
+        fd.buffer_ready(100)
+        self.cluster.gate.set()
+        self.wait_ready(fd)
+        self.cluster.gate.clear()
+        self.assertEqual(60, len(fd.read(60)))
+        self.assertEqual(40, len(fd.read(100)))
+        self.assertFalse(fd.buffer_ready(100))
+        fd.close()
+
+    def test_download_without_read_ahead_fetches_in_a_worker(self):
+        qftpd.READ_AHEAD_MAX = 0
+        fd = qftpd.ReadBuffer(u'/file.bin', self.fs, chunk_size=100,
+                              size=250)
+        self.assertFalse(fd.buffer_ready(100))
+        self.cluster.gate.set()
+        data = ''
+        while True:
+            self.wait_ready(fd)
+            piece = fd.read(100)
+            if not piece:
+                break
+            self.assertTrue(len(fd.pending) <= 1)
+            data += piece
+        self.assertEqual('x' * 250, data)
+        fd.close()
+
+    def test_upload_chunks_are_written_by_a_worker(self):
+        fd = qftpd.WriteBuffer(u'/', u'up.bin', self.fs, max_size=100)
+        self.assertTrue(fd.buffer_ready(100))
+        fd.write('x' * 100)  # handed over, not written yet
+        self.assertEqual(1, len(fd.uploader.threads))
+        self.assertTrue(fd.buffer_ready(100))  # one more can wait its turn
+        fd.write('y' * 100)
+        self.assertFalse(fd.buffer_ready(100))
+        self.assertTrue(fd.buffer_ready(50))  # doesn't fill a chunk
+        self.assertEqual('', self.cluster.contents(u'/up.bin'))
+        self.cluster.gate.set()
+        fd.close()
+        self.assertEqual('x' * 100 + 'y' * 100,
+                         self.cluster.contents(u'/up.bin'))
+
+    def test_upload_short_of_budget_hands_over_what_it_has(self):
+        budget = qftpd.buffer_budget
+        qftpd.buffer_budget = qftpd.BufferBudget(150)
+        try:
+            fd = qftpd.WriteBuffer(u'/', u'up.bin', self.fs, max_size=100)
+            self.assertTrue(fd.buffer_ready(50))
+            fd.write('x' * 50)
+            qftpd.buffer_budget.acquire(100)  # held by other uploads
+            self.assertFalse(fd.buffer_ready(50))
+            self.assertEqual(1, len(fd.uploader.threads))
+            self.cluster.gate.set()
+            for _ in range(500):
+                if fd.buffer_ready(50):
+                    break
+                sleep(0.01)
+            self.assertEqual('x' * 50, self.cluster.contents(u'/up.bin'))
+            fd.write('y' * 50)
+            fd.close()
+            self.assertEqual(100, qftpd.buffer_budget.used)
+        finally:
+            qftpd.buffer_budget = budget
+        self.assertEqual('x' * 50 + 'y' * 50,
+                         self.cluster.contents(u'/up.bin'))
+
+    def test_listing_is_pulled_in_a_worker(self):
+        pulled = []
+
+        def lines():
+            for i in range(3):
+                pulled.append(i)
+                yield 'line %d\r\n' % i
+        session = FakeSession(qftpd.QFTPHandler.executor)
+        producer = qftpd.WorkerProducer(lines(), session)
+        self.assertFalse(producer.buffer_ready(100))
+        self.assertTrue(session.busy)  # the session's commands wait
+        self.assertEqual([], pulled)
+        session.executor.run_tasks()
+        self.assertFalse(session.busy)
+        self.assertTrue(producer.buffer_ready(100))
+        self.assertEqual('line 0\r\nline 1\r\nline 2\r\n', producer.more())
+        self.assertFalse(producer.buffer_ready(100))
+        session.executor.run_tasks()
+        self.assertEqual('', producer.more())
+
+
+class TestRestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = qftpd.RestScheduler(1, 1, 0.5)
+        self.started = []
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def queue(self, share, bulk, label):
+        """acquire() in a thread, which notes label once it gets through"""
+        queued = self.scheduler.queued()
+
+        def call():
+            self.scheduler.acquire(share, bulk)
+            self.started.append(label)
+        thread = threading.Thread(target=call)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        while self.scheduler.queued() == queued:
+            sleep(0.001)
+
+    def release(self, share, bulk):
+        """finish one call and wait for any it let go to get going"""
+        count, queued = len(self.started), self.scheduler.queued()
+        self.scheduler.release(share, bulk)
+        if self.scheduler.queued() < queued:
+            while len(self.started) == count:
+                sleep(0.001)
+
+    def test_metadata_goes_before_bulk(self):
+        share = qftpd.FairShare('a')
+        self.scheduler.acquire(share, False)
+        self.queue(share, True, 'bulk')
+        self.queue(share, False, 'metadata')
+        self.release(share, False)
+        self.release(share, False)
+        self.release(share, True)
+        self.assertEqual(['metadata', 'bulk'], self.started)
+
+    def test_sessions_take_turns(self):
+        self.scheduler.user_limit = 10
+        other = qftpd.FairShare('other')
+        busy, quiet = qftpd.FairShare('batch'), qftpd.FairShare('user')
+        self.scheduler.acquire(other, False)
+        for i in range(3):
+            self.queue(busy, False, 'batch %d' % i)
+        for i in range(2):
+            self.queue(quiet, False, 'user %d' % i)
+        for share in (other, busy, quiet, busy, quiet):
+            self.release(share, False)
+        self.assertEqual(['batch 0', 'user 0', 'batch 1', 'user 1',
+                          'batch 2'], self.started)
+        # a session that already had more turns waits for the others'
+        self.queue(busy, False, 'batch 3')
+        self.queue(quiet, False, 'user 2')
+        self.release(busy, False)
+        self.assertEqual('user 2', self.started[-1])
+        self.release(quiet, False)
+        self.release(busy, False)
+
+    def test_user_limit(self):
+        self.scheduler.resize(2)
+        first, second = qftpd.FairShare('a'), qftpd.FairShare('b')
+        self.scheduler.acquire(first, False)
+        self.scheduler.acquire(second, False)
+        self.scheduler.resize(3)
+        self.queue(first, False, 'a')
+        self.assertEqual(1, self.scheduler.queued())
+        # calls from the IOLoop go out regardless
+        self.assertEqual(0.0, self.scheduler.acquire(first, False,
+                                                     wait=False))
+        self.scheduler.release(first, False)
+        self.release(first, False)
+        self.assertEqual(['a'], self.started)
+
+    def test_bulk_share(self):
+        self.scheduler.resize(4)
+        self.scheduler.user_limit = 10
+        share = qftpd.FairShare('a')
+        self.scheduler.acquire(share, True)
+        self.scheduler.acquire(share, True)
+        self.queue(share, True, 'bulk')
+        self.scheduler.acquire(share, False)
+        self.assertEqual({'in_flight': {False: 1, True: 2},
+                          'queued': {False: 0, True: 1}},
+                         self.scheduler.stats())
+        self.release(share, True)
+        self.assertEqual(['bulk'], self.started)
+
+    def test_overloaded(self):
+        limit = qftpd.REST_QUEUE_LIMIT
+        qftpd.REST_QUEUE_LIMIT = 1
+        try:
+            share = qftpd.FairShare('a')
+            self.scheduler.acquire(share, False)
+            self.assertFalse(self.scheduler.overloaded())
+            self.queue(share, False, 'a')
+            self.assertTrue(self.scheduler.overloaded())
+            self.release(share, False)
+        finally:
+            qftpd.REST_QUEUE_LIMIT = limit
+
+    def test_session_calls_are_scheduled(self):
+        scheduler, untracked = qftpd.rest_scheduler, qftpd.untracked_rest_request
+        qftpd.rest_scheduler = self.scheduler
+        qftpd.untracked_rest_request = lambda *args, **kwargs: (
+            self.started.append(self.scheduler.stats()['in_flight']))
+        conninfo = FakeConnection('a')
+        conninfo.share = qftpd.FairShare('a')
+
+        def read_file():
+            qftpd.tracked_rest_request(conninfo, None, 'GET', '/')
+        try:
+            read_file()
+        finally:
+            qftpd.rest_scheduler = scheduler
+            qftpd.untracked_rest_request = untracked
+        self.assertEqual([{False: 0, True: 1}], self.started)
+        self.assertEqual({False: 0, True: 0},
+                         self.scheduler.stats()['in_flight'])
+
+    def test_calls_within_a_call_are_not_scheduled(self):
+        scheduler, untracked = qftpd.rest_scheduler, qftpd.untracked_rest_request
+        qftpd.rest_scheduler = self.scheduler  # one call per user
+        conninfo = FakeConnection('a')
+        conninfo.share = qftpd.FairShare('a')
+
+        def probe(conninfo, credentials, method, uri, *args, **kwargs):
+            # like Connection.maybe_probe_reuse_flag() on a new connection
+            if uri == '/':
+                qumulo.lib.request.rest_request(conninfo, None, 'GET',
+                                                '/v1/version')
+            self.started.append(uri)
+        qftpd.untracked_rest_request = probe
+        try:
+            qftpd.tracked_rest_request(conninfo, None, 'GET', '/')
+        finally:
+            qftpd.rest_scheduler = scheduler
+            qftpd.untracked_rest_request = untracked
+        self.assertEqual(['/v1/version', '/'], self.started)
+        self.assertEqual({False: 0, True: 0},
+                         self.scheduler.stats()['in_flight'])
+
+
+class TestFakeQumulo(FakeClusterTest):
+    def setUp(self):
+        FakeClusterTest.setUp(self)
+        self.fs.cmd_channel = FakeCmdChannel()
+
+    def test_listing_pages(self):
+        self.cluster.make_files('/dir', 25)
+        qftpd.LISTDIR_PAGE_SIZE = 10
+        try:
+            names = list(self.fs.listdir(u'/dir'))
+        finally:
+            qftpd.LISTDIR_PAGE_SIZE = 1000
+        self.assertEqual(['f%06d' % i for i in range(25)], names)
+        self.assertEqual(3, self.cluster.calls['read_directory'])
+
+    def test_write_and_read_back(self):
+        data = ''.join(chr(i % 256) for i in range(3000))
+        fd = self.fs.open(u'/file', 'wb')
+        fd.write(data)
+        fd.close()
+        self.assertEqual(3000, self.fs.getsize(u'/file'))
+        fd = self.fs.open(u'/file', 'rb')
+        self.assertEqual(data, fd.read(len(data) + 1))
+        fd.close()
+
+    def test_missing_path(self):
+        self.assertRaises(qftpd.FilesystemError, self.fs.lstat, u'/nope')
+
+    def test_calls_need_a_session(self):
+        rc = RestClient('127.0.0.1', API_PORT)
+        self.assertRaises(RequestError, rc.fs.get_file_attr, path=u'/')
+        self.assertRaises(RequestError, rc.login, API_USER, 'wrong')
+        rc.login(API_USER, API_PASS)
+        self.assertEqual(u'/', rc.fs.get_file_attr(path=u'/')['path'])
+
+    def test_calls_are_measured_like_real_ones(self):
+        metrics = qftpd.metrics
+        qftpd.metrics = qftpd.Metrics((0.1, 1))
+        try:
+            self.assertFalse(self.fs.lexists(u'/nope'))
+            values = qftpd.metrics.values
+        finally:
+            qftpd.metrics = metrics
+        self.assertEqual(1, values[('qftpd_rest_request_errors_total',
+                                    (('call', 'get_file_attr'),
+                                     ('status', 404)))])
+
+
 class TestQSFSAuthorizer(unittest.TestCase):
     def test_has_user(self):
         target_user = 'admin'